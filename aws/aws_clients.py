@@ -0,0 +1,183 @@
+"""
+AWS connections shared by the scripts of the aws tools.
+
+Connections are made on first use, once per service and region, and shared by every worker thread: boto
+connections keep a pool of HTTP connections per host, here capped to the number of workers.  Credentials are
+resolved once per process, from the given keys or else the environment, ~/.aws or the instance profile, and
+every connection gets the same timeout and retry policy.
+
+The scripts of aws/s3bucket and aws/snapshot import it from the directory above them.
+"""
+import sys
+import threading
+import traceback
+
+from boto import ec2, iam, s3
+from boto.connection import ConnectionPool
+from boto.provider import Provider
+from boto.regioninfo import RegionInfo
+
+# Idle HTTP connections kept per host, at least the number of threads making calls
+DEFAULT_POOL_SIZE = 10
+
+# Seconds a socket may block, and attempts made by boto on errors it retries, i.e. 5xx and connection resets
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 5
+
+SERVICES = {'ec2': ec2, 'iam': iam, 's3': s3}
+
+# AwsClients by credentials, made once per process
+clients = {}
+clients_lock = threading.Lock()
+
+
+def print_list(llist):
+    return '[%s]' % '\n'.join(map(str, llist))
+
+
+def print_exception(e):
+    (typeE, value, tracebackPrev) = sys.exc_info()
+    print(str(typeE) + ':' + str(value))
+    print(" PREV=\n" + print_list(traceback.extract_tb(tracebackPrev)))
+
+
+class BoundedConnectionPool(ConnectionPool):
+    """
+    boto ConnectionPool keeping at most size idle HTTP connections per host.  Connections returned once the
+    pool of their host is full are closed.
+    """
+
+    def __init__(self, size):
+        ConnectionPool.__init__(self)
+        self.size = size
+
+    def put_http_connection(self, host, port, is_secure, conn):
+        with self.mutex:
+            pool = self.host_to_pool.get((host, port, is_secure))
+            full = pool is not None and pool.size() >= self.size
+        if full:
+            conn.close()
+        else:
+            ConnectionPool.put_http_connection(self, host, port, is_secure, conn)
+
+
+class AwsClients(object):
+    """
+    Connections of one set of credentials, made on first use and shared by all threads
+    """
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        """
+        :param aws_access_key_id: if None, the environment, the .aws/config on this system or the instance
+                                  profile are used
+        """
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self._provider = None
+        self.connections = {}
+        # RegionInfo by (service, region name) of the regions listed by the account, newer than the boto release
+        self.regions = {}
+        self.lock = threading.Lock()
+
+    @property
+    def provider(self):
+        """
+        The credentials, resolved on first use.  Credentials of an instance profile are refreshed by boto
+        before they expire.
+        """
+        with self.lock:
+            if self._provider is None:
+                self._provider = Provider('aws', self.aws_access_key_id, self.aws_secret_access_key)
+            return self._provider
+
+    def add_regions(self, service, regions):
+        """
+        Connect to these regions with their endpoint, instead of the regions known to boto
+        :param regions: list of boto RegionInfo, i.e. from get_all_regions of an EC2 connection
+        """
+        with self.lock:
+            for region in regions:
+                self.regions[(service, region.name)] = region
+
+    def connect(self, service, region_name, connection_class=None, **kw_params):
+        """
+        Make a new connection, with the shared credentials and the pool, timeout and retry policy
+        :param service: ec2, iam or s3
+        :param connection_class: i.e. a subclass of the boto connection class of the service
+        :return: the connection, None if the region is not known
+        """
+        with self.lock:
+            region = self.regions.get((service, region_name))
+        if region is None:
+            regions = [region for region in SERVICES[service].regions() if region.name == region_name]
+            if len(regions) == 0:
+                return None
+            region = regions[0]
+        if connection_class is not None:
+            region = RegionInfo(name=region.name, endpoint=region.endpoint, connection_cls=connection_class)
+        provider = self.provider
+        conn = region.connect(aws_access_key_id=provider.access_key, aws_secret_access_key=provider.secret_key,
+                              security_token=provider.security_token, **kw_params)
+        # Sign with the shared provider, so credentials of an instance profile are refreshed once for all
+        conn.provider = provider
+        conn._auth_handler.update_provider(provider)
+        conn._pool = BoundedConnectionPool(self.pool_size)
+        conn.http_connection_kwargs['timeout'] = self.timeout
+        conn.num_retries = self.retries
+        return conn
+
+    def get(self, service, region_name, connection_class=None, **kw_params):
+        """
+        The connection of the service and region, made by the first call.  kw_params of later calls are
+        ignored.
+        :return: the connection, None if the region is not known
+        """
+        key = (service, region_name, connection_class)
+        with self.lock:
+            conn = self.connections.get(key)
+        if conn is None:
+            conn = self.connect(service, region_name, connection_class, **kw_params)
+            if conn is None:
+                return None
+            with self.lock:
+                conn = self.connections.setdefault(key, conn)
+        return conn
+
+    def get_or_raise(self, service, region_name):
+        conn = self.get(service, region_name)
+        if conn is None:
+            raise Exception("Could not get {} connection to region {}, invalid credentials.".format(service,
+                                                                                                   region_name))
+        return conn
+
+    def ec2(self, region_name):
+        return self.get_or_raise('ec2', region_name)
+
+    def iam(self, region_name):
+        return self.get_or_raise('iam', region_name)
+
+    def s3(self, region_name):
+        return self.get_or_raise('s3', region_name)
+
+
+def get_clients(aws_access_key_id=None, aws_secret_access_key=None, pool_size=None, timeout=None, retries=None):
+    """
+    The AwsClients of the credentials, made by the first call.  pool_size, timeout and retries, default
+    DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT and DEFAULT_RETRIES, apply to the connections made after the call.
+    """
+    with clients_lock:
+        key = (aws_access_key_id, aws_secret_access_key)
+        if key not in clients:
+            clients[key] = AwsClients(aws_access_key_id, aws_secret_access_key)
+        aws_clients = clients[key]
+        if pool_size is not None:
+            aws_clients.pool_size = pool_size
+        if timeout is not None:
+            aws_clients.timeout = timeout
+        if retries is not None:
+            aws_clients.retries = retries
+        return aws_clients
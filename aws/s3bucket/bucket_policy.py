@@ -0,0 +1,414 @@
+"""
+Offline evaluation, rendering and merging of S3 bucket policies.
+
+Predicts whether a bucket policy allows a principal an S3 action on a bucket or an object, following the AWS
+evaluation logic: an explicit Deny wins over any Allow, and a request no statement allows is implicitly
+denied.  Only what bucket policies use is supported: Principal and NotPrincipal, Action and NotAction,
+Resource and NotResource, and the String and Bool conditions with their IfExists variants.
+
+Policies are rendered from a template parsed once, for any number of accounts and bucket paths, and can be
+merged into an existing bucket policy.
+"""
+from collections import OrderedDict
+import json
+import re
+import threading
+
+ALLOW = 'allow'
+DENY = 'deny'
+IMPLICIT_DENY = 'implicit deny'
+
+# Condition operator to (test of a policy value against a request value, True if the operator is negated)
+CONDITION_OPERATORS = {
+    'StringEquals': (lambda pattern, value: pattern == value, False),
+    'StringNotEquals': (lambda pattern, value: pattern == value, True),
+    'StringEqualsIgnoreCase': (lambda pattern, value: pattern.lower() == value.lower(), False),
+    'StringNotEqualsIgnoreCase': (lambda pattern, value: pattern.lower() == value.lower(), True),
+    'StringLike': (lambda pattern, value: wildcard_match(pattern, value), False),
+    'StringNotLike': (lambda pattern, value: wildcard_match(pattern, value), True),
+    'Bool': (lambda pattern, value: pattern.lower() == value.lower(), False),
+}
+
+DEFAULT_POLICY_VERSION = '2012-10-17'
+
+# Operators of conditions that allow any of their values, so statements differing only by the values of such a
+# condition allow the same as one statement with all the values
+COMBINABLE_OPERATORS = ('StringEquals', 'StringEqualsIgnoreCase', 'StringLike')
+
+# Size limit of a bucket policy in bytes, measured on its JSON without whitespace
+MAX_POLICY_SIZE = 20 * 1024
+
+# Compiled wildcard patterns, policies are evaluated many times with the same patterns
+patterns = {}
+patterns_lock = threading.Lock()
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def wildcard_match(pattern, value, ignore_case=False):
+    """
+    Match value against a policy pattern, where * matches any characters including / and ? matches one
+    """
+    with patterns_lock:
+        regex = patterns.get((pattern, ignore_case))
+        if regex is None:
+            regex = re.compile('^' + ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char)
+                                             for char in pattern) + '$', re.IGNORECASE if ignore_case else 0)
+            patterns[(pattern, ignore_case)] = regex
+    return regex.match(value) is not None
+
+
+def load_policy(policy):
+    """
+    :param policy: a policy dict, a JSON string, or the output of get-bucket-policy which wraps the policy as a
+                   JSON string under Policy
+    :return: the policy dict
+    """
+    if isinstance(policy, basestring):
+        policy = json.loads(policy, object_pairs_hook=OrderedDict)
+    if 'Statement' not in policy and isinstance(policy.get('Policy'), basestring):
+        policy = json.loads(policy['Policy'], object_pairs_hook=OrderedDict)
+    return policy
+
+
+def principal_account(principal):
+    """
+    :param principal: an account id or an IAM ARN
+    :return: the account id
+    """
+    if principal.startswith('arn:'):
+        return principal.split(':')[4]
+    return principal
+
+
+def principal_matches(statement_principal, principal):
+    """
+    A statement naming an account, or its root, applies to every principal of the account
+    """
+    if statement_principal == '*':
+        return True
+    if isinstance(statement_principal, dict):
+        values = as_list(statement_principal.get('AWS'))
+    else:
+        values = as_list(statement_principal)
+    account_id = principal_account(principal)
+    for value in values:
+        if value in ('*', principal, account_id, 'arn:aws:iam::{}:root'.format(account_id)):
+            return True
+    return False
+
+
+def condition_matches(condition, context):
+    """
+    Every operator of the condition block, and every key of an operator, must match.  A key matches if any of
+    its values matches the request value, for a negated operator if none of them does.
+    :param context: dict of condition key to the request value, i.e. s3:prefix
+    """
+    context = dict((key.lower(), value) for key, value in context.iteritems())
+    for operator, keys in condition.iteritems():
+        if_exists = operator.endswith('IfExists')
+        name = operator[:-len('IfExists')] if if_exists else operator
+        if name not in CONDITION_OPERATORS:
+            raise Exception("Unsupported condition operator {}".format(operator))
+        test, negated = CONDITION_OPERATORS[name]
+        for key, values in keys.iteritems():
+            value = context.get(key.lower())
+            if value is None:
+                if not (if_exists or negated):
+                    return False
+                continue
+            matched = any(test(str(pattern), str(value)) for pattern in as_list(values))
+            if matched == negated:
+                return False
+    return True
+
+
+def statement_matches(statement, principal, action, resource, context):
+    if 'Principal' in statement and not principal_matches(statement['Principal'], principal):
+        return False
+    if 'NotPrincipal' in statement and principal_matches(statement['NotPrincipal'], principal):
+        return False
+    if 'Action' in statement and not any(wildcard_match(pattern, action, True)
+                                         for pattern in as_list(statement['Action'])):
+        return False
+    if 'NotAction' in statement and any(wildcard_match(pattern, action, True)
+                                        for pattern in as_list(statement['NotAction'])):
+        return False
+    if 'Resource' in statement and not any(wildcard_match(pattern, resource)
+                                           for pattern in as_list(statement['Resource'])):
+        return False
+    if 'NotResource' in statement and any(wildcard_match(pattern, resource)
+                                          for pattern in as_list(statement['NotResource'])):
+        return False
+    return condition_matches(statement.get('Condition', {}), context)
+
+
+def matching_statements(policy, principal, action, resource, context=None):
+    """
+    :return: list of (effect, Sid) of the statements that apply to the request
+    """
+    policy = load_policy(policy)
+    return [(statement['Effect'], statement.get('Sid'))
+            for statement in as_list(policy.get('Statement'))
+            if statement_matches(statement, principal, action, resource, context or {})]
+
+
+def evaluate(policy, principal, action, resource, context=None):
+    """
+    :param principal: account id or IAM ARN making the request
+    :param action: i.e. s3:GetObject
+    :param resource: ARN of the bucket or object, see bucket_arn and object_arn
+    :param context: dict of condition key to the request value, i.e. {'s3:prefix': 'logs/'}
+    :return: ALLOW, DENY or IMPLICIT_DENY
+    """
+    effects = [effect for effect, _ in matching_statements(policy, principal, action, resource, context)]
+    if 'Deny' in effects:
+        return DENY
+    if 'Allow' in effects:
+        return ALLOW
+    return IMPLICIT_DENY
+
+
+def bucket_arn(bucket_name):
+    return 'arn:aws:s3:::{}'.format(bucket_name)
+
+
+def object_arn(bucket_name, key):
+    return 'arn:aws:s3:::{}/{}'.format(bucket_name, key)
+
+
+def substitute(value, values):
+    """
+    :return: a copy of the JSON value with the placeholders in values replaced in every string
+    """
+    if isinstance(value, dict):
+        return type(value)((key, substitute(item, values)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [substitute(item, values) for item in value]
+    if isinstance(value, basestring):
+        for placeholder, replacement in values.iteritems():
+            value = value.replace(placeholder, replacement)
+    return value
+
+
+def drop_condition_key(statement, condition_key):
+    """
+    Remove a condition key from the statement, and the operators and Condition it leaves empty
+    """
+    condition = statement.get('Condition', {})
+    for operator in condition.keys():
+        condition[operator].pop(condition_key, None)
+        if not condition[operator]:
+            del condition[operator]
+    if 'Condition' in statement and not condition:
+        del statement['Condition']
+
+
+class PolicyTemplate(object):
+    """
+    A bucket policy with <INTERANA_ACCOUNT_ID>, <BUCKET_NAME> and <BUCKET_PREFIX> placeholders, parsed once and
+    rendered for any number of accounts and bucket paths
+    """
+
+    def __init__(self, template):
+        self.template = load_policy(template)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as fh:
+            return cls(fh.read())
+
+    def render(self, account_id, bucket_name, bucket_prefix):
+        """
+        :param bucket_prefix: the path in the bucket followed by *, empty for the whole bucket.  A condition
+                              on s3:prefix can not match the whole bucket, they are left out for it.
+        :return: the policy
+        """
+        policy = substitute(self.template, {'<INTERANA_ACCOUNT_ID>': account_id,
+                                            '<BUCKET_NAME>': bucket_name,
+                                            '<BUCKET_PREFIX>': bucket_prefix})
+        if len(bucket_prefix) < 1:
+            for statement in as_list(policy.get('Statement')):
+                drop_condition_key(statement, 's3:prefix')
+        return policy
+
+    def render_all(self, entries):
+        """
+        :param entries: list of (account id, bucket name, bucket prefix)
+        :return: list of the policies
+        """
+        return [self.render(account_id, bucket_name, bucket_prefix)
+                for account_id, bucket_name, bucket_prefix in entries]
+
+
+def canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def without(statement, *fields):
+    return dict((key, value) for key, value in statement.iteritems() if key not in fields)
+
+
+def union(values, more):
+    return values + [value for value in more if value not in values]
+
+
+def combinable(field, value):
+    if value is None:
+        return False
+    if field == 'Principal':
+        return isinstance(value, dict) and value.keys() == ['AWS']
+    if field == 'Condition':
+        return (len(value) == 1 and value.keys()[0] in COMBINABLE_OPERATORS and
+                len(value.values()[0]) == 1)
+    return True
+
+
+def combine_statements(statements, field):
+    """
+    Combine the statements that only differ by their Sid and field, Principal, Resource or a single key
+    Condition, into one statement allowing the values of all of them
+    """
+    combined = []
+    by_rest = {}
+    for statement in statements:
+        value = statement.get(field)
+        if not combinable(field, value):
+            combined.append(statement)
+            continue
+        rest = canonical(without(statement, 'Sid', field))
+        if field == 'Condition':
+            operator, keys = value.items()[0]
+            rest += canonical([operator, keys.keys()[0]])
+        if rest not in by_rest:
+            by_rest[rest] = OrderedDict(statement)
+            combined.append(by_rest[rest])
+            continue
+        first = by_rest[rest]
+        if field == 'Principal':
+            first['Principal'] = {'AWS': union(as_list(first['Principal']['AWS']), as_list(value['AWS']))}
+        elif field == 'Condition':
+            operator, keys = first['Condition'].items()[0]
+            key, values = keys.items()[0]
+            first['Condition'] = {operator: {key: union(as_list(values), as_list(value[operator][key]))}}
+        else:
+            first[field] = union(as_list(first[field]), as_list(value))
+    return combined
+
+
+def principal_values(principal):
+    """
+    :return: the set of AWS principals of a Principal naming only AWS principals, account ids as their root ARN,
+             None for any other Principal
+    """
+    if not combinable('Principal', principal):
+        return None
+    return set(value if value.startswith('arn:') or value == '*' else 'arn:aws:iam::{}:root'.format(value)
+               for value in as_list(principal['AWS']))
+
+
+def condition_values(condition):
+    """
+    :return: (operator, key, set of values) of a single key Condition allowing any of its values, None otherwise
+    """
+    if not combinable('Condition', condition):
+        return None
+    operator, keys = condition.items()[0]
+    key, values = keys.items()[0]
+    return operator, key, set(as_list(values))
+
+
+def covers(statement, other):
+    """
+    :return: True if statement applies to every request other applies to, with the same effect: both only differ
+             by their Sid, and statement has all the principals, resources and condition values of other
+    """
+    if canonical(without(statement, 'Sid', 'Principal', 'Resource', 'Condition')) != \
+            canonical(without(other, 'Sid', 'Principal', 'Resource', 'Condition')):
+        return False
+    if canonical(statement.get('Principal')) != canonical(other.get('Principal')):
+        principals = principal_values(statement.get('Principal'))
+        other_principals = principal_values(other.get('Principal'))
+        if principals is None or other_principals is None or not (other_principals <= principals or
+                                                                   '*' in principals):
+            return False
+    if ('Resource' in statement) != ('Resource' in other) or \
+            not set(as_list(other.get('Resource'))) <= set(as_list(statement.get('Resource'))):
+        return False
+    if 'Condition' in statement and canonical(statement['Condition']) != canonical(other.get('Condition')):
+        values = condition_values(statement['Condition'])
+        other_values = condition_values(other.get('Condition'))
+        if values is None or other_values is None or values[:2] != other_values[:2] or \
+                not other_values[2] <= values[2]:
+            return False
+    return True
+
+
+def covered(statement, statements):
+    """
+    :param statements: dict of canonical statement without Sid, Principal, Resource and Condition to the list of
+                       statements, as made by index_statements
+    """
+    return any(covers(candidate, statement)
+               for candidate in statements.get(canonical(without(statement, 'Sid', 'Principal', 'Resource',
+                                                                 'Condition')), []))
+
+
+def index_statements(statements):
+    index = {}
+    for statement in statements:
+        index.setdefault(canonical(without(statement, 'Sid', 'Principal', 'Resource', 'Condition')),
+                         []).append(statement)
+    return index
+
+
+def merge_policies(existing, policies, max_size=MAX_POLICY_SIZE):
+    """
+    Merge rendered policies into an existing bucket policy.  Existing statements are kept as they are, rendered
+    statements an existing statement already covers are dropped, and the others are combined across accounts,
+    resources and prefixes where they only differ by those.  Sids are made unique.  Merging the result again
+    with the same policies returns it unchanged.
+    :param existing: the bucket policy, None for an empty one
+    :param policies: list of rendered policies
+    :return: the merged policy
+    """
+    existing = load_policy(existing) if existing is not None else OrderedDict()
+    merged = OrderedDict([('Version', existing.get('Version', DEFAULT_POLICY_VERSION))])
+    if 'Id' in existing:
+        merged['Id'] = existing['Id']
+
+    kept = as_list(existing.get('Statement'))
+    index = index_statements(kept)
+    seen = set()
+    added = []
+    for policy in policies:
+        for statement in as_list(load_policy(policy).get('Statement')):
+            key = canonical(without(statement, 'Sid'))
+            if key not in seen and not covered(statement, index):
+                seen.add(key)
+                added.append(statement)
+    for field in ('Principal', 'Resource', 'Condition'):
+        added = combine_statements(added, field)
+    added = [statement for statement in added if not covered(statement, index)]
+
+    sids = set(statement.get('Sid') for statement in kept)
+    for statement in added:
+        sid = statement.get('Sid')
+        if sid is None:
+            continue
+        num = 1
+        while statement['Sid'] in sids:
+            num += 1
+            statement['Sid'] = '{}{}'.format(sid, num)
+        sids.add(statement['Sid'])
+
+    merged['Statement'] = kept + added
+    size = len(json.dumps(merged, separators=(',', ':')))
+    if size > max_size:
+        raise Exception("Merged policy is {} bytes, over the {} bytes limit of a bucket policy".format(size,
+                                                                                                      max_size))
+    return merged
@@ -0,0 +1,92 @@
+"""
+On-disk cache of the listings and lookups of provision.py checks.
+
+A check run again after an edit of the bucket policy goes straight to the files the last check chose, and
+reuses the folder listings that have not expired instead of walking the path again.  Each bucket path and
+credentials have their own JSON file, whose entries expire after a TTL or can be cleared explicitly.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_DIR = '.provision_cache'
+
+# Seconds a cached entry is used for
+DEFAULT_CACHE_TTL = 3600
+
+
+class ListingCache(object):
+    """
+    Entries by section and name, i.e. ('listing', folder), for one bucket path and credentials.  The access key
+    id is only kept hashed in the file name.
+    """
+
+    def __init__(self, cache_dir, identity, bucket_name, bucket_prefix, ttl=DEFAULT_CACHE_TTL):
+        key = hashlib.sha1('\n'.join((identity or '', bucket_name, bucket_prefix))).hexdigest()
+        self.path = os.path.join(cache_dir, '{}.json'.format(key))
+        self.bucket_name = bucket_name
+        self.bucket_prefix = bucket_prefix
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as fh:
+                self.entries = json.load(fh)['entries']
+        except (ValueError, KeyError), e:
+            print "Ignoring unreadable cache {} because {}".format(self.path, e)
+            self.entries = {}
+
+    def get(self, section, name):
+        """
+        :return: the value, None if there is none or it expired
+        """
+        with self.lock:
+            entry = self.entries.get(section, {}).get(name)
+        if entry is None or time.time() - entry['cached_at'] >= self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, section, name, value):
+        """
+        Store a value.  An entry put again unchanged before it expires keeps its age, so entries reused by every
+        check still expire.
+        """
+        with self.lock:
+            entries = self.entries.setdefault(section, {})
+            entry = entries.get(name)
+            if entry is not None and entry['value'] == value and time.time() - entry['cached_at'] < self.ttl:
+                return
+            entries[name] = {'cached_at': time.time(), 'value': value}
+
+    def invalidate(self, section=None, name=None):
+        """
+        Drop an entry, every entry of a section, or everything
+        """
+        with self.lock:
+            if section is None:
+                self.entries = {}
+            elif name is None:
+                self.entries.pop(section, None)
+            else:
+                self.entries.get(section, {}).pop(name, None)
+
+    def save(self):
+        """
+        Write the cache, replacing the file at once so a check interrupted meanwhile does not leave half of it
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            content = {'bucket': self.bucket_name, 'prefix': self.bucket_prefix, 'entries': self.entries}
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump(content, fh)
+        os.rename(tmp_path, self.path)
@@ -2,71 +2,81 @@
 
 import argparse
 from calendar import timegm
+import csv
 from datetime import datetime
+import gzip
+import heapq
+from itertools import izip
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import sys
-import traceback
+import threading
+import time
+import urllib
 
-import pytz
-from boto import ec2, iam, s3
 from boto.exception import S3ResponseError
 from boto.s3.key import Key
 from boto.s3.prefix import Prefix
 from datetime import timedelta
 import dateutil.parser
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aws_clients import DEFAULT_RETRIES, DEFAULT_TIMEOUT, get_clients, print_exception
+from listing_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL, ListingCache
+import read_benchmark
+from read_benchmark import print_read_benchmark, run_read_benchmark
+from bucket_policy import ALLOW, PolicyTemplate, bucket_arn, evaluate, load_policy, merge_policies, object_arn
 
-def utctimestamp():
-    return timegm(datetime.utcnow().timetuple())
+# Template of the bucket policy made by create, and the policy it is rendered to
+POLICY_TEMPLATE_FILE = 's3_bucket_list.policy.template'
+POLICY_FILE = 's3_bucket_list.policy'
 
+# Files kept per folder as download candidates, and folders listed in parallel, while checking read access
+DEFAULT_MAX_FILES = 100
+DEFAULT_LIST_WORKERS = 4
 
-def print_list(llist):
-    return '[%s]' % '\n'.join(map(str, llist))
+# Bytes read from a candidate file to verify read access, and candidates probed in parallel
+VERIFY_BYTES = 1024
+DEFAULT_PROBE_WORKERS = 4
 
+# Storage classes whose objects can not be read until they are restored
+ARCHIVED_STORAGE_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
 
-def print_exception(e):
-    (typeE, value, tracebackPrev) = sys.exc_info()
-    print(str(typeE) + ':' + str(value))
-    print(" PREV=\n" + print_list(traceback.extract_tb(tracebackPrev)))
+# Budget of a sampled listing: requests made, keys listed and seconds spent, and the age of the files it looks for
+DEFAULT_MAX_PAGES = 20
+DEFAULT_MAX_KEYS = 20000
+DEFAULT_MAX_SECONDS = 60
+DEFAULT_RECENT_DAYS = 7
+LIST_PAGE_SIZE = 1000
 
+# Folder names of a date partition, i.e. dt=2017-05-31 or 20170531, with the strftime format of the date
+DATE_PARTITIONS = ((re.compile(r'^([A-Za-z_]+=)?\d{4}-\d{2}-\d{2}$'), '%Y-%m-%d'),
+                   (re.compile(r'^([A-Za-z_]+=)?\d{8}$'), '%Y%m%d'))
 
-def get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name):
-    """
-    :param aws_access_key: if None, we will use the .aws/config on this system
-    :param aws_secret_key: if None we wil use the .aws/config on this system
-    :param region_name: This is a region string i.e. us-east-1
-    :return: an ec2 connection object
-    :rtype: EC2Connection
-    """
-    conn = ec2.connect_to_region(aws_access_key_id=aws_access_key_id,
-                                 aws_secret_access_key=aws_secret_access_key,
-                                 region_name=region_name)
-    if conn is None:
-        raise Exception("Could not get ec2 connection to region {}, invalid credentials.".format(region_name))
+# Folder names of a date partitioned by year, month and day folders, i.e. 2017/05/31 or year=2017/month=05/day=31
+DATE_LEVELS = ((re.compile(r'^([A-Za-z_]+=)?\d{4}$'), '%Y'),
+               (re.compile(r'^([A-Za-z_]+=)?\d{2}$'), '%m'),
+               (re.compile(r'^([A-Za-z_]+=)?\d{2}$'), '%d'))
 
-    return conn
+# Columns of an S3 Inventory CSV file read without the manifest.json giving its fileSchema
+DEFAULT_INVENTORY_SCHEMA = 'Bucket, Key, Size, LastModifiedDate, StorageClass'
 
+# Files of the checked path read by the benchmark action
+DEFAULT_BENCHMARK_OBJECTS = 20
 
-def get_iam_connection(aws_access_key_id, aws_secret_access_key, region_name):
-    conn = iam.connect_to_region(aws_access_key_id=aws_access_key_id,
-                                 aws_secret_access_key=aws_secret_access_key,
-                                 region_name=region_name)
-    if conn is None:
-        raise Exception("Could not get iam connection to region {}, invalid credentials.".format(region_name))
+# Manifest entries processed in parallel in batch mode, and the columns of a manifest
+DEFAULT_BATCH_WORKERS = 8
+MANIFEST_FIELDS = ('customer', 'account', 'bucket', 'region')
 
-    return conn
+# Buckets and their location, looked up once per s3 connection and bucket name
+bucket_locations = {}
+bucket_locations_lock = threading.Lock()
 
 
-def get_s3_connection(aws_access_key_id, aws_secret_access_key, region_name):
-    conn = s3.connect_to_region(aws_access_key_id=aws_access_key_id,
-                                aws_secret_access_key=aws_secret_access_key,
-                                region_name=region_name)
-    if conn is None:
-        raise Exception("Could not get s3 connection to region {}, invalid credentials.".format(region_name))
-
-    return conn
+def utctimestamp():
+    return timegm(datetime.utcnow().timetuple())
 
 
 def check_account_setup(iam_conn, interana_user):
@@ -87,7 +97,11 @@ def check_account_setup(iam_conn, interana_user):
     return user, all_policies
 
 
-def create_cluster_json(ec2_conn, s3_bucket, user, all_policies, validated, clustername, reasons):
+def create_cluster_json(ec2_conn, s3_bucket, user, all_policies, validated, clustername, reasons, output_dir='.'):
+    """
+    Write interana_cluster.json to output_dir
+    :return: the interana_cluster dict
+    """
     interana_cluster = dict()
 
     interana_cluster['aws_access_key'] = ec2_conn.access_key
@@ -103,62 +117,215 @@ def create_cluster_json(ec2_conn, s3_bucket, user, all_policies, validated, clus
     interana_cluster['clustername'] = clustername
 
     if validated:
-        with open('s3_bucket_list.policy') as fh:
+        with open(os.path.join(output_dir, POLICY_FILE)) as fh:
             interana_cluster['s3_bucket_policy'] = json.load(fh)
     else:
         interana_cluster['s3_bucket_policy'] = dict()
         print("Warning : Failed validation, please check log above for warnings")
 
     print "****interana_cluster.json contents.  Please email to support@interana.com***"
-    with open('interana_cluster.json', 'w+') as fp_ic:
+    with open(os.path.join(output_dir, 'interana_cluster.json'), 'w+') as fp_ic:
         json.dump(interana_cluster, fp_ic, indent=4)
 
     print json.dumps(interana_cluster, indent=True)
+    return interana_cluster
 
 
-def provision_create(ec2_conn, iam_conn, interana_account_id, s3_bucket_path, interana_user):
+def provision_create(iam_conn, interana_account_id, s3_bucket_path, interana_user, output_dir='.',
+                     template=None):
     """
     Make the s3 bucket policy and let user configure with it
-    If we specify the root bucket, we have t remove the "Condition" as it does allow
+    If we specify the root bucket, the "Condition" is left out as it does not allow
     wildcard at root.
+    :param output_dir: directory s3_bucket_list.policy is written to
+    :param template: the PolicyTemplate, default the one in s3_bucket_list.policy.template
+    :return: the policy
     """
     try:
         user, all_policies = check_account_setup(iam_conn, interana_user)
     except Exception, e:
         print "Warning could not verify user interana_user {} because {}".format(interana_user, e)
 
-    infile = 's3_bucket_list.policy.template'
-    outfile = 's3_bucket_list.policy'
+    template = template or PolicyTemplate.from_file(POLICY_TEMPLATE_FILE)
+    outfile = os.path.join(output_dir, POLICY_FILE)
 
     bucket_name, bucket_prefix = get_bucket_name_prefix(s3_bucket_path)
+    policy = template.render(interana_account_id, bucket_name, bucket_prefix)
+    if len(bucket_prefix) < 1:
+        print "Download file to check GetObject Access {}".format(outfile)
 
-    all_lines = ''
-    with open(infile, 'r') as tmp_fh, open(outfile, 'w') as out_fh:
-        for line in tmp_fh:
-            re_proxy = re.compile('<INTERANA_ACCOUNT_ID>')
-            translate = re_proxy.sub(interana_account_id, line)
+    with open(outfile, 'w') as out_fh:
+        json.dump(policy, out_fh, indent=4)
 
-            re_proxy = re.compile('<BUCKET_NAME>')
-            translate = re_proxy.sub(bucket_name, translate)
+    print "****policy file {}***".format(outfile)
 
-            re_proxy = re.compile('<BUCKET_PREFIX>')
-            translate = re_proxy.sub(bucket_prefix, translate)
+    print json.dumps(policy, indent=True)
+    return policy
 
-            out_fh.write(translate)
-            all_lines += translate.strip()
 
-    if len(bucket_prefix) < 1:
-        with open(outfile, 'r') as in_fh:
-            policy = json.load(in_fh)
-            del policy['Statement'][1]['Condition']
-            all_lines = json.dumps(policy)
-            print "Download file to check GetObject Access {}".format(outfile)
-            with open(outfile, 'w') as out_fh:
-                json.dump(policy, out_fh, indent=4)
+def provision_merge(template, entries, existing_policy, output_dir='.'):
+    """
+    Render the policy of every (interana account id, s3 bucket path) in one pass, and merge those of each bucket
+    into the existing bucket policy.  Writes <bucket>.merged.policy, ready to apply as the policy of the bucket.
+    :param existing_policy: the current policy of the bucket, None if it has none
+    :return: dict of bucket name to the merged policy file
+    """
+    buckets = {}
+    for interana_account_id, s3_bucket_path in entries:
+        bucket_name, bucket_prefix = get_bucket_name_prefix(s3_bucket_path)
+        buckets.setdefault(bucket_name, []).append((interana_account_id, bucket_name, bucket_prefix))
+
+    merged_files = {}
+    for bucket_name, bucket_entries in sorted(buckets.iteritems()):
+        merged = merge_policies(existing_policy, template.render_all(bucket_entries))
+        outfile = os.path.join(output_dir, '{}.merged.policy'.format(bucket_name))
+        with open(outfile, 'w') as out_fh:
+            json.dump(merged, out_fh, indent=4)
+        print "****merged policy file {} with {} statements for {} paths***".format(
+            outfile, len(merged['Statement']), len(bucket_entries))
+        merged_files[bucket_name] = outfile
+    return merged_files
+
+
+def get_bucket_location(s3_conn, bucket_name, cache=None):
+    """
+    Look up the bucket and its location, once per connection.  Later calls return the cached lookup.  The
+    location is always asked to S3, as being allowed to is part of what a check verifies.
+    :param cache: ListingCache the location is kept in between checks
+    :return: the bucket, its location, and the exception raised looking up the location or None.  When the
+             lookup fails the location is the one found by the last check, None if unknown.
+    """
+    with bucket_locations_lock:
+        cached = bucket_locations.get((s3_conn, bucket_name))
+    if cached is not None:
+        return cached
 
-    print "****policy file {}***".format(outfile)
+    bucket = s3_conn.get_bucket(bucket_name, validate=False)
+    try:
+        cached = (bucket, bucket.get_location(), None)
+        if cache is not None:
+            cache.put('location', bucket_name, cached[1])
+    except Exception, e:
+        location = cache.get('location', bucket_name) if cache is not None else None
+        if location is not None:
+            print "Using the location of bucket {} found by the last check".format(bucket_name)
+        cached = (bucket, location, e)
+    with bucket_locations_lock:
+        return bucket_locations.setdefault((s3_conn, bucket_name), cached)
+
+
+def ancestor_prefixes(bucket_prefix):
+    """
+    :return: the prefixes above bucket_prefix up to the root of the bucket, nearest first
+    """
+    prefixes = []
+    while len(bucket_prefix) > 0:
+        if bucket_prefix[-1] == '/':
+            bucket_prefix = bucket_prefix[0:-1]
+        bucket_prefix = '/'.join(bucket_prefix.split('/')[0:-1])
+        prefixes.append(bucket_prefix)
+    return prefixes
+
+
+def list_allowed(bucket, prefix, delim):
+    """
+    Make a single list request under the prefix, the first page is enough to tell if listing is allowed
+    :return: True if the prefix could be listed, False if access was denied
+    """
+    try:
+        bucket.get_all_keys(prefix=prefix, delimiter=delim, max_keys=1)
+    except S3ResponseError:
+        return False
+    return True
+
+
+def predict_access(policy, interana_account_id, s3_bucket_path):
+    """
+    Evaluate the bucket policy offline for the accesses provision_check probes: location and list of the
+    prefix, read of a file under it allowed, write under it and list of every prefix above it denied
+    :return: list of warnings, empty if the policy gives the expected access
+    """
+    bucket_name, bucket_prefix = get_bucket_name_prefix(s3_bucket_path)
+    bucket_prefix = bucket_prefix.replace('*', '')
+    testfile = os.path.join(bucket_prefix, 'dummy.txt')
+
+    checks = [('s3:GetBucketLocation', bucket_arn(bucket_name), {}, True, 'bucket location'),
+              ('s3:ListBucket', bucket_arn(bucket_name), {'s3:prefix': bucket_prefix, 's3:delimiter': '/'}, True,
+               "list of prefix '{}'".format(bucket_prefix)),
+              ('s3:GetObject', object_arn(bucket_name, testfile), {}, True, 'read of {}'.format(testfile)),
+              ('s3:PutObject', object_arn(bucket_name, testfile), {}, False, 'write of {}'.format(testfile))]
+    for prefix in ancestor_prefixes(bucket_prefix):
+        checks.append(('s3:ListBucket', bucket_arn(bucket_name), {'s3:prefix': prefix, 's3:delimiter': '/'}, False,
+                       "list of prefix '{}'".format(prefix)))
+
+    warnings = []
+    for action, resource, context, expected, description in checks:
+        decision = evaluate(policy, interana_account_id, action, resource, context)
+        if (decision == ALLOW) != expected:
+            warnings.append("Warning: Policy evaluation predicts {} is {}, expected {}".format(
+                description, decision, 'allow' if expected else 'deny'))
+    return warnings
+
+
+def provision_evaluate(interana_account_id, s3_bucket_path, policy):
+    """
+    Check the bucket policy gives the interana account the expected access, without any request to AWS
+    :return: list of warnings, empty if the policy gives the expected access
+    """
+    print "Evaluating bucket policy for account {} on {}".format(interana_account_id, s3_bucket_path)
+    warnings = predict_access(policy, interana_account_id, s3_bucket_path)
+    for warning in warnings:
+        print warning
+    if not warnings:
+        print "Policy evaluation predicts the expected access on {}".format(s3_bucket_path)
+    return warnings
+
+
+def provision_benchmark(s3_conn, s3_bucket_path, output_dir='.', objects=DEFAULT_BENCHMARK_OBJECTS,
+                        concurrency=read_benchmark.DEFAULT_CONCURRENCY, part_size=read_benchmark.DEFAULT_PART_SIZE,
+                        max_bytes=read_benchmark.DEFAULT_MAX_BYTES, max_seconds=read_benchmark.DEFAULT_MAX_SECONDS,
+                        budget=None, inventory=None, recent_days=DEFAULT_RECENT_DAYS):
+    """
+    Measure the read throughput of the path a check verified, with parallel ranged GETs of its newest files,
+    and add the results to its interana_cluster.json as s3_read_benchmark
+    :param objects: number of files read
+    :param budget: ListingBudget of the listing the files are chosen from, default the ListingBudget defaults
+    :param inventory: a local S3 Inventory report the files are chosen from instead
+    :return: the results
+    """
+    cluster_file = os.path.join(output_dir, 'interana_cluster.json')
+    if not os.path.isfile(cluster_file):
+        raise Exception("No {}, run check first".format(cluster_file))
+    with open(cluster_file) as fh:
+        interana_cluster = json.load(fh)
+    if interana_cluster.get('s3_bucket') != s3_bucket_path:
+        raise Exception("{} is of {}, run check of {} first".format(cluster_file, interana_cluster.get('s3_bucket'),
+                                                                    s3_bucket_path))
+    if not interana_cluster.get('validated'):
+        print "Warning: the check of {} did not pass, reads may fail".format(s3_bucket_path)
+
+    bucket_name, bucket_prefix = get_bucket_name_prefix(s3_bucket_path)
+    bucket_prefix = bucket_prefix.replace('*', '')
+    bucket = s3_conn.get_bucket(bucket_name, validate=False)
+    if inventory is not None:
+        candidates, _ = inventory_candidates(bucket, inventory, bucket_prefix, objects, 'last_modified')
+    else:
+        candidates, _ = sample_prefix(bucket, bucket_prefix, budget or ListingBudget(), objects, 'last_modified',
+                                      recent_days)
+    candidates = [key for key in candidates if key.size > 0]
+    if len(candidates) == 0:
+        raise Exception("No files to read under {}".format(s3_bucket_path))
 
-    print json.dumps(json.loads(all_lines), indent=True)
+    print "Benchmarking reads of {} files under {}".format(len(candidates), s3_bucket_path)
+    result = run_read_benchmark(bucket, candidates, concurrency, part_size, max_bytes, max_seconds)
+    result['created'] = datetime.utcnow().isoformat() + 'Z'
+    print_read_benchmark(result)
+
+    interana_cluster['s3_read_benchmark'] = result
+    with open(cluster_file, 'w') as fh:
+        json.dump(interana_cluster, fh, indent=4)
+    print "****benchmark results added to {}***".format(cluster_file)
+    return result
 
 
 def get_bucket_name_prefix(s3_bucket_path):
@@ -174,61 +341,445 @@ def get_bucket_name_prefix(s3_bucket_path):
     return bucket_name, bucket_prefix
 
 
-class VerificationComplete(Exception):
-    pass
-
-
-def download_callback_verifier(num_bytes, total_bytes):
+def verify_read(key):
     """
-    Amazon will call this after each chunk.  Once we've verified that a chunk has been downloaded, just
-    raise an exception so we don't finish the download
+    Read the first VERIFY_BYTES of the file into memory, nothing is written to disk.  An empty file, i.e. a
+    _SUCCESS marker, is read with a plain GET, S3 refuses any range of it with 416 InvalidRange.
+    :return: number of bytes read
     """
-    if num_bytes > 0:
-        msg = "Verified Read access, with partial download {}/{} MiB".format(num_bytes / 1.e6, total_bytes / 1.e6)
-        raise VerificationComplete(msg)
+    if key.size == 0:
+        return len(key.get_contents_as_string())
+    return len(key.get_contents_as_string(headers={'Range': 'bytes=0-{}'.format(VERIFY_BYTES - 1)}))
 
 
-def download_files(file_list, max_days=7):
-    tzinfo = pytz.timezone('UTC')
-    cut_off = datetime.now().replace(tzinfo=None) - timedelta(days=7)
-    downloaded = 0
-    saved_e = None
+def download_files(file_list, max_days=7, probe_workers=DEFAULT_PROBE_WORKERS):
+    """
+    Verify read access with a small ranged read of the candidate files, probe_workers at a time, returning as
+    soon as one succeeds.  Files in an archived storage class are skipped without trying them.  Failures of
+    files older than max_days are ignored, they may have been archived since.
+    :return: 1 if a file could be read, else 0
+    """
+    cut_off = datetime.utcnow() - timedelta(days=max_days)
+    candidates = []
+    archived = 0
     for filel in file_list:
         if isinstance(filel, Prefix):
             continue
         local_name = os.path.basename(filel.key)
         if local_name == '' or local_name == '.':
             continue
-        last_modified = dateutil.parser.parse(filel.last_modified)
-        last_modified = last_modified.replace(tzinfo=None)
+        if filel.storage_class in ARCHIVED_STORAGE_CLASSES:
+            archived += 1
+            continue
+        candidates.append(filel)
+    if archived > 0:
+        print "Skipped {} archived files".format(archived)
+
+    stop = threading.Event()
+
+    def probe(filel):
+        if stop.is_set():
+            return filel, None, None
         try:
-            filel.get_contents_to_filename(local_name, cb=download_callback_verifier, num_cb=1000)
-            downloaded += 1
-            print "Downloaded Verified {}".format(filel.key)
-            break
-        except VerificationComplete, e:
-            print e.message
-            downloaded += 1
-            print "Downloaded Verified {}".format(filel.key)
-            break
+            return filel, verify_read(filel), None
         except Exception, e:
+            return filel, None, e
+
+    downloaded = 0
+    saved_e = None
+    recent_failure = None
+    pool = ThreadPool(max(1, probe_workers))
+    try:
+        for filel, num_bytes, e in pool.imap_unordered(probe, candidates):
+            if num_bytes is not None:
+                print "Verified Read access, with a ranged read of {} bytes".format(num_bytes)
+                downloaded += 1
+                print "Downloaded Verified {}".format(filel.key)
+                break
+            if e is None:
+                continue
+            last_modified = dateutil.parser.parse(filel.last_modified).replace(tzinfo=None)
             if last_modified < cut_off:
                 saved_e = e
-                continue
-            print "File could not be downloaded {} because {}".format(filel.key, e)
-            return 0
-    if downloaded == 0:
+            elif recent_failure is None:
+                recent_failure = (filel, e)
+    finally:
+        stop.set()
+        pool.close()
+        pool.join()
+
+    if downloaded == 0 and recent_failure is not None:
+        print "File could not be downloaded {} because {}".format(recent_failure[0].key, recent_failure[1])
+    elif downloaded == 0:
         print "No files could be downloaded, moving to next folder. {}".format(saved_e or '')
 
     return downloaded
 
 
-def provision_check(ec2_conn, iam_conn, s3_conn, s3_bucket_path, clustername, force, interana_user):
+def keep_best(heap, entry, max_files):
+    """
+    Keep the max_files largest (sort value, key name, file) entries in the heap
+    """
+    if len(heap) < max_files:
+        heapq.heappush(heap, entry)
+    elif entry[:2] > heap[0][:2]:
+        heapq.heapreplace(heap, entry)
+
+
+def file_record(key):
+    """
+    :return: what the cache keeps of a file
+    """
+    return {'name': key.name, 'etag': key.etag, 'last_modified': key.last_modified,
+            'storage_class': key.storage_class, 'size': key.size}
+
+
+def record_file(bucket, record):
+    """
+    :return: the boto Key of a file kept in the cache
+    """
+    key = Key(bucket, record['name'])
+    key.etag = record['etag']
+    key.last_modified = record['last_modified']
+    key.storage_class = record['storage_class']
+    key.size = record['size']
+    return key
+
+
+def list_folder(bucket, prefix_name, delim, max_files=DEFAULT_MAX_FILES, order='key', stop=None):
+    """
+    Stream the listing of a folder page by page, keeping only the best max_files files in a heap so memory
+    does not grow with the size of the folder
+    :param order: key to keep the files with the largest keys, last_modified to keep the newest files
+    :param stop: threading.Event, the listing is abandoned once it is set
+    :return: list of the files kept, best first, list of the sub folders and number of archived files skipped
+    """
+    heap = []
+    folders = []
+    archived = 0
+    if stop is not None and stop.is_set():
+        return [], [], 0
+    for item in bucket.list(prefix_name, delim):
+        if stop is not None and stop.is_set():
+            break
+        if isinstance(item, Prefix) or item.name[-1] == '/':
+            if item.name != prefix_name:
+                folders.append(item)
+            continue
+        if item.storage_class in ARCHIVED_STORAGE_CLASSES:
+            archived += 1
+            continue
+        keep_best(heap, (item.last_modified if order == 'last_modified' else item.name, item.name, item), max_files)
+    return [entry[2] for entry in sorted(heap, reverse=True)], folders, archived
+
+
+def cached_list_folder(bucket, prefix_name, delim, max_files=DEFAULT_MAX_FILES, order='key', stop=None, cache=None):
+    """
+    list_folder, answered from the cache while its listing of the folder has not expired
+    """
+    listing = cache.get('listing', prefix_name) if cache is not None else None
+    if listing is not None and listing['max_files'] == max_files and listing['order'] == order:
+        return ([record_file(bucket, record) for record in listing['files']],
+                [Prefix(bucket, name) for name in listing['folders']], listing['archived'])
+
+    files, folders, archived = list_folder(bucket, prefix_name, delim, max_files, order, stop)
+    # A listing abandoned half way is not kept
+    if cache is not None and not (stop is not None and stop.is_set()):
+        cache.put('listing', prefix_name, {'max_files': max_files, 'order': order, 'archived': archived,
+                                           'files': [file_record(key) for key in files],
+                                           'folders': [folder.name for folder in folders]})
+    return files, folders, archived
+
+
+def cached_read(bucket, bucket_prefix, delim, cache, probe_workers=DEFAULT_PROBE_WORKERS):
+    """
+    Verify read access with the candidates the last check chose, once a list request confirms the path can
+    still be listed.  The listings of the folders of candidates that changed or could not be read expire, so
+    only those are listed again.
+    :return: number of files downloaded, and the candidates
+    """
+    records = cache.get('candidates', bucket_prefix)
+    if not records:
+        return 0, []
+    if not list_allowed(bucket, bucket_prefix, delim):
+        cache.invalidate()
+        return 0, []
+
+    print "Trying the {} files chosen by the last check".format(len(records))
+    candidates = [record_file(bucket, record) for record in records]
+    downloaded = download_files(candidates, probe_workers=probe_workers)
+    for key, record in zip(candidates, records):
+        if downloaded == 0 or key.etag != record['etag']:
+            cache.invalidate('listing', key.name[:key.name.rfind('/') + 1])
+    if downloaded == 0:
+        cache.invalidate('candidates', bucket_prefix)
+        return 0, []
+    return downloaded, candidates
+
+
+def walk_prefix(bucket, bucket_prefix, delim, list_workers=DEFAULT_LIST_WORKERS, max_files=DEFAULT_MAX_FILES,
+                order='key', probe_workers=DEFAULT_PROBE_WORKERS, cache=None):
+    """
+    Walk the folders under bucket_prefix breadth first until a file can be downloaded.  The folders of a level
+    are listed in parallel, and their candidates tried in order as their listings complete.
+    :param cache: ListingCache of the folder listings
+    :return: number of files downloaded, and the candidates of the folder a file was downloaded from
+    """
+    downloaded = 0
+    result_iter = []
+    next_prefixes = [bucket_prefix]
+    stop = threading.Event()
+    pool = ThreadPool(max(1, list_workers))
+    try:
+        while len(result_iter) == 0 and len(next_prefixes) > 0:
+            prefixes = sorted(next_prefixes, reverse=True)
+            next_prefixes = []
+            listings = pool.imap(lambda prefix_name: cached_list_folder(bucket, prefix_name, delim, max_files, order,
+                                                                        stop, cache),
+                                 prefixes)
+            for prefix_name, (result_iter, folders, archived) in izip(prefixes, listings):
+                print "Viewing folder {}".format(prefix_name)
+                if archived > 0:
+                    print "Skipped {} archived files in folder {}".format(archived, prefix_name)
+                for folder in folders:
+                    print 'Folder={}'.format(folder.name)
+                    next_prefixes.append(folder.name)
+
+                if len(result_iter) > 0:
+                    # Now attempt to download a file.  We get file list from previous
+                    print "Attempting to Download file to ensure GET access is provided"
+                    downloaded = download_files(result_iter, probe_workers=probe_workers)
+                    if downloaded > 0:
+                        break
+                    else:
+                        result_iter = []
+            if downloaded > 0:
+                break
+    finally:
+        stop.set()
+        pool.close()
+        pool.join()
+    return downloaded, result_iter
+
+
+class ListingBudget(object):
+    """
+    Requests, keys and seconds a sampled listing may spend, so a check takes bounded time on any bucket
+    """
+
+    def __init__(self, max_pages=DEFAULT_MAX_PAGES, max_keys=DEFAULT_MAX_KEYS, max_seconds=DEFAULT_MAX_SECONDS):
+        self.max_pages = max_pages
+        self.max_keys = max_keys
+        self.max_seconds = max_seconds
+        self.pages = 0
+        self.keys = 0
+        self.started = time.time()
+
+    def spend(self, keys):
+        self.pages += 1
+        self.keys += keys
+
+    @property
+    def remaining_keys(self):
+        return max(0, self.max_keys - self.keys)
+
+    @property
+    def exhausted(self):
+        return (self.pages >= self.max_pages or self.keys >= self.max_keys or
+                time.time() - self.started >= self.max_seconds)
+
+    def __str__(self):
+        return "{} of {} pages, {} of {} keys, {:.1f} of {}s".format(self.pages, self.max_pages, self.keys,
+                                                                    self.max_keys, time.time() - self.started,
+                                                                    self.max_seconds)
+
+
+def list_page(bucket, prefix, delim, marker, budget):
+    """
+    One list request of the keys after marker, charged to the budget
+    :return: the boto result set, with is_truncated
+    """
+    page = bucket.get_all_keys(prefix=prefix, delimiter=delim, marker=marker,
+                               max_keys=max(1, min(LIST_PAGE_SIZE, budget.remaining_keys)))
+    budget.spend(len(page))
+    return page
+
+
+def date_partition_format(bucket, prefix, budget):
+    """
+    Find whether the folders under prefix are date partitions by following the latest partition down, one
+    level at a time
+    :return: the strftime format of a partition under prefix, i.e. dt=%Y-%m-%d or %Y/%m/%d, None if the folders
+             are not date partitions
+    """
+    path = prefix
+    formats = []
+    for level_pattern, level_format in DATE_LEVELS:
+        if budget.exhausted:
+            break
+        folders = [item.name[len(path):].rstrip('/') for item in list_page(bucket, path, '/', '', budget)
+                   if isinstance(item, Prefix)]
+        if len(formats) == 0:
+            for pattern, date_format in DATE_PARTITIONS:
+                partitions = [folder for folder in folders if pattern.match(folder)]
+                if len(partitions) > 0:
+                    return (pattern.match(max(partitions)).group(1) or '') + date_format
+        levels = [folder for folder in folders if level_pattern.match(folder)]
+        if len(levels) == 0:
+            break
+        latest = max(levels)
+        formats.append((level_pattern.match(latest).group(1) or '') + level_format)
+        path += latest + '/'
+    return '/'.join(formats) or None
+
+
+def sample_prefix(bucket, bucket_prefix, budget, max_files=DEFAULT_MAX_FILES, order='key',
+                  recent_days=DEFAULT_RECENT_DAYS):
+    """
+    List the files under bucket_prefix within the budget, keeping the best max_files as candidates.  Under date
+    partitions the listing starts after the partition of recent_days ago, instead of at the oldest files.
+    :return: list of the files kept, best first, and number of archived files skipped
+    """
+    marker = ''
+    date_format = date_partition_format(bucket, bucket_prefix, budget)
+    if date_format is not None:
+        marker = bucket_prefix + (datetime.utcnow() - timedelta(days=recent_days)).strftime(date_format)
+        print "Date partitions {} found under '{}', listing after {}".format(date_format, bucket_prefix, marker)
+
+    heap = []
+    archived = 0
+    start = marker
+    while not budget.exhausted:
+        page = list_page(bucket, bucket_prefix, '', start, budget)
+        for item in page:
+            if item.name[-1] == '/':
+                continue
+            if item.storage_class in ARCHIVED_STORAGE_CLASSES:
+                archived += 1
+                continue
+            keep_best(heap, (item.last_modified if order == 'last_modified' else item.name, item.name, item),
+                      max_files)
+        if not page.is_truncated or len(page) == 0:
+            if len(heap) == 0 and start != '' and marker != '':
+                print "No files after {}, listing from the start of '{}'".format(marker, bucket_prefix)
+                start = marker = ''
+                continue
+            break
+        start = page[-1].name
+    return [entry[2] for entry in sorted(heap, reverse=True)], archived
+
+
+def read_inventory(path):
+    """
+    Stream the objects of a local copy of an S3 Inventory report
+    :param path: the manifest.json of the report, whose data files are looked up in its directory or a data
+                 directory next to it, or a single CSV data file, gzipped or not, with the
+                 DEFAULT_INVENTORY_SCHEMA columns
+    :return: iterator of dicts of the columns of each object
+    """
+    if path.endswith('.json'):
+        with open(path) as fh:
+            manifest = json.load(fh)
+        if manifest.get('fileFormat', 'CSV') != 'CSV':
+            raise Exception("Inventory {} is {}, only CSV is supported".format(path, manifest['fileFormat']))
+        schema = manifest.get('fileSchema', DEFAULT_INVENTORY_SCHEMA)
+        data_files = []
+        for data_file in manifest['files']:
+            name = os.path.basename(data_file['key'])
+            found = [local for local in (os.path.join(os.path.dirname(path), name),
+                                         os.path.join(os.path.dirname(path), 'data', name))
+                     if os.path.isfile(local)]
+            if len(found) == 0:
+                raise Exception("Inventory data file {} not found next to {}".format(name, path))
+            data_files.append(found[0])
+    else:
+        schema = DEFAULT_INVENTORY_SCHEMA
+        data_files = [path]
+
+    columns = [column.strip() for column in schema.split(',')]
+    for data_file in data_files:
+        with (gzip.open if data_file.endswith('.gz') else open)(data_file, 'rb') as fh:
+            for row in csv.reader(fh):
+                yield dict(izip(columns, row))
+
+
+def inventory_candidates(bucket, inventory, bucket_prefix, max_files=DEFAULT_MAX_FILES, order='key'):
+    """
+    Choose the candidate files under bucket_prefix from an S3 Inventory report, without listing the bucket
+    :return: list of the files kept, best first, and number of archived files skipped
+    """
+    heap = []
+    archived = 0
+    for row in read_inventory(inventory):
+        if row.get('Bucket', bucket.name) != bucket.name:
+            continue
+        if row.get('IsLatest', 'true') != 'true' or row.get('IsDeleteMarker', 'false') != 'false':
+            continue
+        name = urllib.unquote_plus(row['Key'])
+        if not name.startswith(bucket_prefix) or name[-1] == '/':
+            continue
+        if row.get('StorageClass') in ARCHIVED_STORAGE_CLASSES:
+            archived += 1
+            continue
+        last_modified = row.get('LastModifiedDate') or '1970-01-01T00:00:00.000Z'
+        keep_best(heap, (last_modified if order == 'last_modified' else name, name, row), max_files)
+
+    candidates = []
+    for _, name, row in sorted(heap, reverse=True):
+        key = Key(bucket, name)
+        key.last_modified = row.get('LastModifiedDate') or '1970-01-01T00:00:00.000Z'
+        key.storage_class = row.get('StorageClass') or 'STANDARD'
+        key.size = int(row.get('Size') or 0)
+        candidates.append(key)
+    return candidates, archived
+
+
+def sample_read(bucket, bucket_prefix, budget=None, inventory=None, max_files=DEFAULT_MAX_FILES, order='key',
+                probe_workers=DEFAULT_PROBE_WORKERS, recent_days=DEFAULT_RECENT_DAYS):
+    """
+    Try to download one of the candidates of a sampled listing, or of an S3 Inventory report with no listing
+    at all, instead of walking every folder
+    :return: number of files downloaded, and the candidates
+    """
+    if inventory is not None:
+        print "Reading the files under '{}' from inventory {}".format(bucket_prefix, inventory)
+        candidates, archived = inventory_candidates(bucket, inventory, bucket_prefix, max_files, order)
+    else:
+        candidates, archived = sample_prefix(bucket, bucket_prefix, budget, max_files, order, recent_days)
+        print "Sampled listing used {}".format(budget)
+    if archived > 0:
+        print "Skipped {} archived files".format(archived)
+    if len(candidates) == 0:
+        return 0, []
+
+    print "Attempting to Download file to ensure GET access is provided"
+    return download_files(candidates, recent_days, probe_workers), candidates
+
+
+def provision_check(ec2_conn, iam_conn, s3_conn, s3_bucket_path, clustername, force, interana_user,
+                    list_workers=DEFAULT_LIST_WORKERS, max_files=DEFAULT_MAX_FILES, order='key',
+                    probe_workers=DEFAULT_PROBE_WORKERS, output_dir='.', interana_account_id=None, policy=None,
+                    budget=None, inventory=None, recent_days=DEFAULT_RECENT_DAYS, cache_dir=None,
+                    cache_ttl=DEFAULT_CACHE_TTL, clear_cache=False):
     """
     Check the s3 bucket share has list properties, but not write
     Use "dummy_<date>.txt at root of bucket
     Create interana_cluster.json and allow user to send that off.
     @TODO should recursively check up the tree to be more sure.
+    :param list_workers: number of folders listed in parallel
+    :param max_files: number of files per folder kept as download candidates
+    :param order: key or last_modified, which files of a folder are tried first
+    :param probe_workers: number of files read in parallel to verify read access
+    :param output_dir: directory interana_cluster.json is written to, and s3_bucket_list.policy is read from
+    :param interana_account_id: with policy, the account the bucket policy is evaluated for before probing
+    :param policy: the bucket policy, evaluated offline first so most mistakes show up before any probe
+    :param budget: ListingBudget, to sample the files under the path within it instead of walking its folders
+    :param inventory: a local S3 Inventory report the files are chosen from, without listing the bucket
+    :param recent_days: age of the files a sampled listing looks for
+    :param cache_dir: directory of the ListingCache of the bucket path, None to look everything up again
+    :param cache_ttl: seconds the cached location, listings and candidates are used for
+    :param clear_cache: drop what is cached for the bucket path first
+    :return: the interana_cluster dict
     """
     validated = True
     warning_reasons = []
@@ -251,101 +802,89 @@ def provision_check(ec2_conn, iam_conn, s3_conn, s3_bucket_path, clustername, fo
     delim = "/"
 
     if force:
-        create_cluster_json(ec2_conn, s3_bucket_path, user, all_policies, False, clustername, [])
+        create_cluster_json(ec2_conn, s3_bucket_path, user, all_policies, False, clustername, [], output_dir)
+
+    if policy is not None and interana_account_id is not None:
+        provision_evaluate(interana_account_id, s3_bucket_path, policy)
+        print "Confirming with requests to the bucket"
+
+    cache = None
+    if cache_dir is not None:
+        cache = ListingCache(cache_dir, getattr(s3_conn, 'aws_access_key_id', None), bucket_name, bucket_prefix,
+                             cache_ttl)
+        if clear_cache:
+            cache.invalidate()
+
+    bucket, location, location_error = get_bucket_location(s3_conn, bucket_name, cache)
+    print "Checking Region..."
+    if location_error is not None:
+        validated = False
+        reasons = "Warning, location of bucket is not accessible, customer to ensure location is {}".format(
+            ec2_conn.region.name)
+        print reasons
+        warning_reasons.append(reasons)
+    if location is not None:
+        if location == '':
+            regions_allowed = ['us-east-1']
+        else:
+            regions_allowed = [location]
 
-    iter = 0
-    bucket = None
-    downloaded = 0
-    while bucket_prefix is not None:
+        if ec2_conn.region.name not in regions_allowed:
+            raise Exception(
+                "EC2 Region {} not in S3 region(s) {}. Excess charges will occur".format(ec2_conn.region.name,
+                                                                                         regions_allowed))
 
-        access = 'read allow' if iter == 0 else 'read deny'
-        try:
-            bucket = s3_conn.get_bucket(bucket_name, validate=False)
+    # Every prefix above the allowed one must not be readable, they are probed while the allowed one is walked
+    ancestors = ancestor_prefixes(bucket_prefix)
+    pool = ThreadPool(max(1, len(ancestors)))
+    try:
+        for prefix in ancestors:
+            print "Checking Bucket for read deny only access at prefix '{}'".format(prefix)
+        ancestors_allowed = pool.map_async(lambda prefix: list_allowed(bucket, prefix, delim), ancestors)
 
-            location = ''
-            print "Checking Region..."
-            try:
-                location = bucket.get_location()
-            except Exception, e:
-                validated = False
-                reasons = "Warning, location of bucket is not accessible, customer to ensure location is {}".format(
-                    ec2_conn.region.name)
-                print reasons
-                warning_reasons.append(reasons)
+        # Try to download the latest file in bucket, sometimes some files are in glacier
+        try:
+            downloaded, result_iter = 0, []
+            if cache is not None:
+                downloaded, result_iter = cached_read(bucket, bucket_prefix, delim, cache, probe_workers)
+            if downloaded > 0:
+                print "Verified read access at prefix '{}' with the files of the last check".format(bucket_prefix)
+            elif budget is not None or inventory is not None:
+                print "Checking Bucket for read allow only access at prefix '{}'".format(bucket_prefix)
+                downloaded, result_iter = sample_read(bucket, bucket_prefix, budget, inventory, max_files, order,
+                                                      probe_workers, recent_days)
             else:
-                if location == '':
-                    regions_allowed = ['us-east-1']
-                else:
-                    regions_allowed = [location]
-
-                if ec2_conn.region.name not in regions_allowed:
-                    raise Exception(
-                        "EC2 Region {} not in S3 region(s) {}. Excess charges will occur".format(ec2_conn.region.name,
-                                                                                                 regions_allowed))
-
-            # Try to download the latest file in bucket, sometimes some files are in glacier
-            print "Checking Bucket for {} only access at prefix {}.  " \
-                  "This may take a while for large buckets".format(access, "'{}'".format(bucket_prefix))
-
-            result_iter = []
-            max_files = 100
-            next_prefixes = [Prefix(bucket, bucket_prefix)]
-            while len(result_iter) == 0 and len(next_prefixes) > 0:
-                prefixes = next_prefixes
-                next_prefixes = []
-                for prefix in sorted(prefixes, reverse=True):
-                    print "Viewing folder {}".format(prefix.name)
-                    for num, item in enumerate(sorted(bucket.list(prefix.name, delim), reverse=True)):
-                        if isinstance(item, Prefix) or item.name[-1] == '/':
-                            print 'Folder={}'.format(item.name)
-                            next_prefixes.append(item)
-                            continue
-                        if num >= max_files:
-                            index = num % max_files
-                            result_iter[index] = item
-                        else:
-                            result_iter.append(item)
-
-                    if len(result_iter) > 0:
-                        # Now attempt to download a file.  We get file list from previous
-                        print "Attempting to Download file to ensure GET access is provided"
-                        downloaded = download_files(result_iter)
-                        if downloaded > 0:
-                            break
-                        else:
-                            result_iter = []
-                if downloaded > 0:
-                    break
-            prefixes = [prefix.name for prefix in result_iter]
-            if iter == 0 and len(prefixes) < 1:
-                validated = False
-                reasons = """"Warning: Did not find any folders or files in prefix {} using delim {}.  "
-                          Please upload at least 1 file""".format(bucket_prefix, delim)
-                print(reasons)
-                warning_reasons.append(reasons)
-
-                break
+                print "Checking Bucket for read allow only access at prefix {}.  " \
+                      "This may take a while for large buckets, see --sample".format("'{}'".format(bucket_prefix))
+                downloaded, result_iter = walk_prefix(bucket, bucket_prefix, delim, list_workers, max_files, order,
+                                                      probe_workers, cache)
+            if cache is not None and downloaded > 0:
+                cache.put('candidates', bucket_prefix, [file_record(key) for key in result_iter])
         except S3ResponseError, e:
-            if iter == 0:
-                print_exception(e)
-                raise Exception("Failed to verify access on bucket {} path {}.\n".format(bucket_name, bucket_prefix))
-
-        else:
-            if iter > 0:
+            print_exception(e)
+            raise Exception("Failed to verify access on bucket {} path {}.\n".format(bucket_name, bucket_prefix))
+        ancestors_allowed = ancestors_allowed.get()
+    finally:
+        pool.close()
+        pool.join()
+        if cache is not None:
+            cache.save()
+
+    prefixes = [prefix.name for prefix in result_iter]
+    if len(prefixes) < 1:
+        validated = False
+        reasons = """"Warning: Did not find any folders or files in prefix {} using delim {}.  "
+                  Please upload at least 1 file""".format(bucket_prefix, delim)
+        print(reasons)
+        warning_reasons.append(reasons)
+    else:
+        for prefix, allowed in zip(ancestors, ancestors_allowed):
+            if allowed:
                 validated = False
-                reasons = "Warning: Unexpected Read Access is granted on path on bucket prefix {}.\n".format(
-                    bucket_prefix)
+                reasons = "Warning: Unexpected Read Access is granted on path on bucket prefix {}.\n".format(prefix)
                 print(reasons)
                 warning_reasons.append(reasons)
 
-        if len(bucket_prefix) > 0 and bucket_prefix[-1] == '/':
-            bucket_prefix = bucket_prefix[0:-1]
-        if len(bucket_prefix) > 0:
-            bucket_prefix = '/'.join(bucket_prefix.split('/')[0:-1])
-            iter += 1
-        else:
-            bucket_prefix = None
-
     if downloaded < 1:
         validated = False
         reasons = "Warning : Could not download any files, check if is this the correct bucket prefix {}".format(
@@ -354,13 +893,11 @@ def provision_check(ec2_conn, iam_conn, s3_conn, s3_bucket_path, clustername, fo
         warning_reasons.append(reasons)
 
     testfile = 'dummy.txt'
-    with open(testfile, 'w+') as filep:
-        pass
 
     try:
         k = Key(bucket)
         k.key = os.path.join(bucket_prefix_orig, testfile + '.' + str(utctimestamp()))
-        k.set_contents_from_filename(testfile)
+        k.set_contents_from_string('')
     except S3ResponseError, e:
         print "verified read only access to path {} ".format(bucket_prefix_orig)
     else:
@@ -369,7 +906,137 @@ def provision_check(ec2_conn, iam_conn, s3_conn, s3_bucket_path, clustername, fo
         print(reasons)
         warning_reasons.append(reasons)
 
-    create_cluster_json(ec2_conn, s3_bucket_path, user, all_policies, validated, clustername, warning_reasons)
+    return create_cluster_json(ec2_conn, s3_bucket_path, user, all_policies, validated, clustername,
+                               warning_reasons, output_dir)
+
+
+def read_policy_file(path):
+    """
+    :return: the policy in the file, None if there is no such file
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path) as fh:
+        return load_policy(fh.read())
+
+
+def read_manifest(path):
+    """
+    Read the entries of a batch manifest, a JSON list of objects or a CSV file with a header line, both with
+    the MANIFEST_FIELDS customer, account, bucket and region, and optionally the S3 Inventory report to check
+    the entry from as inventory
+    :return: list of dicts
+    """
+    with open(path) as fh:
+        if path.endswith('.json'):
+            entries = json.load(fh)
+        else:
+            entries = list(csv.DictReader(fh))
+
+    for num, entry in enumerate(entries, 1):
+        missing = [field for field in MANIFEST_FIELDS if not (entry.get(field) or '').strip()]
+        if missing:
+            raise Exception("Manifest {} entry {} is missing {}".format(path, num, ', '.join(missing)))
+        for field in MANIFEST_FIELDS:
+            entry[field] = str(entry[field]).strip()
+        if "*" in entry['bucket']:
+            raise Exception("Do not use wildcard in bucket path {}".format(entry['bucket']))
+    return entries
+
+
+def entry_output_dir(output_dir, entry):
+    """
+    :return: the directory of the output files of a manifest entry, one per customer and bucket path
+    """
+    bucket_dir = re.sub('[^A-Za-z0-9_.-]+', '_', entry['bucket'].strip('/'))
+    return os.path.join(output_dir, entry['customer'], bucket_dir)
+
+
+def provision_batch(aws_access_key_id, aws_secret_access_key, entries, action, output_dir, force=False,
+                    interana_user='interana_admin', workers=DEFAULT_BATCH_WORKERS, list_workers=DEFAULT_LIST_WORKERS,
+                    max_files=DEFAULT_MAX_FILES, order='key', probe_workers=DEFAULT_PROBE_WORKERS, template=None,
+                    budget_limits=None, recent_days=DEFAULT_RECENT_DAYS, cache_dir=None, cache_ttl=DEFAULT_CACHE_TTL,
+                    clear_cache=False, benchmark_limits=None):
+    """
+    Run create or check for every manifest entry, workers entries at a time.  The connections of a region are
+    made when an entry first needs them and shared by its entries.  An entry that fails does not stop the others.
+    :param template: the PolicyTemplate create renders for every entry
+    :param budget_limits: (max pages, max keys, max seconds) of the ListingBudget of each check, None to walk
+                          the folders.  An entry with an inventory field is checked from that S3 Inventory report.
+    :param cache_dir: directory of the ListingCache of each check, None not to cache
+    :param benchmark_limits: (objects, concurrency, part size, max bytes, max seconds) of the benchmark action
+    :return: list of the result of each entry, in manifest order
+    """
+    clients = get_clients(aws_access_key_id, aws_secret_access_key)
+
+    def process_entry(entry):
+        result = dict(entry, action=action, passed=False, warnings=[], error=None,
+                      output_dir=entry_output_dir(output_dir, entry))
+        try:
+            if not os.path.isdir(result['output_dir']):
+                os.makedirs(result['output_dir'])
+            region_name = entry['region']
+            policy = read_policy_file(os.path.join(result['output_dir'], POLICY_FILE))
+            if action == 'create':
+                provision_create(clients.iam(region_name), entry['account'], entry['bucket'], interana_user,
+                                 result['output_dir'], template)
+                result['passed'] = True
+            elif action == 'evaluate':
+                if policy is None:
+                    raise Exception("No policy in {}, run create first".format(result['output_dir']))
+                result['warnings'] = provision_evaluate(entry['account'], entry['bucket'], policy)
+                result['passed'] = len(result['warnings']) == 0
+            elif action == 'benchmark':
+                budget = ListingBudget(*budget_limits) if budget_limits is not None else None
+                benchmark = provision_benchmark(clients.s3(region_name), entry['bucket'], result['output_dir'],
+                                                *(benchmark_limits or ()),
+                                                budget=budget, inventory=entry.get('inventory') or None,
+                                                recent_days=recent_days)
+                result['benchmark'] = benchmark
+                result['passed'] = benchmark['errors'] == 0 and benchmark['bytes'] > 0
+            else:
+                budget = ListingBudget(*budget_limits) if budget_limits is not None else None
+                interana_cluster = provision_check(clients.ec2(region_name), clients.iam(region_name),
+                                                   clients.s3(region_name), entry['bucket'], entry['customer'],
+                                                   force, interana_user, list_workers, max_files, order,
+                                                   probe_workers, result['output_dir'], entry['account'], policy,
+                                                   budget, entry.get('inventory') or None, recent_days, cache_dir,
+                                                   cache_ttl, clear_cache)
+                result['passed'] = interana_cluster['validated']
+                result['warnings'] = interana_cluster['validation_warnings']
+        except Exception, e:
+            print_exception(e)
+            print "Error processing {} bucket {}".format(entry['customer'], entry['bucket'])
+            result['error'] = str(e)
+        return result
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        return pool.map(process_entry, entries)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_batch_report(results, report_file):
+    """
+    Print a pass or fail line per entry, and write the results to report_file as JSON
+    """
+    message = '\nProvisioning report for {} entries\n'.format(len(results))
+    for result in results:
+        status = 'PASS' if result['passed'] else 'FAIL'
+        message += '\n{} {} {} bucket {} region {}'.format(status, result['action'], result['customer'],
+                                                           result['bucket'], result['region'])
+        if result['error']:
+            message += '\n    error: {}'.format(result['error'])
+        for warning in result['warnings']:
+            message += '\n    {}'.format(warning.strip())
+    passed = len([result for result in results if result['passed']])
+    message += '\n\nPassed {} of {}, output in {}\n'.format(passed, len(results), os.path.dirname(report_file))
+    print message
+
+    with open(report_file, 'w') as fh:
+        json.dump({'passed': passed, 'failed': len(results) - passed, 'results': results}, fh, indent=4)
 
 
 def main():
@@ -383,18 +1050,36 @@ Assumes requirements.txt has been installed
 """)
 
     parser.add_argument('-i', '--interana_account_id', help='The interana account id, without dashes',
-                        required=True)
+                        default=None)
 
     parser.add_argument('-s', '--s3_bucket', help="""The s3_bucket and path spec.
 Dont use wildcards(*),
 eg:
 my-bucket/my_path/
 my-bucket""",
-                        required='True')
+                        default=None)
 
-    parser.add_argument('-a', '--action', help='Create or Check a configuration', choices=['create', 'check'],
+    parser.add_argument('-a', '--action', help="""Create or Check a configuration, or evaluate the bucket
+policy offline without any request to the bucket, or
+benchmark the read throughput of a checked path""",
+                        choices=['create', 'check', 'evaluate', 'benchmark'],
                         required=True)
 
+    parser.add_argument('-p', '--policy_file',
+                        help="""The bucket policy to evaluate, i.e. the output of
+aws s3api get-bucket-policy.  Default the
+s3_bucket_list.policy made by create""",
+                        default=None)
+
+    parser.add_argument('--existing_policy',
+                        help="""With create, the current policy of the bucket, i.e. the
+output of aws s3api get-bucket-policy.  The new
+statements are merged into it and written to
+<bucket>.merged.policy, with a manifest one file per
+bucket of all its entries.  Use an empty file for a
+bucket without a policy.""",
+                        default=None)
+
     parser.add_argument('-w', '--aws_access_key',
                         help='AWS Access key, None if using instance profile',
                         default=None)
@@ -405,16 +1090,137 @@ my-bucket""",
 
     parser.add_argument('-r', '--region',
                         help='region, i.e. us-east-1',
-                        required=True)
+                        default=None)
 
     parser.add_argument('-c', '--customername',
                         help='The canonical customer name, shortest possible, no trailing integers. eg. acme',
-                        required=True)
+                        default=None)
+
+    parser.add_argument('-m', '--manifest',
+                        help="""A CSV or JSON file of the entries to create or check,
+instead of -i, -s, -r and -c.  Each entry has the fields
+customer, account, bucket and region.  A CSV file starts
+with a header line naming them.""",
+                        default=None)
+
+    parser.add_argument('-o', '--output_dir',
+                        help="""Directory the output files are written to.  Default the
+current directory, or provision_output with a manifest
+where each entry gets a <customer>/<bucket> directory""",
+                        default=None)
+
+    parser.add_argument('--batch_workers', type=int,
+                        help='Number of manifest entries processed in parallel. '
+                             'Default {}'.format(DEFAULT_BATCH_WORKERS),
+                        default=DEFAULT_BATCH_WORKERS)
 
     parser.add_argument('-f', '--force',
                         help='Forces a generation of interana_cluster.json even if we dont pass validation',
                         default=False, action='store_true')
 
+    parser.add_argument('--list_workers', type=int,
+                        help='Number of folders listed in parallel during a check. '
+                             'Default {}'.format(DEFAULT_LIST_WORKERS),
+                        default=DEFAULT_LIST_WORKERS)
+
+    parser.add_argument('--max_files', type=int,
+                        help='Number of files per folder kept as candidates to download during a check. '
+                             'Default {}'.format(DEFAULT_MAX_FILES),
+                        default=DEFAULT_MAX_FILES)
+
+    parser.add_argument('--order', choices=['key', 'last_modified'],
+                        help='Try the files with the largest keys or the newest files first. Default key',
+                        default='key')
+
+    parser.add_argument('--probe_workers', type=int,
+                        help='Number of files read in parallel to verify read access. '
+                             'Default {}'.format(DEFAULT_PROBE_WORKERS),
+                        default=DEFAULT_PROBE_WORKERS)
+
+    parser.add_argument('--sample', action='store_true',
+                        help="""Check read access from a sample of the files within
+--max_pages, --max_keys and --max_seconds, instead
+of walking every folder.  Under date partitioned
+folders, i.e. dt=2017-05-31/ or 2017/05/31/, the
+listing starts at the files of --recent_days ago""",
+                        default=False)
+
+    parser.add_argument('--max_pages', type=int,
+                        help='List requests a sampled check may make. Default {}'.format(DEFAULT_MAX_PAGES),
+                        default=DEFAULT_MAX_PAGES)
+
+    parser.add_argument('--max_keys', type=int,
+                        help='Keys a sampled check may list. Default {}'.format(DEFAULT_MAX_KEYS),
+                        default=DEFAULT_MAX_KEYS)
+
+    parser.add_argument('--max_seconds', type=int,
+                        help='Seconds a sampled check may spend listing. Default {}'.format(DEFAULT_MAX_SECONDS),
+                        default=DEFAULT_MAX_SECONDS)
+
+    parser.add_argument('--recent_days', type=int,
+                        help='Age in days of the files a check looks for. Default {}'.format(DEFAULT_RECENT_DAYS),
+                        default=DEFAULT_RECENT_DAYS)
+
+    parser.add_argument('--inventory',
+                        help="""A local copy of an S3 Inventory report of the bucket, its
+manifest.json or a CSV data file, gzipped or not.  The
+files to read are chosen from it without listing the
+bucket.  With a manifest, use an inventory field per
+entry instead""",
+                        default=None)
+
+    parser.add_argument('--cache_dir',
+                        help="""Directory of the cache of the bucket location, folder
+listings and files chosen by a check, per bucket path
+and credentials.  Default {}""".format(DEFAULT_CACHE_DIR),
+                        default=DEFAULT_CACHE_DIR)
+
+    parser.add_argument('--cache_ttl', type=int,
+                        help='Seconds the cached lookups are used for. Default {}'.format(DEFAULT_CACHE_TTL),
+                        default=DEFAULT_CACHE_TTL)
+
+    parser.add_argument('--clear_cache', action='store_true',
+                        help='Drop the cached lookups of the bucket path and look everything up again',
+                        default=False)
+
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Neither use nor update the cache',
+                        default=False)
+
+    parser.add_argument('--bench_objects', type=int,
+                        help='Newest files of the path read by benchmark. '
+                             'Default {}'.format(DEFAULT_BENCHMARK_OBJECTS),
+                        default=DEFAULT_BENCHMARK_OBJECTS)
+
+    parser.add_argument('--bench_concurrency', type=int,
+                        help='Ranged GETs in flight during benchmark. '
+                             'Default {}'.format(read_benchmark.DEFAULT_CONCURRENCY),
+                        default=read_benchmark.DEFAULT_CONCURRENCY)
+
+    parser.add_argument('--part_size', type=int,
+                        help='MiB read by each ranged GET of benchmark. '
+                             'Default {}'.format(read_benchmark.DEFAULT_PART_SIZE / 1024 / 1024),
+                        default=read_benchmark.DEFAULT_PART_SIZE / 1024 / 1024)
+
+    parser.add_argument('--bench_mb', type=int,
+                        help='MiB read at most by benchmark. '
+                             'Default {}'.format(read_benchmark.DEFAULT_MAX_BYTES / 1024 / 1024),
+                        default=read_benchmark.DEFAULT_MAX_BYTES / 1024 / 1024)
+
+    parser.add_argument('--bench_seconds', type=int,
+                        help='Seconds benchmark reads for at most. '
+                             'Default {}'.format(read_benchmark.DEFAULT_MAX_SECONDS),
+                        default=read_benchmark.DEFAULT_MAX_SECONDS)
+
+    parser.add_argument('--aws_timeout', type=int,
+                        help='Seconds a request to AWS may wait on its socket. Default {}'.format(DEFAULT_TIMEOUT),
+                        default=DEFAULT_TIMEOUT)
+
+    parser.add_argument('--aws_retries', type=int,
+                        help='Retries of a request to AWS failing with a server or connection error. '
+                             'Default {}'.format(DEFAULT_RETRIES),
+                        default=DEFAULT_RETRIES)
+
     parser.add_argument('-u', '--user',
                         help='The IAM user that owns the access/secret key. Default is interana_admin, only change'
                              'if you are an expert',
@@ -422,17 +1228,77 @@ my-bucket""",
 
     args = parser.parse_args()
 
+    template = PolicyTemplate.from_file(POLICY_TEMPLATE_FILE) if args.action == 'create' else None
+    existing_policy = None
+    if args.existing_policy is not None:
+        with open(args.existing_policy) as fh:
+            content = fh.read().strip()
+        existing_policy = load_policy(content) if content else None
+
+    budget_limits = (args.max_pages, args.max_keys, args.max_seconds) if args.sample else None
+    cache_dir = None if args.no_cache else args.cache_dir
+    # Every thread of every entry may use the s3 connection of its region at once
+    pool_size = max(args.list_workers, args.probe_workers, args.bench_concurrency)
+    if args.manifest is not None:
+        pool_size *= args.batch_workers
+    clients = get_clients(args.aws_access_key, args.aws_secret_key, pool_size, args.aws_timeout, args.aws_retries)
+    benchmark_limits = (args.bench_objects, args.bench_concurrency, args.part_size * 1024 * 1024,
+                        args.bench_mb * 1024 * 1024, args.bench_seconds)
+
+    if args.manifest is not None:
+        entries = read_manifest(args.manifest)
+        output_dir = args.output_dir or 'provision_output'
+        results = provision_batch(args.aws_access_key, args.aws_secret_key, entries, args.action, output_dir,
+                                  args.force, args.user, args.batch_workers, args.list_workers, args.max_files,
+                                  args.order, args.probe_workers, template, budget_limits, args.recent_days,
+                                  cache_dir, args.cache_ttl, args.clear_cache, benchmark_limits)
+        if args.existing_policy is not None:
+            provision_merge(template, [(entry['account'], entry['bucket']) for entry in entries], existing_policy,
+                            output_dir)
+        print_batch_report(results, os.path.join(output_dir, 'provision_report.json'))
+        if not all(result['passed'] for result in results):
+            sys.exit(1)
+        return
+
+    for required, name in ((args.interana_account_id, '-i/--interana_account_id'),
+                           (args.s3_bucket, '-s/--s3_bucket'),
+                           (args.region, '-r/--region'),
+                           (args.customername, '-c/--customername')):
+        if required is None:
+            parser.error('argument {} is required without a manifest'.format(name))
+
+    output_dir = args.output_dir or '.'
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
     if "*" in args.s3_bucket:
         raise Exception("Do not use wildcard in bucket path {}".format(args.s3_bucket))
 
-    ec2_conn = get_ec2_connection(args.aws_access_key, args.aws_secret_key, args.region)
-    iam_conn = get_iam_connection(args.aws_access_key, args.aws_secret_key, args.region)
-    s3_conn = get_s3_connection(args.aws_access_key, args.aws_secret_key, args.region)
+    policy = read_policy_file(args.policy_file or os.path.join(output_dir, POLICY_FILE))
+    if args.policy_file is not None and policy is None:
+        raise Exception("Policy file {} not found".format(args.policy_file))
+    if args.action == "evaluate":
+        if policy is None:
+            raise Exception("No policy to evaluate, run create first or use --policy_file")
+        if provision_evaluate(args.interana_account_id, args.s3_bucket, policy):
+            sys.exit(1)
+        return
 
     if args.action == "create":
-        provision_create(ec2_conn, iam_conn, args.interana_account_id, args.s3_bucket, args.user)
+        provision_create(clients.iam(args.region), args.interana_account_id, args.s3_bucket, args.user, output_dir,
+                         template)
+        if args.existing_policy is not None:
+            provision_merge(template, [(args.interana_account_id, args.s3_bucket)], existing_policy, output_dir)
     elif args.action == "check":
-        provision_check(ec2_conn, iam_conn, s3_conn, args.s3_bucket, args.customername, args.force, args.user)
+        provision_check(clients.ec2(args.region), clients.iam(args.region), clients.s3(args.region), args.s3_bucket,
+                        args.customername, args.force, args.user, args.list_workers, args.max_files, args.order,
+                        args.probe_workers, output_dir, args.interana_account_id, policy,
+                        ListingBudget(*budget_limits) if budget_limits is not None else None, args.inventory,
+                        args.recent_days, cache_dir, args.cache_ttl, args.clear_cache)
+    elif args.action == "benchmark":
+        provision_benchmark(clients.s3(args.region), args.s3_bucket, output_dir, *benchmark_limits,
+                            budget=ListingBudget(*budget_limits) if budget_limits is not None else None,
+                            inventory=args.inventory, recent_days=args.recent_days)
 
 
 if __name__ == "__main__":
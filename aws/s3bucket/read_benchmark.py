@@ -0,0 +1,193 @@
+"""
+Read throughput benchmark of an S3 bucket.
+
+Objects are read with parallel ranged GETs, the data is counted and dropped in memory, nothing is written to
+disk.  Reports the sustained throughput, the latency of the requests and how many failed or were throttled,
+to size the ingest of a cluster from.  Requests are made without the retries of boto, which would hide the
+throttling, throttled requests are retried here and counted.
+"""
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 60
+
+# Bytes read from a response at a time
+READ_CHUNK = 256 * 1024
+
+# S3 errors that mean "slow down" rather than "this failed"
+THROTTLE_ERROR_CODES = ('SlowDown', 'Throttling', 'RequestLimitExceeded')
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Attempts again of a throttled range, and seconds waited before the first, doubled at each attempt
+THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 0.1
+
+
+def is_throttle(e):
+    return isinstance(e, S3ResponseError) and (e.status == 503 or e.error_code in THROTTLE_ERROR_CODES)
+
+
+def percentile(values, pct):
+    """
+    :param values: sorted list
+    :return: the nearest rank percentile, None for no values
+    """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))]
+
+
+def part_ranges(candidates, part_size=DEFAULT_PART_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Split the objects in parts, ordered so parallel requests spread over the objects, until max_bytes
+    :return: list of (object name, first byte, last byte)
+    """
+    parts = []
+    for num, key in enumerate(candidates):
+        for start in xrange(0, key.size or 0, part_size):
+            parts.append((start, num, key.name, min(key.size, start + part_size) - 1))
+    ranges = []
+    total = 0
+    for start, _, name, end in sorted(parts):
+        if total >= max_bytes:
+            break
+        ranges.append((name, start, end))
+        total += end - start + 1
+    return ranges
+
+
+def read_range(bucket, name, start, end):
+    """
+    GET one range of an object, dropping the data as it is read.  A single attempt is made.
+    :return: bytes read, seconds to the first byte, and seconds of the whole request
+    """
+    started = time.time()
+    key = Key(bucket, name)
+    key.open_read(headers={'Range': 'bytes={}-{}'.format(start, end)}, override_num_retries=0)
+    try:
+        num_bytes = 0
+        first_byte = None
+        while True:
+            data = key.read(READ_CHUNK)
+            if first_byte is None:
+                first_byte = time.time() - started
+            if not data:
+                break
+            num_bytes += len(data)
+    finally:
+        key.close()
+    return num_bytes, first_byte, time.time() - started
+
+
+def run_read_benchmark(bucket, candidates, concurrency=DEFAULT_CONCURRENCY, part_size=DEFAULT_PART_SIZE,
+                       max_bytes=DEFAULT_MAX_BYTES, max_seconds=DEFAULT_MAX_SECONDS):
+    """
+    Read the candidates with concurrency ranged GETs of part_size bytes at once, until max_bytes are read or
+    max_seconds have passed
+    :param candidates: boto Keys, with their size
+    :return: dict of the results
+    """
+    ranges = part_ranges(candidates, part_size, max_bytes)
+    parts_left = {}
+    for name, _, _ in ranges:
+        parts_left[name] = parts_left.get(name, 0) + 1
+
+    stop = threading.Event()
+
+    def read(part):
+        """
+        :return: the part, its measure, the exception it failed with, and the number of throttled attempts
+        """
+        throttled = 0
+        for attempt in range(THROTTLE_RETRIES + 1):
+            if stop.is_set():
+                return part, None, None, throttled
+            try:
+                return part, read_range(bucket, *part), None, throttled
+            except Exception, e:
+                if not is_throttle(e) or attempt == THROTTLE_RETRIES:
+                    return part, None, e, throttled
+                throttled += 1
+                time.sleep(THROTTLE_BACKOFF * 2 ** attempt)
+
+    latencies = []
+    first_bytes = []
+    total_bytes = 0
+    objects = 0
+    errors = 0
+    throttles = 0
+    last_error = None
+    started = time.time()
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        for (name, _, _), measure, e, throttled in pool.imap_unordered(read, ranges):
+            if time.time() - started >= max_seconds:
+                stop.set()
+            throttles += throttled
+            if e is not None:
+                if is_throttle(e):
+                    throttles += 1
+                else:
+                    errors += 1
+                    last_error = str(e)
+                continue
+            if measure is None:
+                continue
+            num_bytes, first_byte, seconds = measure
+            total_bytes += num_bytes
+            first_bytes.append(first_byte)
+            latencies.append(seconds)
+            parts_left[name] -= 1
+            if parts_left[name] == 0:
+                objects += 1
+    finally:
+        stop.set()
+        pool.close()
+        pool.join()
+    wall_time = max(time.time() - started, 0.001)
+
+    latencies.sort()
+    first_bytes.sort()
+    requests = len(latencies) + errors + throttles
+    return {'objects_sampled': len(candidates),
+            'concurrency': concurrency,
+            'part_size': part_size,
+            'wall_time': round(wall_time, 3),
+            'bytes': total_bytes,
+            'requests': requests,
+            'objects_read': objects,
+            'mib_per_second': round(total_bytes / wall_time / 1024 / 1024, 2),
+            'objects_per_second': round(objects / wall_time, 2),
+            'requests_per_second': round(len(latencies) / wall_time, 2),
+            'latency_ms': dict(('p{}'.format(pct), round(percentile(latencies, pct) * 1000, 1) if latencies else None)
+                               for pct in LATENCY_PERCENTILES),
+            'first_byte_ms': dict(('p{}'.format(pct),
+                                   round(percentile(first_bytes, pct) * 1000, 1) if first_bytes else None)
+                                  for pct in LATENCY_PERCENTILES),
+            'errors': errors,
+            'throttles': throttles,
+            'error_rate': round(float(errors) / requests, 4) if requests else 0.0,
+            'throttle_rate': round(float(throttles) / requests, 4) if requests else 0.0,
+            'last_error': last_error}
+
+
+def print_read_benchmark(result):
+    print "Read {:.1f} MiB of {} objects in {:.1f}s with {} parallel GETs of {} MiB".format(
+        result['bytes'] / 1024.0 / 1024, result['objects_sampled'], result['wall_time'], result['concurrency'],
+        result['part_size'] / 1024 / 1024)
+    print "    {} MiB/s, {} objects/s, {} requests/s".format(result['mib_per_second'], result['objects_per_second'],
+                                                            result['requests_per_second'])
+    print "    latency ms {}, first byte ms {}".format(
+        ', '.join('{} {}'.format(name, value) for name, value in sorted(result['latency_ms'].iteritems())),
+        ', '.join('{} {}'.format(name, value) for name, value in sorted(result['first_byte_ms'].iteritems())))
+    print "    {} of {} requests failed, {} throttled".format(result['errors'], result['requests'], result['throttles'])
+    if result['last_error']:
+        print "    last error: {}".format(result['last_error'])
@@ -0,0 +1,205 @@
+"""
+Throttle aware scheduling of EC2 API calls.
+
+Every call made through a ScheduledEC2Connection takes a token from the bucket of its API action, mutating
+calls also need a slot in a shared concurrency budget.  Calls rejected by EC2 with a throttling error are
+retried with jittered exponential backoff and slow their action's bucket down, so a run goes as fast as
+the account allows.  boto does not retry throttled calls itself, only other server and connection errors.
+"""
+from time import sleep, time
+import random
+import threading
+
+from boto.ec2.connection import EC2Connection
+from boto.exception import BotoServerError, EC2ResponseError
+
+# EC2 error codes that mean "slow down" rather than "this failed"
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'SnapshotCreationPerVolumeRateExceeded', 'Throttling')
+
+# Actions starting with these change resources, and share the mutating calls concurrency budget
+MUTATING_ACTION_PREFIXES = ('Create', 'Delete', 'Modify', 'Copy', 'Attach', 'Detach')
+
+# (calls per second, burst) for each action, actions not listed here use DEFAULT_ACTION_RATE
+DEFAULT_ACTION_RATE = (20.0, 40)
+ACTION_RATES = {
+    'CreateSnapshot': (5.0, 10),
+    'DeleteSnapshot': (5.0, 10),
+    'ModifySnapshotAttribute': (5.0, 10),
+    'CopySnapshot': (2.0, 5),
+    'CreateSnapshots': (2.0, 5),
+    'CreateTags': (10.0, 20),
+    'CreateVolume': (5.0, 10),
+    'AttachVolume': (5.0, 10),
+}
+
+# Actions newer than the API version of boto, sent with the version that introduced them
+ACTION_API_VERSIONS = {
+    'CreateSnapshots': '2016-11-15',
+    'CreateVolume': '2016-11-15',
+}
+
+# Number of mutating calls allowed in flight at once
+DEFAULT_MUTATING_CALLS = 4
+
+
+class TokenBucket(object):
+    """
+    Hands out tokens at rate per second, up to burst at once.  The rate is halved each time the action is
+    throttled and creeps back up to the configured rate as calls succeed.
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 32, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+class ApiScheduler(object):
+    """
+    Shared by every connection and worker of a region.  Keeps one TokenBucket per API action and counts the
+    calls, throttles and errors of each action.  If a RunMetrics is given, the latency and outcome of every
+    call is recorded in it under the name of the scheduler.
+    """
+
+    def __init__(self, mutating_calls=DEFAULT_MUTATING_CALLS, max_retries=8, base_delay=0.5, max_delay=30.0,
+                 metrics=None, name=None, rate_scale=1.0):
+        self.metrics = metrics
+        self.name = name
+        self.rate_scale = rate_scale
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.mutating = threading.BoundedSemaphore(mutating_calls)
+        self.buckets = {}
+        self.calls = {}
+        self.throttles = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, action):
+        with self.lock:
+            if action not in self.buckets:
+                rate, burst = ACTION_RATES.get(action, DEFAULT_ACTION_RATE)
+                self.buckets[action] = TokenBucket(rate * self.rate_scale, max(1, int(burst * self.rate_scale)))
+            return self.buckets[action]
+
+    def count(self, counter, action):
+        with self.lock:
+            counter[action] = counter.get(action, 0) + 1
+
+    def record(self, action, started, outcome):
+        if self.metrics is not None:
+            self.metrics.record_call(self.name, action, time() - started, outcome)
+
+    @property
+    def total_throttles(self):
+        return sum(self.throttles.values())
+
+    def reset_counters(self):
+        """
+        Start counting the calls, throttles and errors of a new run.  The rates of the buckets are kept, they
+        reflect how fast the account allows calls.
+        """
+        with self.lock:
+            self.calls = {}
+            self.throttles = {}
+            self.errors = {}
+
+    def call(self, action, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) as the EC2 API action, retrying it while EC2 throttles it
+        """
+        bucket = self.bucket(action)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self.count(self.calls, action)
+            started = time()
+            try:
+                if action.startswith(MUTATING_ACTION_PREFIXES):
+                    with self.mutating:
+                        result = func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except BotoServerError, e:
+                if e.error_code not in THROTTLE_ERROR_CODES or attempt >= self.max_retries:
+                    self.record(action, started, 'error')
+                    self.count(self.errors, action)
+                    raise
+                attempt += 1
+                self.record(action, started, 'throttled')
+                self.count(self.throttles, action)
+                bucket.throttled()
+                sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            except Exception:
+                self.record(action, started, 'error')
+                self.count(self.errors, action)
+                raise
+            else:
+                self.record(action, started, 'ok')
+                bucket.succeeded()
+                return result
+
+
+def raise_throttle(response, attempt, next_sleep):
+    """
+    retry_handler of boto raising throttled calls to the ApiScheduler, instead of letting boto retry them
+    unseen, without backoff and while holding the mutating calls budget
+    :return: None so boto handles any other response as usual
+    """
+    if response.status != 503:
+        return None
+    error = EC2ResponseError(response.status, response.reason, response.read())
+    if error.error_code in THROTTLE_ERROR_CODES:
+        raise error
+    return None
+
+
+class ScheduledEC2Connection(EC2Connection):
+    """
+    EC2Connection that runs every API call through an ApiScheduler.  Objects returned by the connection keep
+    a reference to it, so calls such as snapshot.delete() are scheduled as well.
+    """
+
+    def __init__(self, scheduler=None, **kw_params):
+        super(ScheduledEC2Connection, self).__init__(**kw_params)
+        self.scheduler = scheduler or ApiScheduler()
+
+    def get_list(self, action, *args, **kwargs):
+        return self.scheduler.call(action, super(ScheduledEC2Connection, self).get_list, action, *args, **kwargs)
+
+    def get_object(self, action, *args, **kwargs):
+        return self.scheduler.call(action, super(ScheduledEC2Connection, self).get_object, action, *args, **kwargs)
+
+    def get_status(self, action, *args, **kwargs):
+        return self.scheduler.call(action, super(ScheduledEC2Connection, self).get_status, action, *args, **kwargs)
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        http_request = self.build_base_http_request(verb, path, None, params, {}, '', self.host)
+        http_request.params['Action'] = action
+        http_request.params['Version'] = ACTION_API_VERSIONS.get(action, self.APIVersion)
+        return self._mexe(http_request, retry_handler=raise_throttle)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Scale benchmark for make_snapshots and rotate_snapshots, run against the in-process fake EC2 in fake_ec2.py.
+
+Each account size runs in its own process, so peak memory is measured per size.  Results are written as JSON
+and can be compared with the results of a previous version.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import Process, Queue
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+from api_scheduler import ApiScheduler
+from fake_ec2 import FakeEC2, FakeEC2Connection
+from make_snapshot import make_snapshots, sync_catalog, DEFAULT_WORKERS, DEFAULT_DELETE_WORKERS
+from metrics import RunMetrics
+from snapshot_catalog import SnapshotCatalog
+
+DEFAULT_SIZES = '10,100,1000,10000'
+
+# make_snapshots phases reported under each benchmark phase
+BENCHMARK_PHASES = (('discovery', ('discovery', 'tags', 'inventory')),
+                    ('creation', ('snapshot',)),
+                    ('rotation', ('rotate',)))
+
+# EC2 actions all reported under one benchmark phase, whatever make_snapshots phase made them.  The expired
+# snapshots are deleted by their own threads while the volumes are snapshotted
+ACTION_PHASES = {'DeleteSnapshot': 'rotation'}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class BenchmarkMetrics(RunMetrics):
+    """
+    RunMetrics that also records the EC2 calls made and the peak memory at the end of every phase
+    """
+
+    def __init__(self, account):
+        super(BenchmarkMetrics, self).__init__()
+        self.account = account
+        self.phase_calls = {}
+        self.phase_peak_rss = {}
+
+    @contextmanager
+    def phase(self, region_name, name):
+        calls_before = self.account.call_counts()
+        with super(BenchmarkMetrics, self).phase(region_name, name):
+            yield
+        calls = self.account.call_counts()
+        self.phase_calls[name] = dict((action, count - calls_before.get(action, 0))
+                                      for action, count in calls.iteritems()
+                                      if count > calls_before.get(action, 0))
+        self.phase_peak_rss[name] = peak_rss_mb()
+
+    def record_phase(self, region_name, name, seconds):
+        super(BenchmarkMetrics, self).record_phase(region_name, name, seconds)
+        self.phase_peak_rss[name] = peak_rss_mb()
+
+
+def run_size(volumes, snapshots, args):
+    """
+    Build an account of the given size and snapshot it once
+    :return: dict of the measurements
+    """
+    account = FakeEC2.generate(volumes, snapshots, latency=args.latency, throttle_rate=args.throttle_rate,
+                               seed=volumes)
+    baseline_rss = peak_rss_mb()
+    metrics = BenchmarkMetrics(account)
+    scheduler = ApiScheduler(metrics=metrics, name='us-east-1', rate_scale=args.rate_scale)
+    conn = FakeEC2Connection(account, scheduler=scheduler)
+
+    catalog = None
+    if args.catalog:
+        # A catalog synced by an earlier run, its calls are not counted
+        catalog = SnapshotCatalog(':memory:')
+        sync_catalog(catalog, conn)
+        account.calls = {}
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = make_snapshots(conn, args.period, ('Cluster', 'Interana'), None, args.workers, args.delete_workers,
+                                metrics, multi_volume=args.multi_volume, catalog=catalog)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    run_metrics = metrics.as_dict()
+    phase_seconds = dict((phase['phase'], phase['seconds']) for phase in run_metrics['phases'])
+    benchmark_phase = dict((run_phase, name) for name, run_phases in BENCHMARK_PHASES for run_phase in run_phases)
+    phase_api_calls = dict((name, {}) for name, _ in BENCHMARK_PHASES)
+    for run_phase, calls in metrics.phase_calls.iteritems():
+        for action, count in calls.iteritems():
+            name = benchmark_phase.get(run_phase)
+            if name is not None and action not in ACTION_PHASES:
+                phase_api_calls[name][action] = phase_api_calls[name].get(action, 0) + count
+    for action, count in account.call_counts().iteritems():
+        if action in ACTION_PHASES:
+            phase_api_calls[ACTION_PHASES[action]][action] = count
+    phases = {}
+    for name, run_phases in BENCHMARK_PHASES:
+        api_calls = phase_api_calls[name]
+        peaks = [metrics.phase_peak_rss[run_phase] for run_phase in run_phases if run_phase in metrics.phase_peak_rss]
+        phases[name] = {'seconds': round(sum(phase_seconds.get(run_phase, 0.0) for run_phase in run_phases), 3),
+                        'api_calls': api_calls,
+                        'peak_rss_mb': round(max(peaks) - baseline_rss, 1) if peaks else 0.0}
+
+    return {'volumes': volumes,
+            'snapshots': snapshots,
+            'wall_time': run_metrics['wall_time'],
+            'api_calls': account.call_counts(),
+            'throttles': scheduler.total_throttles,
+            'phases': phases,
+            'created': result['created'],
+            'deleted': result['deleted'],
+            'errors': result['errors']}
+
+
+def run_size_process(volumes, snapshots, args):
+    """
+    Run one size in a child process, so its peak memory is not mixed with the other sizes
+    """
+    queue = Queue()
+
+    def target():
+        try:
+            queue.put(run_size(volumes, snapshots, args))
+        except Exception, e:
+            queue.put({'volumes': volumes, 'snapshots': snapshots, 'error': str(e)})
+
+    process = Process(target=target)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return 'unknown'
+
+
+def print_result(result):
+    if 'error' in result:
+        print '{:>6} volumes {:>7} snapshots: FAILED {}'.format(result['volumes'], result['snapshots'], result['error'])
+        return
+    print '{:>6} volumes {:>7} snapshots: {:8.2f}s wall, {:6d} calls, {:4d} throttled, created {}, deleted {}'.format(
+        result['volumes'], result['snapshots'], result['wall_time'], sum(result['api_calls'].values()),
+        result['throttles'], result['created'], result['deleted'])
+    for name, _ in BENCHMARK_PHASES:
+        phase = result['phases'][name]
+        print '    {:<10} {:8.2f}s  peak +{:7.1f} MiB  {}'.format(
+            name, phase['seconds'], phase['peak_rss_mb'],
+            ', '.join('{} {}'.format(action, count) for action, count in sorted(phase['api_calls'].iteritems())))
+
+
+def compare_results(previous, current):
+    """
+    Print the change in wall time, API calls and peak memory for the sizes found in both runs
+    """
+    print '\nCompared with {} ({})'.format(previous.get('version'), previous.get('created'))
+    before = dict((result['volumes'], result) for result in previous['results'] if 'error' not in result)
+    for result in current['results']:
+        old = before.get(result['volumes'])
+        if old is None or 'error' in result:
+            continue
+        old_calls = sum(old['api_calls'].values())
+        new_calls = sum(result['api_calls'].values())
+        old_rss = max(phase['peak_rss_mb'] for phase in old['phases'].values())
+        new_rss = max(phase['peak_rss_mb'] for phase in result['phases'].values())
+        print '{:>6} volumes: wall {:8.2f}s -> {:8.2f}s ({:+.0%}), calls {} -> {}, peak {:.1f} -> {:.1f} MiB'.format(
+            result['volumes'], old['wall_time'], result['wall_time'],
+            (result['wall_time'] - old['wall_time']) / max(old['wall_time'], 0.001),
+            old_calls, new_calls, old_rss, new_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks make_snapshots against a fake EC2 account",
+                                     epilog='''
+    Notes:
+    Rates of the API scheduler are multiplied by --rate_scale.  Use 1 to include the pacing used against AWS
+    in the wall time, the default measures the cost of the tool itself.
+''')
+
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES,
+                        help='Comma separated numbers of volumes. Default {}'.format(DEFAULT_SIZES))
+
+    parser.add_argument('--snapshots_per_volume', type=int, default=10,
+                        help='Existing snapshots per volume. Default 10')
+
+    parser.add_argument('--max_snapshots', type=int, default=100000,
+                        help='Cap on the number of existing snapshots in an account. Default 100000')
+
+    parser.add_argument('-p', '--period', choices=['day', 'week', 'month', 'adhoc'], default='day',
+                        help='Period of the snapshots. Default day')
+
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every fake EC2 call. Default 0')
+
+    parser.add_argument('--throttle_rate', type=float, default=0.0,
+                        help='Fraction of fake EC2 calls throttled. Default 0')
+
+    parser.add_argument('--rate_scale', type=float, default=100.0,
+                        help='Multiplier of the API scheduler rates. Default 100')
+
+    parser.add_argument('-n', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of volumes to snapshot in parallel. Default {}'.format(DEFAULT_WORKERS))
+
+    parser.add_argument('-d', '--delete_workers', type=int, default=DEFAULT_DELETE_WORKERS,
+                        help='Number of snapshots to delete in parallel. Default {}'.format(DEFAULT_DELETE_WORKERS))
+
+    parser.add_argument('--multi_volume', action='store_true', default=False,
+                        help='Snapshot the volumes of each instance with one request')
+
+    parser.add_argument('--catalog', action='store_true', default=False,
+                        help='Look the snapshots up in a snapshot catalog synced before the run')
+
+    parser.add_argument('-o', '--output',
+                        help='File the results are written to. Default benchmark_<version>_<time>.json',
+                        default=None)
+
+    parser.add_argument('-c', '--compare',
+                        help='Results file of a previous run to compare with', default=None)
+
+    args = parser.parse_args()
+
+    version = get_version()
+    results = {'version': version,
+               'created': datetime.utcnow().isoformat() + 'Z',
+               'params': vars(args),
+               'results': []}
+
+    for volumes in [int(size) for size in args.sizes.split(',')]:
+        snapshots = min(args.max_snapshots, volumes * args.snapshots_per_volume)
+        result = run_size_process(volumes, snapshots, args)
+        print_result(result)
+        results['results'].append(result)
+
+    output = args.output or 'benchmark_{}_{}.json'.format(version, datetime.now().strftime("%Y%m%dT%H%M%S"))
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=4, sort_keys=True)
+    print '\nResults written to {}'.format(output)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare_results(json.load(fh), results)
+
+
+if __name__ == "__main__":
+    main()
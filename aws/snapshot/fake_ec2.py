@@ -0,0 +1,509 @@
+"""
+In-process stand-in for the EC2 API, used to benchmark make_snapshot without an AWS account.
+
+A FakeEC2Connection is a ScheduledEC2Connection whose requests are answered from a FakeEC2 account held in memory
+instead of going over HTTP.  Responses are the same XML documents EC2 returns, so boto's parsing and the API
+scheduler run exactly as they do against AWS.  Latency and throttling can be injected on every call.
+"""
+from datetime import datetime, timedelta
+from time import sleep
+from xml.sax.saxutils import escape
+import fnmatch
+import itertools
+import random
+import threading
+
+from boto.regioninfo import RegionInfo
+
+from api_scheduler import ScheduledEC2Connection
+
+XMLNS = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+
+FAKE_OWNER_ID = '111111111111'
+
+
+class FakeEC2Error(Exception):
+
+    def __init__(self, code, message, status=400):
+        super(FakeEC2Error, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class FakeResponse(object):
+    """
+    The parts of an httplib response boto reads
+    """
+
+    def __init__(self, status, reason, body):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+
+def format_time(when):
+    return when.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(when.microsecond // 1000)
+
+
+def list_param(params, label):
+    """
+    :return: the values of label.1, label.2, ... in the request
+    """
+    values = []
+    for i in itertools.count(1):
+        key = '{}.{}'.format(label, i)
+        if key not in params:
+            return values
+        values.append(params[key])
+
+
+def filter_params(params):
+    """
+    :return: dict of filter name to the set of its values
+    """
+    filters = {}
+    for i in itertools.count(1):
+        name = params.get('Filter.{}.Name'.format(i))
+        if name is None:
+            return filters
+        filters[name] = set(list_param(params, 'Filter.{}.Value'.format(i)))
+
+
+def filter_matches(wanted, value):
+    """
+    Filter values match with the * and ? wildcards, like EC2 filters do
+    """
+    if value is None:
+        return False
+    if '*' in wanted or '?' in wanted:
+        return fnmatch.fnmatchcase(value, wanted)
+    return value == wanted
+
+
+def tags_xml(tags):
+    return '<tagSet>{}</tagSet>'.format(''.join(
+        '<item><key>{}</key><value>{}</value></item>'.format(escape(key), escape(value))
+        for key, value in sorted(tags.iteritems())))
+
+
+def response_xml(action, body):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<{0}Response xmlns="{1}"><requestId>{2}</requestId>{3}' \
+           '</{0}Response>'.format(action, XMLNS, 'fake-request', body)
+
+
+def error_xml(code, message):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<Response><Errors><Error><Code>{}</Code><Message>{}</Message>' \
+           '</Error></Errors><RequestID>fake-request</RequestID></Response>'.format(escape(code), escape(message))
+
+
+class FakeEC2(object):
+    """
+    An EC2 account: instances, volumes, snapshots and their tags, shared by every FakeEC2Connection to it.
+
+    :param latency: seconds added to every call
+    :param throttle_rate: fraction of calls answered with RequestLimitExceeded
+    :param completion_seconds: time a new snapshot takes to go from pending to completed
+    :param copy_limit: copies in flight at once, more are answered with ResourceLimitExceeded
+    :param volume_seconds: time a new volume takes to go from creating to available
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, completion_seconds=60.0, seed=None, copy_limit=5,
+                 volume_seconds=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.completion_seconds = completion_seconds
+        self.volume_seconds = volume_seconds
+        self.copy_limit = copy_limit
+        self.peers = {}
+        self.random = random.Random(seed)
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.snapshots_by_volume = {}
+        self.tags = {}
+        self.calls = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def new_id(self, prefix):
+        return '{}-{:08x}'.format(prefix, next(self.ids))
+
+    def add_instance(self, tags=None, zone='us-east-1a', root_device='/dev/sda1'):
+        with self.lock:
+            instance_id = self.new_id('i')
+            self.instances[instance_id] = {'id': instance_id, 'zone': zone, 'root_device': root_device}
+            self.tags[instance_id] = dict(tags or {})
+            return instance_id
+
+    def add_volume(self, instance_id=None, device=None, tags=None, size=100, zone='us-east-1a', snapshot_id='',
+                   volume_type='gp2', available_at=None):
+        with self.lock:
+            volume_id = self.new_id('vol')
+            self.volumes[volume_id] = {'id': volume_id, 'instance_id': instance_id, 'device': device,
+                                       'size': size, 'zone': zone, 'snapshot_id': snapshot_id,
+                                       'type': volume_type, 'created': datetime.utcnow(),
+                                       'available_at': available_at}
+            self.tags[volume_id] = dict(tags or {})
+            return volume_id
+
+    def add_snapshot(self, volume_id, description, start_time=None, tags=None, completed=True, size=None,
+                     copy_of=None):
+        with self.lock:
+            snapshot_id = self.new_id('snap')
+            volume = self.volumes.get(volume_id, {})
+            self.snapshots[snapshot_id] = {'id': snapshot_id, 'volume_id': volume_id,
+                                           'description': description, 'size': size or volume.get('size', 100),
+                                           'start_time': start_time or datetime.utcnow(),
+                                           'completed': completed, 'shared_with': set(), 'copy_of': copy_of}
+            self.snapshots_by_volume.setdefault(volume_id, []).append(snapshot_id)
+            self.tags[snapshot_id] = dict(tags or {})
+            return snapshot_id
+
+    def add_peer(self, region_name, account):
+        """
+        Make the account of another region the source of snapshots copied from region_name
+        """
+        self.peers[region_name] = account
+
+    @classmethod
+    def generate(cls, volumes, snapshots=0, volumes_per_instance=4, tag=('Cluster', 'Interana'), period='day',
+                 **kwargs):
+        """
+        Build a synthetic account of tagged instances, each with a root drive and data volumes, and older
+        snapshots of the data volumes spread evenly over the days before today.
+        :param volumes: number of data volumes
+        :param snapshots: number of existing snapshots
+        """
+        account = cls(**kwargs)
+        data_volumes = []
+        while len(data_volumes) < volumes:
+            instance_id = account.add_instance({tag[0]: tag[1], 'Name': 'node'})
+            account.add_volume(instance_id, '/dev/sda1', {'Name': 'root'}, size=8)
+            for n in range(min(volumes_per_instance, volumes - len(data_volumes))):
+                tags = {'Cluster': 'bench', 'Uid': instance_id, 'Name': 'data'}
+                data_volumes.append(account.add_volume(instance_id, '/dev/xvd' + chr(ord('b') + n), tags))
+
+        now = datetime.utcnow()
+        per_volume = snapshots // max(1, len(data_volumes))
+        extra = snapshots % max(1, len(data_volumes))
+        for vi, volume_id in enumerate(data_volumes):
+            tags = dict(account.tags[volume_id], group_id='bench')
+            for n in range(per_volume + (1 if vi < extra else 0)):
+                start_time = now - timedelta(days=n + 1)
+                description = 'bench Interana {} Snapshot {}-{} for volume {}'.format(
+                    period.upper(), tags['Uid'], start_time.strftime('%Y%m%dT%H%M%S'), volume_id)
+                account.add_snapshot(volume_id, description, start_time, tags)
+        return account
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def request(self, action, params):
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+        if self.latency:
+            sleep(self.latency)
+        if throttled:
+            return FakeResponse(503, 'Service Unavailable',
+                                error_xml('RequestLimitExceeded', 'Request limit exceeded.'))
+
+        handler = getattr(self, 'do_' + action, None)
+        if handler is None:
+            return FakeResponse(400, 'Bad Request', error_xml('InvalidAction', 'Unknown action ' + action))
+        try:
+            with self.lock:
+                body = handler(params)
+        except FakeEC2Error, e:
+            return FakeResponse(e.status, 'Bad Request', error_xml(e.code, e.message))
+        return FakeResponse(200, 'OK', response_xml(action, body))
+
+    def match(self, resource_id, filters, values):
+        """
+        :param values: dict of the non tag filter names to the value of the resource
+        """
+        tags = self.tags.get(resource_id, {})
+        for name, wanted in filters.iteritems():
+            if name.startswith('tag:'):
+                if tags.get(name[4:]) not in wanted:
+                    return False
+            elif name == 'tag-key':
+                if not wanted & set(tags):
+                    return False
+            elif not any(filter_matches(value, values.get(name)) for value in wanted):
+                return False
+        return True
+
+    def snapshot_state(self, snap):
+        if snap['completed']:
+            return 'completed', 100
+        elapsed = (datetime.utcnow() - snap['start_time']).total_seconds()
+        if elapsed >= self.completion_seconds:
+            snap['completed'] = True
+            return 'completed', 100
+        return 'pending', int(100 * elapsed / self.completion_seconds)
+
+    def volume_status(self, volume):
+        if volume['available_at'] is not None and datetime.utcnow() < volume['available_at']:
+            return 'creating'
+        return 'in-use' if volume['instance_id'] else 'available'
+
+    def volume_xml(self, volume):
+        attachment = ''
+        if volume['instance_id']:
+            attachment = '<item><volumeId>{}</volumeId><instanceId>{}</instanceId><device>{}</device>' \
+                         '<status>attached</status><attachTime>{}</attachTime>' \
+                         '<deleteOnTermination>false</deleteOnTermination></item>'.format(
+                volume['id'], volume['instance_id'], volume['device'], format_time(volume['created']))
+        return '<item><volumeId>{}</volumeId><size>{}</size><snapshotId>{}</snapshotId>' \
+               '<availabilityZone>{}</availabilityZone><status>{}</status><createTime>{}</createTime>' \
+               '<attachmentSet>{}</attachmentSet>{}<volumeType>{}</volumeType></item>'.format(
+            volume['id'], volume['size'], volume['snapshot_id'], volume['zone'], self.volume_status(volume),
+            format_time(volume['created']), attachment, tags_xml(self.tags[volume['id']]), volume['type'])
+
+    def snapshot_xml(self, snap):
+        status, progress = self.snapshot_state(snap)
+        return '<volumeId>{}</volumeId><snapshotId>{}</snapshotId><status>{}</status><startTime>{}</startTime>' \
+               '<progress>{}%</progress><ownerId>{}</ownerId><volumeSize>{}</volumeSize>' \
+               '<description>{}</description><encrypted>false</encrypted>'.format(
+            snap['volume_id'], snap['id'], status, format_time(snap['start_time']), progress, FAKE_OWNER_ID,
+            snap['size'], escape(snap['description']))
+
+    def do_DescribeRegions(self, params):
+        return '<regionInfo><item><regionName>us-east-1</regionName>' \
+               '<regionEndpoint>ec2.us-east-1.amazonaws.com</regionEndpoint></item></regionInfo>'
+
+    def do_DescribeInstances(self, params):
+        filters = filter_params(params)
+        wanted = set(list_param(params, 'InstanceId'))
+        items = []
+        for instance_id in sorted(self.instances):
+            instance = self.instances[instance_id]
+            if wanted and instance_id not in wanted:
+                continue
+            if not self.match(instance_id, filters, {'instance-id': instance_id}):
+                continue
+            items.append('<item><reservationId>r-{0}</reservationId><ownerId>{1}</ownerId><groupSet/>'
+                         '<instancesSet><item><instanceId>{0}</instanceId><instanceState><code>16</code>'
+                         '<name>running</name></instanceState><placement><availabilityZone>{2}</availabilityZone>'
+                         '</placement><rootDeviceName>{3}</rootDeviceName>{4}</item></instancesSet></item>'.format(
+                instance_id, FAKE_OWNER_ID, instance['zone'], instance['root_device'],
+                tags_xml(self.tags[instance_id])))
+        return '<reservationSet>{}</reservationSet>'.format(''.join(items))
+
+    def do_DescribeVolumes(self, params):
+        filters = filter_params(params)
+        wanted = set(list_param(params, 'VolumeId'))
+        items = []
+        for volume_id in sorted(wanted or self.volumes):
+            volume = self.volumes.get(volume_id)
+            if volume is None:
+                raise FakeEC2Error('InvalidVolume.NotFound', 'The volume {} does not exist.'.format(volume_id))
+            values = {'volume-id': volume_id, 'attachment.instance-id': volume['instance_id'],
+                      'attachment.device': volume['device'], 'availability-zone': volume['zone']}
+            if self.match(volume_id, filters, values):
+                items.append(self.volume_xml(volume))
+        return '<volumeSet>{}</volumeSet>'.format(''.join(items))
+
+    def do_DescribeTags(self, params):
+        filters = filter_params(params)
+        resource_ids = filters.pop('resource-id', None) or set(self.tags)
+        items = []
+        for resource_id in sorted(resource_ids):
+            for key, value in sorted(self.tags.get(resource_id, {}).iteritems()):
+                if 'key' in filters and key not in filters['key']:
+                    continue
+                items.append('<item><resourceId>{}</resourceId><resourceType>{}</resourceType><key>{}</key>'
+                             '<value>{}</value></item>'.format(resource_id, self.resource_type(resource_id),
+                                                                escape(key), escape(value)))
+        return '<tagSet>{}</tagSet>'.format(''.join(items))
+
+    def do_DescribeSnapshots(self, params):
+        filters = filter_params(params)
+        wanted = set(list_param(params, 'SnapshotId'))
+        if wanted:
+            candidates = sorted(wanted)
+        elif 'snapshot-id' in filters:
+            candidates = sorted(filters['snapshot-id'])
+        elif 'volume-id' in filters:
+            candidates = [snapshot_id for volume_id in sorted(filters['volume-id'])
+                          for snapshot_id in self.snapshots_by_volume.get(volume_id, [])]
+        else:
+            candidates = sorted(self.snapshots)
+        items = []
+        for snapshot_id in candidates:
+            snap = self.snapshots.get(snapshot_id)
+            if snap is None:
+                if wanted:
+                    raise FakeEC2Error('InvalidSnapshot.NotFound',
+                                       'The snapshot {} does not exist.'.format(snapshot_id))
+                continue
+            status, _ = self.snapshot_state(snap)
+            values = {'snapshot-id': snapshot_id, 'volume-id': snap['volume_id'], 'status': status,
+                      'owner-id': FAKE_OWNER_ID, 'description': snap['description'],
+                      'start-time': format_time(snap['start_time'])}
+            if self.match(snapshot_id, filters, values):
+                items.append('<item>{}{}</item>'.format(self.snapshot_xml(snap), tags_xml(self.tags[snapshot_id])))
+        return '<snapshotSet>{}</snapshotSet>'.format(''.join(items))
+
+    def do_CreateSnapshot(self, params):
+        volume_id = params['VolumeId']
+        if volume_id not in self.volumes:
+            raise FakeEC2Error('InvalidVolume.NotFound', 'The volume {} does not exist.'.format(volume_id))
+        snapshot_id = self.add_snapshot(volume_id, params.get('Description', ''), completed=False)
+        return self.snapshot_xml(self.snapshots[snapshot_id])
+
+    def do_CreateSnapshots(self, params):
+        instance = self.instances.get(params['InstanceSpecification.InstanceId'])
+        if instance is None:
+            raise FakeEC2Error('InvalidInstanceID.NotFound', 'The instance does not exist.')
+        exclude_boot = params.get('InstanceSpecification.ExcludeBootVolume') == 'true'
+        excluded = set(list_param(params, 'InstanceSpecification.ExcludeDataVolumeIds'))
+        tags = {}
+        for i in itertools.count(1):
+            key = params.get('TagSpecification.1.Tag.{}.Key'.format(i))
+            if key is None:
+                break
+            tags[key] = params.get('TagSpecification.1.Tag.{}.Value'.format(i), '')
+        items = []
+        for volume_id in sorted(self.volumes):
+            volume = self.volumes[volume_id]
+            if volume['instance_id'] != instance['id'] or volume_id in excluded:
+                continue
+            if exclude_boot and volume['device'] == instance['root_device']:
+                continue
+            snapshot_tags = dict(self.tags[volume_id]) if params.get('CopyTagsFromSource') == 'volume' else {}
+            snapshot_tags.update(tags)
+            snapshot_id = self.add_snapshot(volume_id, params.get('Description', ''), tags=snapshot_tags,
+                                            completed=False)
+            items.append('<item>{}{}</item>'.format(self.snapshot_xml(self.snapshots[snapshot_id]),
+                                                    tags_xml(snapshot_tags)))
+        return '<snapshotSet>{}</snapshotSet>'.format(''.join(items))
+
+    def do_CopySnapshot(self, params):
+        source = self.peers.get(params['SourceRegion'])
+        if source is None:
+            raise FakeEC2Error('InvalidParameterValue', 'Unknown region {}'.format(params['SourceRegion']))
+        with source.lock:
+            snap = source.snapshots.get(params['SourceSnapshotId'])
+            if snap is None:
+                raise FakeEC2Error('InvalidSnapshot.NotFound', 'The snapshot does not exist.')
+            if source.snapshot_state(snap)[0] != 'completed':
+                raise FakeEC2Error('IncorrectState', 'The snapshot is not completed.')
+        copying = sum(1 for copy in self.snapshots.values()
+                      if copy['copy_of'] and self.snapshot_state(copy)[0] != 'completed')
+        if copying >= self.copy_limit:
+            raise FakeEC2Error('ResourceLimitExceeded', 'Too many snapshot copies in progress.')
+        snapshot_id = self.add_snapshot('vol-ffffffff', params.get('Description', ''), completed=False,
+                                        size=snap['size'], copy_of=snap['id'])
+        return '<snapshotId>{}</snapshotId>'.format(snapshot_id)
+
+    def do_CreateVolume(self, params):
+        snap = self.snapshots.get(params.get('SnapshotId'))
+        if snap is None:
+            raise FakeEC2Error('InvalidSnapshot.NotFound', 'The snapshot does not exist.')
+        if self.snapshot_state(snap)[0] != 'completed':
+            raise FakeEC2Error('IncorrectState', 'Snapshot {} is not completed.'.format(snap['id']))
+        tags = {}
+        for i in itertools.count(1):
+            key = params.get('TagSpecification.1.Tag.{}.Key'.format(i))
+            if key is None:
+                break
+            tags[key] = params.get('TagSpecification.1.Tag.{}.Value'.format(i), '')
+        volume_id = self.add_volume(tags=tags, size=int(params.get('Size', snap['size'])),
+                                    zone=params['AvailabilityZone'], snapshot_id=snap['id'],
+                                    volume_type=params.get('VolumeType', 'gp2'),
+                                    available_at=datetime.utcnow() + timedelta(seconds=self.volume_seconds))
+        volume = self.volumes[volume_id]
+        return '<volumeId>{}</volumeId><size>{}</size><snapshotId>{}</snapshotId><availabilityZone>{}' \
+               '</availabilityZone><status>creating</status><createTime>{}</createTime><volumeType>{}' \
+               '</volumeType>{}'.format(volume_id, volume['size'], snap['id'], volume['zone'],
+                                        format_time(volume['created']), volume['type'], tags_xml(tags))
+
+    def do_AttachVolume(self, params):
+        volume = self.volumes.get(params['VolumeId'])
+        instance = self.instances.get(params['InstanceId'])
+        if volume is None or instance is None:
+            raise FakeEC2Error('InvalidParameterValue', 'Unknown volume or instance.')
+        if self.volume_status(volume) != 'available':
+            raise FakeEC2Error('IncorrectState', 'Volume {} is not available.'.format(volume['id']))
+        if volume['zone'] != instance['zone']:
+            raise FakeEC2Error('InvalidVolume.ZoneMismatch', 'The volume is not in the zone of the instance.')
+        for other in self.volumes.values():
+            if other['instance_id'] == instance['id'] and other['device'] == params['Device']:
+                raise FakeEC2Error('InvalidParameterValue', 'Device {} is in use.'.format(params['Device']))
+        volume['instance_id'] = instance['id']
+        volume['device'] = params['Device']
+        return '<volumeId>{}</volumeId><instanceId>{}</instanceId><device>{}</device><status>attaching</status>' \
+               '<attachTime>{}</attachTime>'.format(volume['id'], instance['id'], volume['device'],
+                                                    format_time(datetime.utcnow()))
+
+    def do_DeleteSnapshot(self, params):
+        snapshot_id = params['SnapshotId']
+        snap = self.snapshots.pop(snapshot_id, None)
+        if snap is None:
+            raise FakeEC2Error('InvalidSnapshot.NotFound', 'The snapshot {} does not exist.'.format(snapshot_id))
+        self.snapshots_by_volume[snap['volume_id']].remove(snapshot_id)
+        self.tags.pop(snapshot_id, None)
+        return '<return>true</return>'
+
+    def do_ModifySnapshotAttribute(self, params):
+        snap = self.snapshots.get(params['SnapshotId'])
+        if snap is None:
+            raise FakeEC2Error('InvalidSnapshot.NotFound', 'The snapshot does not exist.')
+        snap['shared_with'].update(list_param(params, 'UserId'))
+        return '<return>true</return>'
+
+    def do_CreateTags(self, params):
+        resource_ids = list_param(params, 'ResourceId')
+        tags = {}
+        for i in itertools.count(1):
+            key = params.get('Tag.{}.Key'.format(i))
+            if key is None:
+                break
+            tags[key] = params.get('Tag.{}.Value'.format(i), '')
+        for resource_id in resource_ids:
+            if resource_id not in self.tags:
+                raise FakeEC2Error('InvalidID', 'The ID {} is not valid'.format(resource_id))
+            self.tags[resource_id].update(tags)
+        return '<return>true</return>'
+
+    def resource_type(self, resource_id):
+        return {'i': 'instance', 'vol': 'volume', 'snap': 'snapshot'}.get(resource_id.split('-')[0], 'unknown')
+
+
+class FakeEC2Connection(ScheduledEC2Connection):
+    """
+    ScheduledEC2Connection answered by a FakeEC2 account
+    """
+
+    def __init__(self, account, region_name='us-east-1', scheduler=None):
+        super(FakeEC2Connection, self).__init__(
+            scheduler=scheduler,
+            region=RegionInfo(name=region_name, endpoint='ec2.{}.amazonaws.com'.format(region_name)),
+            aws_access_key_id='fake', aws_secret_access_key='fake')
+        self.account = account
+
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        """
+        Answer the request from the account, with the retries of boto on server errors and its retry_handler
+        """
+        params = dict((key, value) for key, value in request.params.iteritems() if key not in ('Action', 'Version'))
+        num_retries = self.num_retries if override_num_retries is None else override_num_retries
+        attempt = 0
+        while True:
+            response = self.account.request(request.params['Action'], params)
+            if retry_handler is not None and retry_handler(response, attempt, 0):
+                attempt += 1
+                continue
+            if response.status not in (500, 502, 503, 504) or attempt >= num_retries:
+                return response
+            attempt += 1
@@ -1,130 +1,831 @@
 #!/usr/bin/env python
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from itertools import groupby
-from time import sleep
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+import Queue
 import argparse
+import os
 import sys
-import traceback
+import threading
 
 from boto import ec2
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aws_clients import DEFAULT_RETRIES, DEFAULT_TIMEOUT, get_clients, print_exception
+from api_scheduler import ApiScheduler, ScheduledEC2Connection
+from metrics import RunMetrics
+from snapshot_catalog import (COPY_VOLUME_TAG, DEFAULT_RECONCILE_INTERVAL, SnapshotCatalog, snapshot_periods,
+                              snapshot_volume_id)
 
 # Number of snapshots to keep, when we rotate.  If we pick adhoc, we don't rotate those.
 keep_week = 2
 keep_day = 7
 keep_month = 1
 
-def get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name):
+# Region used to list the regions of the account for --region all
+DEFAULT_REGION = 'us-east-1'
+
+# Number of volumes processed in parallel by default
+DEFAULT_WORKERS = 4
+
+# Number of expired snapshots deleted in parallel by default
+DEFAULT_DELETE_WORKERS = 4
+
+# Snapshots that can not be deleted yet, i.e. still in use, are retried after a delay
+RETRY_DELETE_ERROR_CODES = ('InvalidSnapshot.InUse', 'IncorrectState')
+
+# Polling interval bounds in seconds while waiting for snapshots to complete, and how long to wait by default
+WAIT_MIN_INTERVAL = 15
+WAIT_MAX_INTERVAL = 300
+DEFAULT_WAIT_TIMEOUT = 6 * 3600
+
+# Copies to another region started at once by default.  The destination region limits the copies in flight,
+# and rejects more with one of COPY_LIMIT_ERROR_CODES
+DEFAULT_COPY_CONCURRENCY = 5
+COPY_LIMIT_ERROR_CODES = ('ResourceLimitExceeded',)
+
+# Seconds between two polls of the snapshots being copied
+COPY_POLL_INTERVAL = 15
+
+# Longest wait in seconds before starting copies again after the destination region refused one for its limit,
+# the wait starts at the poll interval and doubles each time the limit is hit in a row
+COPY_LIMIT_MAX_BACKOFF = 300
+
+# Polls in a row a snapshot is not listed before it is taken as deleted.  Describing snapshots by id fails the
+# whole call for an id EC2 does not know, they are described with a snapshot-id filter which leaves them out, and
+# a snapshot just created may not be listed yet
+NOT_LISTED_POLLS = 3
+
+# Tag holding the availability zone of the volume a snapshot is of, where it is restored once the volume is gone
+ZONE_TAG = 'availability_zone'
+
+# Tag holding the description a snapshot of a single volume would have.  CreateSnapshots takes one description for
+# all the volumes of an instance, the per volume description is kept in this tag of each snapshot
+DESCRIPTION_TAG = 'volume_description'
+
+# When the daemon takes its snapshots: time of day, day of the week for week snapshots (Monday is 0) and day of
+# the month for month snapshots.  Periods falling on the same day are taken as one snapshot.
+DEFAULT_DAEMON_TIME = '02:00'
+DEFAULT_DAEMON_PERIODS = 'day,week,month'
+DAEMON_WEEKDAY = 6
+DAEMON_MONTHDAY = 1
+
+# Seconds after which the daemon lists volumes and snapshots again
+DEFAULT_REFRESH_INTERVAL = 3600
+
+# EC2 accepts at most 200 values for a single describe filter
+MAX_FILTER_VALUES = 200
+
+# Matches the descriptions make_snapshots gives to snapshots, when syncing the catalog
+SNAPSHOT_DESCRIPTION_FILTER = '* Interana * Snapshot *'
+
+# Days listed again before the watermark when syncing the catalog, for snapshots started just before the last sync
+SYNC_OVERLAP_DAYS = 1
+
+# So to snap on over, we need to backup everything that is not the root (/dev/sda1).
+ROOT_DRIVE = '/dev/sda1'
+
+def get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name, scheduler=None, metrics=None):
     """
     :param aws_access_key: if None, we will use the .aws/config on this system
     :param aws_secret_key: if None we wil use the .aws/config on this system
     :param region_name: This is a region string i.e. us-east-1
-    :return: a ec2_connection objects
+    :param scheduler: ApiScheduler the calls go through, None for a new one
+    :param metrics: RunMetrics the calls of a new scheduler are recorded in
+    :return: a ec2_connection objects, None if the region is not known.  The connection of a region, and its
+             scheduler, are made by the first call and shared by the later ones, so every thread of the process
+             draws on the same API budget.
     """
-    conn = ec2.connect_to_region(aws_access_key_id=aws_access_key_id,
-                                 aws_secret_access_key=aws_secret_access_key,
-                                 region_name=region_name)
-
+    conn = get_clients(aws_access_key_id, aws_secret_access_key).get(
+        'ec2', region_name, ScheduledEC2Connection,
+        scheduler=scheduler or ApiScheduler(metrics=metrics, name=region_name))
+    if conn is not None and conn.scheduler.metrics is None:
+        conn.scheduler.metrics = metrics
     return conn
 
 
-def print_list(llist):
-    return '[%s]' % '\n'.join(map(str, llist))
-
-
-def print_exception(e):
-    (typeE, value, tracebackPrev) = sys.exc_info()
-    print(str(typeE) + ':' + str(value))
-    print(" PREV=\n" + print_list(traceback.extract_tb(tracebackPrev)))
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 def set_resource_tags_local(conn, resource, tags):
-    for tag_key, tag_value in tags.iteritems():
-        if tag_key not in resource.tags or resource.tags[tag_key] != tag_value:
-            resource.add_tag(tag_key, tag_value)
+    """
+    Apply the tags the resource does not have yet with a single CreateTags call
+    """
+    new_tags = dict((tag_key, tag_value) for tag_key, tag_value in tags.iteritems()
+                    if tag_key not in resource.tags or resource.tags[tag_key] != tag_value)
+    if new_tags:
+        conn.create_tags([resource.id], new_tags)
+        resource.tags.update(new_tags)
 
 
-def get_resource_tags_local(conn, resource_id):
-    resource_tags = {}
-    if resource_id:
-        tags = conn.get_all_tags({'resource-id': resource_id})
+def get_resource_tags_local(conn, resource_ids):
+    """
+    Read the tags of many resources, asking for MAX_FILTER_VALUES resources per describe call
+    :param conn: ec2 connection
+    :param resource_ids: list of resource ids
+    :return: dict of resource id to a dict of its tags
+    """
+    resource_tags = dict((resource_id, {}) for resource_id in resource_ids if resource_id)
+    for chunk in chunks(resource_tags.keys(), MAX_FILTER_VALUES):
+        tags = conn.get_all_tags({'resource-id': chunk})
         for tag in tags:
             # Tags starting with 'aws:' are reserved for internal use
             if not tag.name.startswith('aws:'):
-                resource_tags[tag.name] = tag.value
+                resource_tags.setdefault(tag.res_id, {})[tag.name] = tag.value
     return resource_tags
 
 
-def rotate_snapshots(vol, period):
+def create_snapshot_local(conn, vol, description):
     """
-    For a given volume, find its snapshots and rotate them
-    :param vol: An AWS Volumen object
-    :param period: day, week month
-    :return: Number of snapshots deleted
+    Same as vol.create_snapshot, without the extra DescribeVolumes and Name tag calls boto makes for
+    every snapshot.  The Name tag is copied along with the other volume tags.
+    """
+    params = {'VolumeId': vol.id, 'Description': description[0:255]}
+    return conn.get_object('CreateSnapshot', params, Snapshot, verb='POST')
+
+
+def create_snapshots_local(conn, instance, exclude_boot, exclude_volume_ids, description, tags):
+    """
+    Snapshot the volumes of an instance with a single CreateSnapshots call, at the same point in time.  Each
+    snapshot gets the tags of its volume and the tags given.
+    :param exclude_boot: True to leave the boot volume out
+    :param exclude_volume_ids: ids of the data volumes to leave out
+    :return: list of the new snapshots
+    """
+    params = {'InstanceSpecification.InstanceId': instance.id,
+              'InstanceSpecification.ExcludeBootVolume': 'true' if exclude_boot else 'false',
+              'Description': description[0:255],
+              'CopyTagsFromSource': 'volume',
+              'TagSpecification.1.ResourceType': 'snapshot'}
+    for i, volume_id in enumerate(exclude_volume_ids, 1):
+        params['InstanceSpecification.ExcludeDataVolumeIds.{}'.format(i)] = volume_id
+    for i, (tag_key, tag_value) in enumerate(sorted(tags.iteritems()), 1):
+        params['TagSpecification.1.Tag.{}.Key'.format(i)] = tag_key
+        params['TagSpecification.1.Tag.{}.Value'.format(i)] = tag_value
+    return conn.get_list('CreateSnapshots', params, [('item', Snapshot)], verb='POST')
+
+
+class SnapshotIndex(object):
+    """
+    Our snapshots of a set of volumes, listed once and indexed by volume id and period.
+    Snapshots made afterwards are added to it, deleted ones are removed.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn, volume_ids, copies=False):
+        """
+        List the owner=self snapshots of the volumes, MAX_FILTER_VALUES volumes per describe call
+        :param copies: True to list the copies of the snapshots of the volumes, made in the region of conn
+        """
+        index = cls()
+        volume_filter = 'tag:' + COPY_VOLUME_TAG if copies else 'volume-id'
+        for chunk in chunks(volume_ids, MAX_FILTER_VALUES):
+            for snap in conn.get_all_snapshots(owner='self', filters={volume_filter: chunk}):
+                index.add(snap)
+        return index
+
+    @classmethod
+    def from_catalog(cls, catalog, conn, volume_ids):
+        """
+        Load the snapshots of the volumes from the catalog instead of listing them, the catalog must be synced
+        :param volume_ids: ids of the volumes, in the region of a copy the volumes the copies were made from
+        """
+        index = cls()
+        for row in catalog.snapshots(conn.region.name, volume_ids=volume_ids):
+            index.add(catalog.to_snapshot(conn, row))
+        return index
+
+    def add(self, snap):
+        with self.lock:
+            for period in snapshot_periods(snap.description):
+                self.snapshots.setdefault((snapshot_volume_id(snap), period), []).append(snap)
+
+    def remove(self, snap, periods=None):
+        """
+        :param periods: periods to remove the snapshot from, None for all of them
+        """
+        with self.lock:
+            for period in periods or snapshot_periods(snap.description):
+                snaps = self.snapshots.get((snapshot_volume_id(snap), period), [])
+                if snap in snaps:
+                    snaps.remove(snap)
+
+    def get(self, volume_id, period):
+        """
+        :return: the snapshots of the volume for the period, oldest first
+        """
+        with self.lock:
+            snaps = list(self.snapshots.get((volume_id, period), []))
+        return sorted(snaps, key=lambda snap: snap.start_time)
+
+    def expired(self, volume_id, period):
+        """
+        :return: the snapshots of the volume beyond the number kept for the period, oldest first
+        """
+        snaps = self.get(volume_id, period)
+        return snaps[:max(0, len(snaps) - keep_count(period))]
+
+    def kept(self, volume_id, period):
+        """
+        :return: the newest snapshots of the volume, the ones kept for the period
+        """
+        snaps = self.get(volume_id, period)
+        return snaps[max(0, len(snaps) - keep_count(period)):]
+
+
+def sync_catalog(catalog, conn, full=False):
+    """
+    Bring the catalog of the region of conn up to date.  Only the snapshots started on the days since the
+    watermark are listed, with a start-time filter of one wildcard per day.  When a reconcile is due, every
+    snapshot is listed and the catalog entries no longer found are dropped.
+    :param full: True to reconcile now
+    :return: number of snapshots listed
+    """
+    region_name = conn.region.name
+    started = time()
+    since = None if full else catalog.sync_from(region_name)
+    if since is not None:
+        first = datetime.strptime(since[:10], '%Y-%m-%d') - timedelta(days=SYNC_OVERLAP_DAYS)
+        days = [(first + timedelta(days=n)).strftime('%Y-%m-%d*')
+                for n in range((datetime.utcnow() - first).days + 1)]
+        if len(days) <= MAX_FILTER_VALUES:
+            snaps = conn.get_all_snapshots(owner='self', filters={'description': SNAPSHOT_DESCRIPTION_FILTER,
+                                                                  'start-time': days})
+            catalog.update(region_name, snaps)
+            return len(snaps)
+    snaps = conn.get_all_snapshots(owner='self', filters={'description': SNAPSHOT_DESCRIPTION_FILTER})
+    dropped = catalog.reconcile(region_name, snaps, started)
+    if dropped:
+        print 'Dropped {} snapshots of region {} no longer found from the catalog'.format(dropped, region_name)
+    return len(snaps)
+
+
+def keep_count(period):
+    """
+    :return: Number of snapshots to keep for the period
     """
-    total_deletes = 0
-    snapshots = vol.snapshots()
-    deletelist = []
-    for snap in snapshots:
-        desc = snap.description
-
-        if desc.find('WEEK Snapshot') > 0 and period == 'week':
-            deletelist.append(snap)
-        elif desc.find('DAY Snapshot') > 0 and period == 'day':
-            deletelist.append(snap)
-        elif desc.find('MONTH Snapshot') > 0 and period == 'month':
-            deletelist.append(snap)
-
-    def date_compare(snap1, snap2):
-        if snap1.start_time < snap2.start_time:
-            return -1
-        elif snap1.start_time == snap2.start_time:
-            return 0
-        return 1
-
-    deletelist.sort(date_compare)
     if period == 'day':
-        keep = keep_day
+        return keep_day
     elif period == 'week':
-        keep = keep_week
+        return keep_week
     elif period == 'month':
-        keep = keep_month
+        return keep_month
+    raise Exception("Invalid period {}".format(period))
+
+
+class SnapshotDeleter(object):
+    """
+    Deletes the expired snapshots of a run from a queue, with its own pool of threads so that a large
+    backlog of deletes does not hold up the creation of new snapshots.
+    """
+
+    def __init__(self, workers=DEFAULT_DELETE_WORKERS, max_attempts=3, retry_delay=5.0, metrics=None,
+                 region_name=None, catalog=None):
+        """
+        :param catalog: SnapshotCatalog the deleted snapshots are removed from, None for no catalog
+        """
+        self.metrics = metrics or RunMetrics()
+        self.region_name = region_name
+        self.catalog = catalog
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = Queue.Queue()
+        self.deleted = 0
+        self.failed = []
+        self.first_start = None
+        self.last_done = None
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, snap):
+        self.queue.put((snap, 1))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            snap, attempt = item
+            with self.lock:
+                if self.first_start is None:
+                    self.first_start = time()
+            try:
+                print 'Deleting snapshot ' + snap.description
+                snap.delete()
+            except EC2ResponseError, e:
+                if e.error_code in RETRY_DELETE_ERROR_CODES and attempt < self.max_attempts:
+                    sleep(self.retry_delay)
+                    self.queue.put((snap, attempt + 1))
+                else:
+                    if e.error_code == 'InvalidSnapshot.NotFound' and self.catalog is not None:
+                        self.catalog.remove([snap.id])
+                    self.fail(snap, e)
+            except Exception, e:
+                self.fail(snap, e)
+            else:
+                if self.catalog is not None:
+                    self.catalog.remove([snap.id])
+                with self.lock:
+                    self.deleted += 1
+                    self.last_done = time()
+                self.metrics.event('delete', region=self.region_name, snapshot_id=snap.id, volume_id=snap.volume_id,
+                                   ok=True, attempts=attempt)
+            finally:
+                self.queue.task_done()
+
+    def fail(self, snap, e):
+        print 'Error deleting snapshot {}: {}'.format(snap.id, e)
+        with self.lock:
+            self.failed.append((snap, e))
+            self.last_done = time()
+        self.metrics.event('delete', region=self.region_name, snapshot_id=snap.id, volume_id=snap.volume_id,
+                           ok=False, error=str(e))
+
+    def finish(self):
+        """
+        Wait for every queued snapshot to be deleted, then stop the threads
+        """
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    @property
+    def rate(self):
+        """
+        :return: deletes per second
+        """
+        if self.first_start is None or self.last_done is None or self.last_done <= self.first_start:
+            return 0.0
+        return self.deleted / (self.last_done - self.first_start)
+
+    @property
+    def seconds(self):
+        """
+        :return: seconds from the start of the first delete to the end of the last one
+        """
+        if self.first_start is None or self.last_done is None:
+            return 0.0
+        return max(0.0, self.last_done - self.first_start)
+
+
+def rotate_snapshots(volume_id, period, index, deleter):
+    """
+    For a given volume, find its expired snapshots and queue them for deletion.  A snapshot taken for several
+    periods is only deleted once none of its periods keeps it.
+    :param volume_id: id of the volume
+    :param period: day, week month
+    :param index: SnapshotIndex holding the snapshots of the volume
+    :param deleter: SnapshotDeleter the expired snapshots are queued on
+    :return: Number of snapshots queued for deletion
+    """
+    total_expired = 0
+    for snap in index.expired(volume_id, period):
+        index.remove(snap, [period])
+        other_periods = [other for other in snapshot_periods(snap.description) if other not in (period, 'adhoc')]
+        if any(snap in index.kept(volume_id, other) for other in other_periods):
+            continue
+        index.remove(snap)
+        deleter.submit(snap)
+        total_expired += 1
+    return total_expired
+
+
+def get_instance_volumes(conn, instance_ids):
+    """
+    Find the volumes attached to a set of instances, asking for MAX_FILTER_VALUES instances per describe call
+    :param conn: ec2 connection
+    :param instance_ids: list of instance ids
+    :return: dict of instance id to the list of volumes attached to it
+    """
+    vols_by_instance = dict((instance_id, []) for instance_id in instance_ids)
+    for chunk in chunks(instance_ids, MAX_FILTER_VALUES):
+        for vol in conn.get_all_volumes(filters={'attachment.instance-id': chunk}):
+            vols_by_instance.setdefault(vol.attach_data.instance_id, []).append(vol)
+    return vols_by_instance
+
+
+def snapshot_description(tags_volume, period, tag_namevalue, share_account, date_str, resource):
+    """
+    :param resource: what is snapshotted, i.e. volume vol-1234
+    """
+    if 'Cluster' and 'Uid' in tags_volume:
+        description = "{} Interana {} Snapshot {}-{} for {}".format(tags_volume['Cluster'],
+                                                                    period.upper(),
+                                                                    tags_volume['Uid'], date_str, resource)
     else:
-        raise Exception("Invalid period {}".format(period))
+        description = "{} Interana {} Snapshot {}-{} for {}".format(':'.join(tag_namevalue),
+                                                                    period.upper(),
+                                                                    'UidUnknown',
+                                                                    date_str,
+                                                                    resource)
+    if share_account is not None:
+        description += " shared with account {}".format(share_account)
+    return description
+
+
+def snapshot_tags(tags_volume, tag_namevalue, date_str, zone=None):
+    """
+    :param zone: availability zone of the volume
+    :return: the tags of a snapshot of the volume
+    """
+    tags_volume = dict(tags_volume)
+    if not ('Cluster' and 'Uid' in tags_volume):
+        tags_volume[tag_namevalue[0]] = tag_namevalue[1]
+    tags_volume['group_id'] = date_str
+    if zone:
+        tags_volume[ZONE_TAG] = zone
+    return tags_volume
+
+
+def snapshot_volume(conn, vol, vi, tags_volume, period, tag_namevalue, share_account, date_str, index):
+    """
+    Snapshot a single volume, then tag and share the snapshot.
+    :param tags_volume: the tags of the volume, copied onto the snapshot
+    :param index: SnapshotIndex the new snapshot is added to
+    :return: the new snapshot
+    """
+    description = snapshot_description(tags_volume, period, tag_namevalue, share_account, date_str,
+                                       'volume ' + vol.id)
+    tags_volume = snapshot_tags(tags_volume, tag_namevalue, date_str, vol.zone)
+    current_snap = create_snapshot_local(conn, vol, description)
+    index.add(current_snap)
+    set_resource_tags_local(conn, current_snap, tags_volume)
+    if share_account is not None:
+        current_snap.share(user_ids=[share_account])
 
-    delta = len(deletelist) - keep
-    for i in range(delta):
-        del_message = 'Deleting snapshot ' + deletelist[i].description
-        print del_message
-        deletelist[i].delete()
-        total_deletes += 1
-    return total_deletes
+    print '** {} ** Snapshot created with description: {} and tags: {}'.format(vi, description,
+                                                                               str(tags_volume))
+    return current_snap
 
 
-def make_snapshots(conn, period, tag_namevalue, share_account):
+def snapshot_instance(conn, instance, vols, instance_vols, vi, tags_by_volume, period, tag_namevalue,
+                      share_account, date_str, index):
     """
-    Bases on a scope, we will look for tags on both volumes and instances.  Once found we will snapshot those.
-    If there are tags that we expect, use those, or else just keep it anonymous, and use the name
+    Snapshot some of the volumes of an instance with one request, so they are taken at the same time, then tag
+    and share the snapshots.  EC2 gives them one description, the description of the volume when there is a
+    single one, else made from the tags of the first volume and naming the instance.  The description each
+    snapshot would have if taken alone is then kept in its DESCRIPTION_TAG tag.  Tags with the same value for
+    every snapshot are given by the request, only the DESCRIPTION_TAG and the tag_namevalue of untagged volumes
+    among tagged ones need a CreateTags call per snapshot.
+    :param vols: the volumes to snapshot
+    :param instance_vols: all the volumes attached to the instance
+    :param index: SnapshotIndex the new snapshots are added to
+    :return: list of the new snapshots, and dict of volume id to the exception raised tagging or sharing its
+             snapshot.  Snapshots are returned even when they could not be tagged or shared.
+    """
+    vol_ids = set(vol.id for vol in vols)
+    excluded = [vol for vol in instance_vols if vol.id not in vol_ids]
+    exclude_boot = any(vol.attach_data.device == instance.root_device_name for vol in excluded)
+    exclude_volume_ids = [vol.id for vol in excluded if vol.attach_data.device != instance.root_device_name]
+
+    resource = 'volume ' + vols[0].id if len(vols) == 1 else 'instance ' + instance.id
+    description = snapshot_description(tags_by_volume[vols[0].id], period, tag_namevalue, share_account, date_str,
+                                       resource)
+    request_tags = {'group_id': date_str, ZONE_TAG: instance.placement}
+    # Volume tags are copied by EC2, only the tag_namevalue of untagged volumes is missing
+    untagged = [vol for vol in vols if not ('Cluster' and 'Uid' in tags_by_volume[vol.id])]
+    if len(untagged) == len(vols):
+        request_tags[tag_namevalue[0]] = tag_namevalue[1]
+    snaps = create_snapshots_local(conn, instance, exclude_boot, exclude_volume_ids, description, request_tags)
+    created = []
+    errors = {}
+    for snap in snaps:
+        if snap.volume_id not in vol_ids:
+            print 'Warning: Snapshot {} of instance {} is of volume {} that was not requested'.format(
+                snap.id, instance.id, snap.volume_id)
+            continue
+        index.add(snap)
+        created.append(snap)
+        try:
+            tags_volume = snapshot_tags(tags_by_volume[snap.volume_id], tag_namevalue, date_str, instance.placement)
+            if len(vols) > 1:
+                tags_volume[DESCRIPTION_TAG] = snapshot_description(tags_by_volume[snap.volume_id], period,
+                                                                    tag_namevalue, share_account, date_str,
+                                                                    'volume ' + snap.volume_id)[0:255]
+            # Only the tags the request could not give are set, usually none for an instance with one volume
+            set_resource_tags_local(conn, snap, tags_volume)
+            if share_account is not None:
+                snap.share(user_ids=[share_account])
+        except Exception, e:
+            errors[snap.volume_id] = e
+            continue
+        print '** {} ** Snapshot created with description: {} for volume {} and tags: {}'.format(
+            vi, description, snap.volume_id, str(tags_volume))
+    return created, errors
+
+
+def snapshot_progress(snap):
+    """
+    :return: progress of the snapshot as an int percentage
+    """
+    try:
+        return int((snap.progress or '0').rstrip('%'))
+    except ValueError:
+        return 0
 
+
+def wait_for_snapshots(conn, snapshot_ids, timeout=DEFAULT_WAIT_TIMEOUT):
+    """
+    Poll the snapshots until they are all completed or failed, or until the timeout.  Each poll describes
+    MAX_FILTER_VALUES snapshots per call.  The interval grows while nothing moves and shrinks back when
+    snapshots make progress.
     :param conn: ec2 connection
-    :param period: day, month, week, the category of the snapshot
-    :param tag_namevalue: a tuple with key,value pair
-    :param share_account: Amazon Account Id integer
-    :return:
+    :param snapshot_ids: ids of the snapshots to wait for
+    :param timeout: seconds to wait before giving up on the pending snapshots
+    :return: dict of completed, pending and error snapshot id lists
+    """
+    pending = dict((snapshot_id, 0) for snapshot_id in snapshot_ids)
+    not_listed = {}
+    result = {'completed': [], 'pending': [], 'error': []}
+    started = time()
+    interval = WAIT_MIN_INTERVAL
+    while pending:
+        moved = False
+        found = set()
+        for chunk in chunks(pending.keys(), MAX_FILTER_VALUES):
+            for snap in conn.get_all_snapshots(filters={'snapshot-id': chunk}):
+                found.add(snap.id)
+                progress = snapshot_progress(snap)
+                if snap.status == 'completed':
+                    result['completed'].append(snap.id)
+                    del pending[snap.id]
+                    moved = True
+                elif snap.status == 'error':
+                    result['error'].append(snap.id)
+                    del pending[snap.id]
+                    moved = True
+                elif progress != pending[snap.id]:
+                    pending[snap.id] = progress
+                    moved = True
+        for snapshot_id in set(pending) - found:
+            not_listed[snapshot_id] = not_listed.get(snapshot_id, 0) + 1
+            if not_listed[snapshot_id] >= NOT_LISTED_POLLS:
+                print 'Snapshot {} is no longer listed'.format(snapshot_id)
+                result['error'].append(snapshot_id)
+                del pending[snapshot_id]
+        for snapshot_id in found:
+            not_listed.pop(snapshot_id, None)
+
+        total = len(snapshot_ids)
+        progress = (100 * len(result['completed']) + sum(pending.values())) / float(max(1, total))
+        print 'Waiting for snapshots: {} of {} completed, {} pending, {} error, {:.1f}% overall'.format(
+            len(result['completed']), total, len(pending), len(result['error']), progress)
+
+        if not pending:
+            break
+        if time() - started + interval > timeout:
+            print 'Timed out after {} seconds waiting for snapshots'.format(int(time() - started))
+            break
+        if moved:
+            interval = max(WAIT_MIN_INTERVAL, interval / 2)
+        else:
+            interval = min(WAIT_MAX_INTERVAL, interval * 2)
+        sleep(interval)
+
+    result['pending'] = sorted(pending)
+    return result
+
+
+class SnapshotCopier(object):
+    """
+    Copies the snapshots of a run to another region, for disaster recovery.  A snapshot is copied as soon as it
+    is completed, keeping up to concurrency copies in flight in the destination region.  Copies get the
+    description and tags of their snapshot, and once a copy is completed the copies of its volume are rotated
+    in the destination region.
+    """
+
+    def __init__(self, conn, copy_conn, volume_ids, periods, concurrency=DEFAULT_COPY_CONCURRENCY,
+                 delete_workers=DEFAULT_DELETE_WORKERS, metrics=None, poll_interval=COPY_POLL_INTERVAL,
+                 timeout=DEFAULT_WAIT_TIMEOUT, catalog=None):
+        """
+        :param conn: ec2 connection of the region of the snapshots
+        :param copy_conn: ec2 connection of the region the snapshots are copied to
+        :param volume_ids: ids of the volumes whose copies are rotated
+        :param periods: periods the copies are rotated for
+        :param catalog: SnapshotCatalog the copies are looked up in, added to and removed from, None for no catalog
+        """
+        self.metrics = metrics or RunMetrics()
+        self.catalog = catalog
+        self.conn = conn
+        self.copy_conn = copy_conn
+        self.volume_ids = volume_ids
+        self.periods = periods
+        self.max_concurrency = max(1, concurrency)
+        self.concurrency = self.max_concurrency
+        self.poll_interval = poll_interval
+        self.limit_backoff = 0
+        self.limit_until = 0
+        self.timeout = timeout
+        self.deleter = SnapshotDeleter(delete_workers, metrics=self.metrics, region_name=copy_conn.region.name,
+                                       catalog=catalog)
+        self.index = None
+        self.waiting = {}
+        self.ready = deque()
+        self.copying = {}
+        self.not_listed = {}
+        self.copied = []
+        self.failed = []
+        self.pending = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, snap):
+        """
+        Copy the snapshot once it is completed
+        """
+        with self.lock:
+            self.waiting[snap.id] = snap
+
+    def run(self):
+        region_name = self.copy_conn.region.name
+        try:
+            with self.metrics.phase(region_name, 'inventory'):
+                if self.catalog is not None:
+                    sync_catalog(self.catalog, self.copy_conn)
+                    self.index = SnapshotIndex.from_catalog(self.catalog, self.copy_conn, self.volume_ids)
+                else:
+                    self.index = SnapshotIndex.load(self.copy_conn, self.volume_ids, copies=True)
+        except Exception, e:
+            print_exception(e)
+            print 'Error listing the snapshots of region {}, copies will not be rotated'.format(region_name)
+
+        started = time()
+        while True:
+            with self.lock:
+                closed = self.closed
+                waiting = dict(self.waiting)
+            if closed and not waiting and not self.ready and not self.copying:
+                break
+            if closed and time() - started > self.timeout:
+                print 'Timed out after {} seconds copying snapshots to {}'.format(int(time() - started), region_name)
+                self.pending = sorted(waiting.keys() + [snap.id for snap in self.ready] + self.copying.keys())
+                break
+            try:
+                self.poll_snapshots(waiting)
+                self.poll_copies()
+                self.start_copies()
+            except Exception, e:
+                print_exception(e)
+                print 'Error copying snapshots to region ' + region_name
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+        self.deleter.finish()
+
+    def poll_snapshots(self, waiting):
+        """
+        Queue the completed snapshots for copy
+        """
+        found = set()
+        for chunk in chunks(waiting.keys(), MAX_FILTER_VALUES):
+            for snap in self.conn.get_all_snapshots(filters={'snapshot-id': chunk}):
+                found.add(snap.id)
+                if snap.status == 'completed':
+                    self.ready.append(waiting[snap.id])
+                elif snap.status == 'error':
+                    self.fail(waiting[snap.id], 'snapshot failed')
+                else:
+                    continue
+                with self.lock:
+                    del self.waiting[snap.id]
+        for snapshot_id in waiting:
+            if self.missing(snapshot_id, snapshot_id in found):
+                self.fail(waiting[snapshot_id], 'snapshot is no longer listed')
+                with self.lock:
+                    del self.waiting[snapshot_id]
+
+    def start_copies(self):
+        source_region = self.conn.region.name
+        if time() < self.limit_until:
+            return
+        while self.ready and len(self.copying) < self.concurrency:
+            snap = self.ready.popleft()
+            try:
+                copy_id = self.copy_conn.copy_snapshot(source_region, snap.id, snap.description)
+            except EC2ResponseError, e:
+                if e.error_code in COPY_LIMIT_ERROR_CODES:
+                    # The region is at its limit of copies in flight, which may be taken by copies of others.  Keep
+                    # below it and try again later
+                    self.ready.appendleft(snap)
+                    self.concurrency = max(1, len(self.copying))
+                    self.limit_backoff = min(COPY_LIMIT_MAX_BACKOFF, max(self.poll_interval, 2 * self.limit_backoff))
+                    self.limit_until = time() + self.limit_backoff
+                    print 'Region {} is at its limit of copies, starting more in {} seconds'.format(
+                        self.copy_conn.region.name, self.limit_backoff)
+                    return
+                self.fail(snap, e)
+                continue
+            except Exception, e:
+                self.fail(snap, e)
+                continue
+            tags = dict(snap.tags)
+            tags[COPY_VOLUME_TAG] = snap.volume_id
+            tags['source_snapshot_id'] = snap.id
+            tags['source_region'] = source_region
+            self.copying[copy_id] = (snap, time())
+            self.limit_backoff = 0
+            self.copy_conn.create_tags([copy_id], tags)
+            print 'Copying snapshot {} to {} as {}'.format(snap.id, self.copy_conn.region.name, copy_id)
+
+    def poll_copies(self):
+        """
+        Rotate the copies of the volumes whose copy completed
+        """
+        found = set()
+        for chunk in chunks(self.copying.keys(), MAX_FILTER_VALUES):
+            for copy in self.copy_conn.get_all_snapshots(filters={'snapshot-id': chunk}):
+                found.add(copy.id)
+                if copy.status not in ('completed', 'error'):
+                    continue
+                snap, started = self.copying.pop(copy.id)
+                # A copy is done, one more may be in flight again
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                if copy.status == 'error':
+                    self.fail(snap, 'copy {} failed'.format(copy.id))
+                    continue
+                self.copied.append(copy.id)
+                if self.catalog is not None:
+                    self.catalog.add(self.copy_conn.region.name, copy)
+                expired = 0
+                if self.index is not None and COPY_VOLUME_TAG in copy.tags:
+                    self.index.add(copy)
+                    for period in self.periods:
+                        expired += rotate_snapshots(snapshot_volume_id(copy), period, self.index, self.deleter)
+                self.metrics.event('copy', region=self.conn.region.name, copy_region=self.copy_conn.region.name,
+                                   snapshot_id=snap.id, copy_id=copy.id, volume_id=snap.volume_id, ok=True,
+                                   expired=expired, seconds=round(time() - started, 3))
+        for copy_id in self.copying.keys():
+            if self.missing(copy_id, copy_id in found):
+                snap, _ = self.copying.pop(copy_id)
+                self.fail(snap, 'copy {} is no longer listed'.format(copy_id))
+
+    def missing(self, snapshot_id, listed):
+        """
+        Count the polls in a row a snapshot was not listed in
+        :return: True once it was not listed NOT_LISTED_POLLS times
+        """
+        if listed:
+            self.not_listed.pop(snapshot_id, None)
+            return False
+        self.not_listed[snapshot_id] = self.not_listed.get(snapshot_id, 0) + 1
+        return self.not_listed[snapshot_id] >= NOT_LISTED_POLLS
+
+    def fail(self, snap, e):
+        print 'Error copying snapshot {} to {}: {}'.format(snap.id, self.copy_conn.region.name, e)
+        self.failed.append((snap, e))
+        self.metrics.event('copy', region=self.conn.region.name, copy_region=self.copy_conn.region.name,
+                           snapshot_id=snap.id, volume_id=snap.volume_id, ok=False, error=str(e))
+
+    def finish(self):
+        """
+        Wait for every submitted snapshot to be copied and for the expired copies to be deleted
+        """
+        with self.lock:
+            self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+
+
+def find_volumes(conn, tag_namevalue):
+    """
+    Find the volumes that have the tag, and the non root volumes of the instances that have the tag
+    :return: list of volumes sorted by id, and dict of the id of each instance with the tag to a tuple of the
+             instance and all its volumes
     """
     print 'Finding volumes that match the requested tag {}:{}'.format(tag_namevalue[0], tag_namevalue[1])
     vols_from_tags = conn.get_all_volumes(filters={'tag:' + tag_namevalue[0]: tag_namevalue[1]})
 
     reservations = conn.get_all_instances(filters={"tag:{}".format(tag_namevalue[0]): tag_namevalue[1]})
     all_instances = [instance for reservation in reservations for instance in reservation.instances]
+    instance_ids = [instance.id for instance in all_instances]
+    vols_by_instance = get_instance_volumes(conn, instance_ids)
 
-    # So to snap on over, we need to backup everything that is not the root (/dev/sda1).
     # If there is ONLY one drive, then assume its the root.
     vols_from_instances = []
-    ROOT_DRIVE = '/dev/sda1'
     for instance in all_instances:
-        all_vols = conn.get_all_volumes(filters={'attachment.instance-id': instance.id})
+        all_vols = vols_by_instance[instance.id]
 
-        if len (all_vols) == 0:
+        if len(all_vols) == 0:
             print "Warning: No volumes for instance {} are for backup".format(instance.id)
         elif len(all_vols) == 1:
             vols_from_instances += all_vols
@@ -132,54 +833,212 @@ def make_snapshots(conn, period, tag_namevalue, share_account):
             vols_from_instances += [vol for vol in all_vols if vol.attach_data.device != ROOT_DRIVE]
 
     sorted_vols = sorted(vols_from_instances + vols_from_tags, key=lambda x:x.id)
-    deduped_vols = [next(x[1]) for x in groupby(sorted_vols, key=lambda x: x.id)]
+    instances = dict((instance.id, (instance, vols_by_instance[instance.id])) for instance in all_instances)
+    return [next(x[1]) for x in groupby(sorted_vols, key=lambda x: x.id)], instances
+
+
+class Inventory(object):
+    """
+    The volumes to snapshot for a tag, the instances with the tag, the tags of the volumes and their snapshots.
+    make_snapshots builds one for each run, the daemon keeps one per region and refreshes it between runs.
+    """
+
+    def __init__(self, conn, tag_namevalue, metrics=None, catalog=None):
+        """
+        :param catalog: SnapshotCatalog the snapshots are looked up in after syncing it, None to list them
+        """
+        self.conn = conn
+        self.tag_namevalue = tag_namevalue
+        self.metrics = metrics or RunMetrics()
+        self.catalog = catalog
+        self.volumes = []
+        self.instances = {}
+        self.tags = {}
+        self.index = SnapshotIndex()
+        self.refreshed = None
+
+    def refresh(self, snapshots=True):
+        """
+        :param snapshots: False to skip listing the snapshots, they are only needed to rotate
+        """
+        region_name = self.conn.region.name
+        with self.metrics.phase(region_name, 'discovery'):
+            volumes, instances = find_volumes(self.conn, self.tag_namevalue)
+        with self.metrics.phase(region_name, 'tags'):
+            tags = get_resource_tags_local(self.conn, [vol.id for vol in volumes])
+        index = SnapshotIndex()
+        if snapshots:
+            with self.metrics.phase(region_name, 'inventory'):
+                if self.catalog is not None:
+                    sync_catalog(self.catalog, self.conn)
+                    index = SnapshotIndex.from_catalog(self.catalog, self.conn, [vol.id for vol in volumes])
+                else:
+                    index = SnapshotIndex.load(self.conn, [vol.id for vol in volumes])
+        self.volumes = volumes
+        self.instances = instances
+        self.tags = tags
+        self.index = index
+        self.refreshed = time()
+
+
+def group_volumes(volumes, instances):
+    """
+    Group the volumes by the instance with the tag they are attached to
+    :param instances: dict of instance id to a tuple of the instance and all its volumes, as found by find_volumes
+    :return: list of tuples of an instance, its volumes to snapshot and all its volumes.  The volumes of no
+             instance with the tag are returned one per tuple, with None as instance
+    """
+    vols_by_instance = {}
+    groups = []
+    for vol in volumes:
+        instance_id = vol.attach_data.instance_id if vol.attach_data else None
+        if instance_id in instances:
+            vols_by_instance.setdefault(instance_id, []).append(vol)
+        else:
+            groups.append((None, [vol], None))
+    for instance_id in sorted(vols_by_instance):
+        instance, instance_vols = instances[instance_id]
+        groups.append((instance, vols_by_instance[instance_id], instance_vols))
+    return groups
+
+
+def make_snapshots(conn, period, tag_namevalue, share_account, workers=DEFAULT_WORKERS,
+                   delete_workers=DEFAULT_DELETE_WORKERS, metrics=None, inventory=None, copy_conn=None,
+                   copy_concurrency=DEFAULT_COPY_CONCURRENCY, copy_timeout=DEFAULT_WAIT_TIMEOUT, multi_volume=False,
+                   catalog=None):
+    """
+    Bases on a scope, we will look for tags on both volumes and instances.  Once found we will snapshot those.
+    If there are tags that we expect, use those, or else just keep it anonymous, and use the name
+
+    :param conn: ec2 connection
+    :param period: day, month, week, the category of the snapshot.  Several periods joined with a + take one
+                   snapshot for all of them, i.e. day+week
+    :param tag_namevalue: a tuple with key,value pair
+    :param share_account: Amazon Account Id integer
+    :param workers: number of volumes to snapshot in parallel
+    :param delete_workers: number of expired snapshots to delete in parallel
+    :param metrics: RunMetrics the phase timings and volume events are recorded in
+    :param inventory: Inventory of the volumes and snapshots to use, None to build a new one
+    :param copy_conn: ec2 connection of the region the snapshots are copied to, None to not copy them
+    :param copy_concurrency: number of copies in flight at once
+    :param copy_timeout: seconds to wait for the copies to complete
+    :param multi_volume: True to snapshot the volumes of each instance with the tag in one request, so they are
+                         taken at the same time.  workers is then the number of instances snapshotted in parallel
+    :param catalog: SnapshotCatalog the snapshots are looked up in, and the snapshots created and deleted recorded
+                    in, None for no catalog
+    :return: dict with the counters of the run and the ids of the snapshots created
+    """
+    metrics = metrics or RunMetrics()
+    region_name = conn.region.name
+    periods = [p for p in period.split('+') if p != 'adhoc']
+
+    if inventory is None:
+        inventory = Inventory(conn, tag_namevalue, metrics, catalog)
+    if inventory.refreshed is None:
+        inventory.refresh(snapshots=len(periods) > 0)
+    deduped_vols = inventory.volumes
+    tags_by_volume = inventory.tags
+    index = inventory.index
 
     # Counters
     total_creates = 0
     total_deletes = 0
+    total_untagged = 0
     count_errors = 0
     count_success = 0
     count_total = 0
 
     date_str = datetime.now().strftime("%Y%m%dT%H%M%S")
-    for vi, vol in enumerate(deduped_vols):
-        try:
-            count_total += 1
-            tags_volume = get_resource_tags_local(conn, vol.id)
-            if 'Cluster' and 'Uid' in tags_volume:
-                description = "{} Interana {} Snapshot {}-{} for volume {}".format(tags_volume['Cluster'],
-                                                                                   period.upper(),
-                                                                                   tags_volume['Uid'], date_str, vol.id)
-            else:
-                description = "{} Interana {} Snapshot {}-{} for volume {}".format(':'.join(tag_namevalue),
-                                                                                   period.upper(),
-                                                                                   'UidUnknown',
-                                                                                   date_str,
-                                                                                   vol.id)
-                tags_volume[tag_namevalue[0]] = tag_namevalue[1]
-            tags_volume['group_id'] = date_str
 
-            if share_account is not None:
-                description += " shared with account {}".format(share_account)
-            current_snap = vol.create_snapshot(description)
-            set_resource_tags_local(conn, current_snap, tags_volume)
-            if share_account is not None:
-                current_snap.share(user_ids=[share_account])
+    deleter = SnapshotDeleter(delete_workers, metrics=metrics, region_name=region_name, catalog=catalog)
+    copier = None
+    if copy_conn is not None:
+        copier = SnapshotCopier(conn, copy_conn, [vol.id for vol in deduped_vols], periods, copy_concurrency,
+                                delete_workers, metrics, timeout=copy_timeout, catalog=catalog)
 
-            print '** {} ** Snapshot created with description: {} and tags: {}'.format(vi, description,
-                                                                                       str(tags_volume))
+    created_ids = []
 
-            total_creates += 1
+    def process_volume(vol, current_snap, error, started):
+        """
+        :return: tuple of True if the volume was snapshotted, its snapshot tagged and shared, the number of
+                 snapshots created, and the number of snapshots made but not tagged or shared
+        """
+        creates = 0
+        untagged = 0
+        expired = 0
+        try:
+            if current_snap is None:
+                raise error or Exception('No snapshot was made of volume {}'.format(vol.id))
+            created_ids.append(current_snap.id)
+            if catalog is not None:
+                catalog.add(region_name, current_snap)
+            if copier is not None:
+                copier.submit(current_snap)
+            # The snapshot was made but could not be tagged or shared, it is kept and the volume reported
+            if error is not None:
+                untagged += 1
+                raise error
+            creates += 1
 
-            if period != 'adhoc':
-                total_deletes += rotate_snapshots(vol, period)
-            sleep(3)
+            for rotate_period in periods:
+                expired += rotate_snapshots(vol.id, rotate_period, index, deleter)
         except Exception, e:
             print_exception(e)
             print 'Error in processing volume with id: ' + vol.id
-            count_errors += 1
-        else:
-            count_success += 1
+            metrics.event('volume', region=region_name, volume_id=vol.id, ok=False, error=str(e),
+                          snapshot_id=current_snap.id if current_snap else None, seconds=round(time() - started, 3))
+            return False, creates, untagged
+        metrics.event('volume', region=region_name, volume_id=vol.id, ok=True, snapshot_id=current_snap.id,
+                      expired=expired, seconds=round(time() - started, 3))
+        return True, creates, untagged
+
+    def process_group(item):
+        vi, (instance, vols, instance_vols) = item
+        started = time()
+        snaps = {}
+        errors = {}
+        error = None
+        try:
+            if instance is None:
+                snaps[vols[0].id] = snapshot_volume(conn, vols[0], vi, tags_by_volume[vols[0].id], period,
+                                                    tag_namevalue, share_account, date_str, index)
+            else:
+                created, errors = snapshot_instance(conn, instance, vols, instance_vols, vi, tags_by_volume,
+                                                    period, tag_namevalue, share_account, date_str, index)
+                for snap in created:
+                    snaps[snap.volume_id] = snap
+        except Exception, e:
+            error = e
+        return [process_volume(vol, snaps.get(vol.id), errors.get(vol.id, error), started) for vol in vols]
+
+    if multi_volume:
+        groups = group_volumes(deduped_vols, inventory.instances)
+    else:
+        groups = [(None, [vol], None) for vol in deduped_vols]
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        with metrics.phase(region_name, 'snapshot'):
+            for results in pool.imap_unordered(process_group, enumerate(groups)):
+                for ok, creates, untagged in results:
+                    count_total += 1
+                    total_creates += creates
+                    total_untagged += untagged
+                    if ok:
+                        count_success += 1
+                    else:
+                        count_errors += 1
+    finally:
+        pool.close()
+        pool.join()
+        with metrics.phase(region_name, 'delete'):
+            deleter.finish()
+        # The deletes run while the volumes are snapshotted, rotate is the time spent deleting
+        metrics.record_phase(region_name, 'rotate', deleter.seconds)
+        if copier is not None:
+            with metrics.phase(region_name, 'copy'):
+                copier.finish()
+    total_deletes = deleter.deleted
 
     result = '\nFinished making snapshots at {} with {} snapshots of {} possible.\n\n'.format(
         datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
@@ -189,10 +1048,312 @@ def make_snapshots(conn, period, tag_namevalue, share_account):
     message = result
     message += "\nTotal snapshots created: " + str(total_creates)
     message += "\nTotal snapshots errors: " + str(count_errors)
-    message += "\nTotal snapshots deleted: " + str(total_deletes) + "\n"
+    message += "\nTotal snapshots made but not tagged or shared: " + str(total_untagged)
+    message += "\nTotal snapshots deleted: " + str(total_deletes)
+    message += "\nTotal snapshot deletes failed: " + str(len(deleter.failed))
+    message += "\nSnapshot delete rate: {:.2f} deletes/s".format(deleter.rate)
+    for snap, e in deleter.failed:
+        message += "\n  Could not delete {} because {}".format(snap.id, e)
+    if copier is not None:
+        message += "\nTotal snapshots copied to {}: {}".format(copy_conn.region.name, len(copier.copied))
+        message += "\nTotal snapshot copies failed: " + str(len(copier.failed))
+        message += "\nTotal snapshot copies pending: " + str(len(copier.pending))
+        message += "\nTotal snapshot copies deleted: " + str(copier.deleter.deleted)
+        for snap, e in copier.failed:
+            message += "\n  Could not copy {} because {}".format(snap.id, e)
+    message += "\nTotal API calls throttled and retried: " + str(conn.scheduler.total_throttles) + "\n"
 
     print '\n' + message + '\n'
     print result
+    run_result = {'total': count_total,
+                  'success': count_success,
+                  'created': total_creates,
+                  'untagged': total_untagged,
+                  'errors': count_errors,
+                  'deleted': total_deletes,
+                  'delete_failures': len(deleter.failed),
+                  'throttles': conn.scheduler.total_throttles,
+                  'created_ids': created_ids}
+    if copier is not None:
+        run_result.update({'copied': len(copier.copied),
+                           'copy_failures': len(copier.failed),
+                           'copy_pending': len(copier.pending),
+                           'copies_deleted': copier.deleter.deleted,
+                           'copy_ids': copier.copied})
+    metrics.record_result(region_name, run_result)
+    return run_result
+
+
+def get_region_names(aws_access_key_id, aws_secret_access_key, regions):
+    """
+    :param regions: comma separated region names, or all for every region enabled for the account.  The regions
+                    are listed from EC2 when all or a region boto does not know is asked for, and connected to
+                    with the endpoints listed.
+    :return: list of region names
+    """
+    names = [region.strip() for region in regions.split(',') if region.strip()]
+    known = set(region.name for region in ec2.regions())
+    if names == ['all'] or not set(names) <= known:
+        conn = get_ec2_connection(aws_access_key_id, aws_secret_access_key, DEFAULT_REGION)
+        if conn is None:
+            raise Exception("Could not connect to AWS with supplied credentials")
+        account_regions = conn.get_all_regions()
+        get_clients(aws_access_key_id, aws_secret_access_key).add_regions('ec2', account_regions)
+        if names == ['all']:
+            return sorted(region.name for region in account_regions)
+    return names
+
+
+def make_snapshots_regions(aws_access_key_id, aws_secret_access_key, region_names, period, tag_namevalue,
+                           share_account, workers=DEFAULT_WORKERS, delete_workers=DEFAULT_DELETE_WORKERS,
+                           wait=False, wait_timeout=DEFAULT_WAIT_TIMEOUT, metrics=None, inventories=None,
+                           copy_region=None, copy_concurrency=DEFAULT_COPY_CONCURRENCY, multi_volume=False,
+                           catalog=None):
+    """
+    Run make_snapshots in every region at the same time, each with its own connection and API budget.
+    A region that fails is reported and does not stop the others.
+    :param inventories: dict of region name to the Inventory to use, None to connect and build them
+    :param copy_region: region the snapshots are copied to, None to not copy them.  The snapshots of that
+                        region itself are not copied
+    :param catalog: SnapshotCatalog shared by the regions, None for no catalog
+    :return: dict of region name to its make_snapshots result, or to the exception that stopped it
+    """
+    metrics = metrics or RunMetrics()
+
+    def process_region(region_name):
+        try:
+            inventory = None
+            if inventories is not None:
+                inventory = inventories[region_name]
+                conn = inventory.conn
+            else:
+                conn = get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name, metrics=metrics)
+            if conn is None:
+                raise Exception("Could not connect to region {}".format(region_name))
+            copy_conn = None
+            if copy_region is not None and copy_region != region_name:
+                copy_conn = get_ec2_connection(aws_access_key_id, aws_secret_access_key, copy_region,
+                                               metrics=metrics)
+                if copy_conn is None:
+                    raise Exception("Could not connect to region {}".format(copy_region))
+            result = make_snapshots(conn, period, tag_namevalue, share_account, workers, delete_workers, metrics,
+                                    inventory, copy_conn, copy_concurrency, wait_timeout, multi_volume, catalog)
+            if wait:
+                with metrics.phase(region_name, 'wait'):
+                    result['wait'] = wait_for_snapshots(conn, result['created_ids'], wait_timeout)
+        except Exception, e:
+            print_exception(e)
+            print 'Error in processing region ' + region_name
+            return region_name, e
+        return region_name, result
+
+    pool = ThreadPool(max(1, len(region_names)))
+    try:
+        return dict(pool.map(process_region, region_names))
+    finally:
+        pool.close()
+        pool.join()
+
+
+@contextmanager
+def run_lock(lock_file):
+    """
+    Hold an exclusive lock on lock_file while snapshotting, so overlapping runs wait for each other
+    instead of competing for the API rate limits
+    """
+    if lock_file is None:
+        yield
+        return
+    import fcntl
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def due_periods(day, periods):
+    """
+    :param day: date of the run
+    :param periods: the periods scheduled by the daemon
+    :return: the periods due that day joined with a +, i.e. day+week, None if nothing is due
+    """
+    due = []
+    if 'day' in periods:
+        due.append('day')
+    if 'week' in periods and day.weekday() == DAEMON_WEEKDAY:
+        due.append('week')
+    if 'month' in periods and day.day == DAEMON_MONTHDAY:
+        due.append('month')
+    return '+'.join(due) or None
+
+
+def next_run_time(now, run_at):
+    """
+    :param run_at: tuple of hour, minute
+    :return: the next datetime at run_at after now
+    """
+    run_time = now.replace(hour=run_at[0], minute=run_at[1], second=0, microsecond=0)
+    if run_time <= now:
+        run_time += timedelta(days=1)
+    return run_time
+
+
+def refresh_inventories(inventories, max_age):
+    """
+    Refresh, in parallel, the inventories older than max_age seconds.  Failures are printed and the old
+    inventory kept.
+    """
+    def refresh(inventory):
+        if inventory.refreshed is not None and time() - inventory.refreshed < max_age:
+            return
+        try:
+            inventory.refresh()
+        except Exception, e:
+            print_exception(e)
+            print 'Error refreshing volumes and snapshots of region ' + inventory.conn.region.name
+
+    pool = ThreadPool(max(1, len(inventories)))
+    try:
+        pool.map(refresh, inventories.values())
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_daemon(aws_access_key_id, aws_secret_access_key, region_names, tag_namevalue, share_account, periods,
+               run_at, refresh_interval=DEFAULT_REFRESH_INTERVAL, workers=DEFAULT_WORKERS,
+               delete_workers=DEFAULT_DELETE_WORKERS, metrics=None, lock_file=None, metrics_file=None,
+               prometheus_file=None, copy_region=None, copy_concurrency=DEFAULT_COPY_CONCURRENCY, multi_volume=False,
+               catalog=None):
+    """
+    Snapshot the regions every day at run_at, forever.  Connections are made once and the volume and snapshot
+    inventory of each region is kept between runs and refreshed every refresh_interval seconds.  Periods due
+    on the same day are taken as a single snapshot, runs never overlap.
+    :param periods: list of the periods to schedule, day, week and/or month
+    :param run_at: tuple of hour, minute
+    :param catalog: SnapshotCatalog the inventories are refreshed from, None to list the snapshots at every refresh
+    """
+    metrics = metrics or RunMetrics()
+    inventories = {}
+    for region_name in region_names:
+        conn = get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name, metrics=metrics)
+        if conn is None:
+            raise Exception("Could not connect to region {}".format(region_name))
+        inventories[region_name] = Inventory(conn, tag_namevalue, metrics, catalog)
+
+    while True:
+        run_time = next_run_time(datetime.now(), run_at)
+        period = due_periods(run_time.date(), periods)
+        print 'Next snapshot run at {} for period {}'.format(run_time.strftime('%d-%m-%Y %H:%M'), period)
+        while datetime.now() < run_time:
+            refresh_inventories(inventories, refresh_interval)
+            sleep(max(0, min(60, (run_time - datetime.now()).total_seconds())))
+        if period is None:
+            continue
+
+        with run_lock(lock_file):
+            started = time()
+            # The metrics files and the report are of this run only, calls made while idle are not part of it
+            metrics.reset()
+            for inventory in inventories.itervalues():
+                inventory.conn.scheduler.reset_counters()
+            refresh_inventories(inventories, refresh_interval)
+            results = make_snapshots_regions(aws_access_key_id, aws_secret_access_key, region_names, period,
+                                             tag_namevalue, share_account, workers, delete_workers, metrics=metrics,
+                                             inventories=inventories, copy_region=copy_region,
+                                             copy_concurrency=copy_concurrency, multi_volume=multi_volume,
+                                             catalog=catalog)
+        if len(region_names) > 1:
+            print_regions_report(results, time() - started)
+        if metrics_file:
+            metrics.write_json(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+
+
+def print_regions_report(results, wall_time):
+    """
+    Print the counters of every region and the totals, as one report
+    """
+    totals = dict.fromkeys(['total', 'success', 'created', 'untagged', 'errors', 'deleted', 'delete_failures',
+                            'throttles'], 0)
+    message = '\nSnapshot report for {} region(s)\n'.format(len(results))
+    for region_name in sorted(results):
+        result = results[region_name]
+        if isinstance(result, Exception):
+            message += '\nRegion {}: FAILED {}'.format(region_name, result)
+            continue
+        if result['total'] == 0:
+            message += '\nRegion {}: no volumes with the tag'.format(region_name)
+            continue
+        message += '\nRegion {}: {} snapshots of {} possible, created {}, not tagged or shared {}, errors {}, ' \
+                   'deleted {}, delete failures {}, throttled {}'.format(
+                       region_name, result['success'], result['total'], result['created'], result['untagged'],
+                       result['errors'], result['deleted'], result['delete_failures'], result['throttles'])
+        if 'copied' in result:
+            message += ', copied {}, copy failures {}, copies pending {}'.format(
+                result['copied'], result['copy_failures'], result['copy_pending'])
+        for key in totals:
+            totals[key] += result[key]
+
+    message += "\n\nTotal snapshots created: " + str(totals['created'])
+    message += "\nTotal snapshots errors: " + str(totals['errors'])
+    message += "\nTotal snapshots made but not tagged or shared: " + str(totals['untagged'])
+    message += "\nTotal snapshots deleted: " + str(totals['deleted'])
+    message += "\nTotal snapshot deletes failed: " + str(totals['delete_failures'])
+    message += "\nTotal API calls throttled and retried: " + str(totals['throttles'])
+    message += "\nTotal wall time: {:.1f} seconds\n".format(wall_time)
+    print message
+
+
+def sync_catalog_regions(aws_access_key_id, aws_secret_access_key, region_names, catalog, full=False):
+    """
+    Sync the catalog of every region in parallel.  A region that fails is reported and does not stop the others.
+    :return: list of the regions that failed
+    """
+    def sync(region_name):
+        try:
+            conn = get_ec2_connection(aws_access_key_id, aws_secret_access_key, region_name)
+            if conn is None:
+                raise Exception("Could not connect to region {}".format(region_name))
+            sync_catalog(catalog, conn, full)
+        except Exception, e:
+            print_exception(e)
+            print 'Error syncing the catalog of region ' + region_name
+            return region_name
+        return None
+
+    pool = ThreadPool(max(1, len(region_names)))
+    try:
+        return [region_name for region_name in pool.map(sync, region_names) if region_name is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_restore_points(catalog, region_names, cluster=None, uid=None):
+    """
+    Print the groups of snapshots of the regions, newest first
+    """
+    print '{:<16} {:<24} {:<20} {:>9} {:>9}  {:<24}  {}'.format('group_id', 'cluster', 'uid', 'snapshots',
+                                                                 'completed', 'started', 'regions')
+    for region_name in region_names:
+        for point in catalog.restore_points(region_name, cluster, uid):
+            print '{:<16} {:<24} {:<20} {:>9} {:>9}  {:<24}  {}'.format(
+                point['group_id'], point['cluster'], point['uid'], point['snapshots'], point['completed'],
+                point['first_start'], point['regions'])
+
+
+def print_group(catalog, region_names, group_id):
+    """
+    Print the snapshots of a group
+    """
+    for region_name in region_names:
+        for row in catalog.snapshots(region_name, group_id=group_id):
+            print '{} {} {} {:<10} {:>5} GiB  {}'.format(row['region'], row['id'], row['volume_id'], row['status'],
+                                                          row['volume_size'], row['start_time'])
 
 
 def main():
@@ -203,12 +1364,13 @@ def main():
 ''')
 
     parser.add_argument('-p', '--period', choices=['day', 'week', 'month', 'adhoc'],
-                        help='Specify period of snapshot',
-                        required=True)
+                        help='Specify period of snapshot, required unless running as a daemon',
+                        default=None)
 
     parser.add_argument('-t', '--tag_namevalue',
-                        help='Specify a tag name and value, i.e. mycustomtag:True',
-                        required=True)
+                        help='Specify a tag name and value, i.e. mycustomtag:True, required unless querying the '
+                             'catalog',
+                        default=None)
 
     parser.add_argument('-w', '--aws_access_key',
                         help='AWS Access key, None if using instance profile',
@@ -219,23 +1381,198 @@ def main():
                         default=None)
 
     parser.add_argument('-r', '--region',
-                        help='region, i.e. us-east-1',
+                        help='region, i.e. us-east-1.  Several regions can be given separated by commas, '
+                             'or all for every region of the account',
                         required=True)
 
     parser.add_argument('-s', '--share_account', 
                          help='Shares the snapshot with an account. Default no share is made', default=None)
 
+    parser.add_argument('-n', '--workers', type=int,
+                        help='Number of volumes to snapshot in parallel. Default {}'.format(DEFAULT_WORKERS),
+                        default=DEFAULT_WORKERS)
+
+    parser.add_argument('-d', '--delete_workers', type=int,
+                        help='Number of expired snapshots to delete in parallel. '
+                             'Default {}'.format(DEFAULT_DELETE_WORKERS),
+                        default=DEFAULT_DELETE_WORKERS)
+
+    parser.add_argument('--aws_timeout', type=int,
+                        help='Seconds a request to AWS may wait on its socket. Default {}'.format(DEFAULT_TIMEOUT),
+                        default=DEFAULT_TIMEOUT)
+
+    parser.add_argument('--aws_retries', type=int,
+                        help='Retries of a request to AWS failing with a server or connection error. '
+                             'Default {}'.format(DEFAULT_RETRIES),
+                        default=DEFAULT_RETRIES)
+
+    parser.add_argument('--multi_volume', action='store_true', default=False,
+                        help='Snapshot all the volumes of an instance with one request, so they are taken at the '
+                             'same time. -n is then the number of instances snapshotted in parallel')
+
+    parser.add_argument('--wait', action='store_true', default=False,
+                        help='Wait for the snapshots of this run to complete, exits with an error '
+                             'if any of them failed or are still pending')
+
+    parser.add_argument('--wait_timeout', type=int,
+                        help='Seconds to wait for the snapshots to complete. '
+                             'Default {}'.format(DEFAULT_WAIT_TIMEOUT),
+                        default=DEFAULT_WAIT_TIMEOUT)
+
+    parser.add_argument('--copy_region',
+                        help='Copy the snapshots to this region once they are completed, for disaster recovery. '
+                             'Default no copy is made', default=None)
+
+    parser.add_argument('--copy_concurrency', type=int,
+                        help='Number of copies in flight at once. Default {}'.format(DEFAULT_COPY_CONCURRENCY),
+                        default=DEFAULT_COPY_CONCURRENCY)
+
+    parser.add_argument('--metrics_file',
+                        help='Write the API call and phase metrics of the run to this JSON file', default=None)
+
+    parser.add_argument('--prometheus_file',
+                        help='Write the metrics of the run to this file for the Prometheus textfile collector, '
+                             'i.e. /var/lib/node_exporter/make_snapshot.prom', default=None)
+
+    parser.add_argument('--events_file',
+                        help='Append one JSON line per volume and deleted snapshot to this file', default=None)
+
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='Keep running and take the day, week and month snapshots on schedule')
+
+    parser.add_argument('--daemon_periods',
+                        help='Comma separated periods the daemon takes. Default {}'.format(DEFAULT_DAEMON_PERIODS),
+                        default=DEFAULT_DAEMON_PERIODS)
+
+    parser.add_argument('--daemon_time',
+                        help='Local time of day HH:MM the daemon snapshots at. Default {}'.format(DEFAULT_DAEMON_TIME),
+                        default=DEFAULT_DAEMON_TIME)
+
+    parser.add_argument('--refresh_interval', type=int,
+                        help='Seconds between two listings of the volumes and snapshots by the daemon. '
+                             'Default {}'.format(DEFAULT_REFRESH_INTERVAL),
+                        default=DEFAULT_REFRESH_INTERVAL)
+
+    parser.add_argument('--lock_file',
+                        help='Lock held while snapshotting, runs using the same lock file never overlap',
+                        default=None)
+
+    parser.add_argument('--catalog',
+                        help='SQLite file cataloging the snapshots, synced from EC2 and updated as snapshots are '
+                             'made and deleted, so they are not all listed at every run. Default no catalog',
+                        default=None)
+
+    parser.add_argument('--reconcile_interval', type=int,
+                        help='Seconds between two full listings of the snapshots of a region to correct the '
+                             'catalog. Default {}'.format(DEFAULT_RECONCILE_INTERVAL),
+                        default=DEFAULT_RECONCILE_INTERVAL)
+
+    parser.add_argument('--reconcile', action='store_true', default=False,
+                        help='Fully reconcile the catalog of the regions with EC2 now, then exit')
+
+    parser.add_argument('--restore_points', action='store_true', default=False,
+                        help='Sync the catalog and print the groups of snapshots that can be restored, then exit')
+
+    parser.add_argument('--group_id',
+                        help='Sync the catalog and print the snapshots of this group, then exit', default=None)
+
+    parser.add_argument('--cluster',
+                        help='Only print the restore points of this Cluster tag', default=None)
+
+    parser.add_argument('--uid',
+                        help='Only print the restore points of this Uid tag', default=None)
+
     args = parser.parse_args()
 
-    ec2_conn = get_ec2_connection(args.aws_access_key, args.aws_secret_key, args.region)
+    query = args.reconcile or args.restore_points or args.group_id is not None
+    if query and args.catalog is None:
+        parser.error('argument --catalog is required to query or reconcile the catalog')
+    if args.period is None and not args.daemon and not query:
+        parser.error('argument -p/--period is required')
+    if args.tag_namevalue is None and not query:
+        parser.error('argument -t/--tag_namevalue is required')
+
+    # The connection of a region is shared by its snapshot, delete and copy workers
+    get_clients(args.aws_access_key, args.aws_secret_key, args.workers + args.delete_workers + args.copy_concurrency,
+                args.aws_timeout, args.aws_retries)
+    region_names = get_region_names(args.aws_access_key, args.aws_secret_key, args.region)
+    if len(region_names) < 1:
+        raise Exception("Invalid region {}".format(args.region))
+    if args.copy_region is not None:
+        # Registers the endpoint of a copy region boto does not know
+        get_region_names(args.aws_access_key, args.aws_secret_key, args.copy_region)
+
+    catalog = None
+    if args.catalog is not None:
+        catalog = SnapshotCatalog(args.catalog, args.reconcile_interval)
+
+    if query:
+        failed = sync_catalog_regions(args.aws_access_key, args.aws_secret_key, region_names, catalog,
+                                      args.reconcile)
+        if args.restore_points:
+            print_restore_points(catalog, region_names, args.cluster, args.uid)
+        if args.group_id is not None:
+            print_group(catalog, region_names, args.group_id)
+        catalog.close()
+        if failed:
+            sys.exit(1)
+        return
 
-    if ec2_conn is None:
-        raise Exception("Could not connect to AWS with supplied credentials")
     namevalue = tuple(args.tag_namevalue.split(':'))
     if len(namevalue) != 2:
         raise Exception("Invalid Tag name value pair {}".format(args.tag_namevalue))
 
-    make_snapshots(ec2_conn, args.period, namevalue, args.share_account)
+    if args.daemon:
+        periods = [period.strip() for period in args.daemon_periods.split(',')]
+        for period in periods:
+            keep_count(period)
+        run_at = tuple(int(part) for part in args.daemon_time.split(':'))
+        if len(run_at) != 2:
+            raise Exception("Invalid daemon time {}".format(args.daemon_time))
+        run_daemon(args.aws_access_key, args.aws_secret_key, region_names, namevalue, args.share_account, periods,
+                   run_at, args.refresh_interval, args.workers, args.delete_workers, RunMetrics(args.events_file),
+                   args.lock_file, args.metrics_file, args.prometheus_file, args.copy_region, args.copy_concurrency,
+                   args.multi_volume, catalog)
+        return
+
+    started = time()
+    metrics = RunMetrics(args.events_file)
+    try:
+        with run_lock(args.lock_file):
+            results = make_snapshots_regions(args.aws_access_key, args.aws_secret_key, region_names, args.period,
+                                             namevalue, args.share_account, args.workers, args.delete_workers,
+                                             args.wait, args.wait_timeout, metrics, copy_region=args.copy_region,
+                                             copy_concurrency=args.copy_concurrency, multi_volume=args.multi_volume,
+                                             catalog=catalog)
+    finally:
+        metrics.close()
+        if catalog is not None:
+            catalog.close()
+        if args.metrics_file:
+            metrics.write_json(args.metrics_file)
+        if args.prometheus_file:
+            metrics.write_prometheus(args.prometheus_file)
+    if len(region_names) > 1:
+        print_regions_report(results, time() - started)
+
+    failed = False
+    for region_name in sorted(results):
+        result = results[region_name]
+        if isinstance(result, Exception):
+            failed = True
+            continue
+        if result.get('copy_failures') or result.get('copy_pending'):
+            failed = True
+        if 'wait' in result:
+            wait_result = result['wait']
+            print '\nRegion {}'.format(region_name)
+            print 'Snapshots completed: {}'.format(len(wait_result['completed']))
+            print 'Snapshots pending: {} {}'.format(len(wait_result['pending']), ' '.join(wait_result['pending']))
+            print 'Snapshots error: {} {}'.format(len(wait_result['error']), ' '.join(wait_result['error']))
+            if wait_result['pending'] or wait_result['error']:
+                failed = True
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
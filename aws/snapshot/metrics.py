@@ -0,0 +1,189 @@
+"""
+Run metrics for make_snapshot.
+
+Records the count, latency, throttles and errors of every EC2 API call, the time spent in each phase of a run
+and the result counters of each region.  They can be written as a JSON file and as a Prometheus textfile
+collector file, and per volume events can be streamed to a JSON lines file.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from time import time
+import json
+import os
+import threading
+
+# Upper bounds in seconds of the API call latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = 'interana_snapshot'
+
+
+class RunMetrics(object):
+    """
+    Shared by every region, connection and worker of a run.  A daemon keeps one for all its runs and resets it
+    at the start of each of them.
+    """
+
+    def __init__(self, events_file=None):
+        self.lock = threading.Lock()
+        self.reset()
+        self.events = open(events_file, 'a') if events_file else None
+
+    def reset(self):
+        """
+        Start the metrics of a new run, the events file is kept open
+        """
+        with self.lock:
+            self.started = time()
+            self.actions = {}
+            self.phases = {}
+            self.results = {}
+
+    def record_call(self, region_name, action, seconds, outcome):
+        """
+        :param outcome: ok, throttled or error
+        """
+        with self.lock:
+            stats = self.actions.get((region_name, action))
+            if stats is None:
+                stats = {'calls': 0, 'ok': 0, 'throttled': 0, 'error': 0, 'latency_sum': 0.0,
+                         'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+                self.actions[(region_name, action)] = stats
+            stats['calls'] += 1
+            stats[outcome] += 1
+            stats['latency_sum'] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['latency_buckets'][i] += 1
+                    break
+            else:
+                stats['latency_buckets'][-1] += 1
+
+    @contextmanager
+    def phase(self, region_name, name):
+        started = time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                key = (region_name, name)
+                self.phases[key] = self.phases.get(key, 0.0) + time() - started
+
+    def record_phase(self, region_name, name, seconds):
+        """
+        Add the seconds of a phase that was not timed with phase(), i.e. work spread over other threads
+        """
+        with self.lock:
+            key = (region_name, name)
+            self.phases[key] = self.phases.get(key, 0.0) + seconds
+
+    def record_result(self, region_name, result):
+        with self.lock:
+            self.results[region_name] = dict((key, value) for key, value in result.iteritems()
+                                             if isinstance(value, (int, long, float)))
+
+    def event(self, event, **fields):
+        """
+        Append one JSON line to the events file, if there is one
+        """
+        if self.events is None:
+            return
+        fields['event'] = event
+        fields['time'] = datetime.utcnow().isoformat() + 'Z'
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.events.write(line + '\n')
+            self.events.flush()
+
+    def as_dict(self):
+        with self.lock:
+            actions = []
+            for (region_name, action), stats in sorted(self.actions.iteritems()):
+                buckets = dict(('le_{}'.format(bound), count)
+                               for bound, count in zip(LATENCY_BUCKETS, stats['latency_buckets']))
+                buckets['le_inf'] = stats['latency_buckets'][-1]
+                actions.append({'region': region_name,
+                                'action': action,
+                                'calls': stats['calls'],
+                                'throttled': stats['throttled'],
+                                'errors': stats['error'],
+                                'latency_sum': round(stats['latency_sum'], 6),
+                                'latency_avg': round(stats['latency_sum'] / max(1, stats['calls']), 6),
+                                'latency_buckets': buckets})
+            phases = [{'region': region_name, 'phase': name, 'seconds': round(seconds, 3)}
+                      for (region_name, name), seconds in sorted(self.phases.iteritems())]
+            return {'started': datetime.utcfromtimestamp(self.started).isoformat() + 'Z',
+                    'wall_time': round(time() - self.started, 3),
+                    'api_calls': actions,
+                    'phases': phases,
+                    'results': dict(self.results)}
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.as_dict(), indent=4, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in the Prometheus text format, for the node exporter textfile collector
+        """
+        metrics = self.as_dict()
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append('# HELP {}_{} {}'.format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(PROMETHEUS_PREFIX, name, kind))
+
+        def sample(name, labels, value):
+            label_str = ','.join('{}="{}"'.format(key, labels[key]) for key in sorted(labels))
+            lines.append('{}_{}{{{}}} {}'.format(PROMETHEUS_PREFIX, name, label_str, value))
+
+        header('api_calls_total', 'counter', 'EC2 API calls made by the last run, including retries')
+        for stats in metrics['api_calls']:
+            sample('api_calls_total', {'region': stats['region'], 'action': stats['action']}, stats['calls'])
+        header('api_throttles_total', 'counter', 'EC2 API calls of the last run throttled and retried')
+        for stats in metrics['api_calls']:
+            sample('api_throttles_total', {'region': stats['region'], 'action': stats['action']}, stats['throttled'])
+        header('api_errors_total', 'counter', 'EC2 API calls of the last run that failed')
+        for stats in metrics['api_calls']:
+            sample('api_errors_total', {'region': stats['region'], 'action': stats['action']}, stats['errors'])
+
+        header('api_latency_seconds', 'histogram', 'EC2 API call latency in the last run')
+        for stats in metrics['api_calls']:
+            labels = {'region': stats['region'], 'action': stats['action']}
+            cumulative = 0
+            for bound in LATENCY_BUCKETS:
+                cumulative += stats['latency_buckets']['le_{}'.format(bound)]
+                sample('api_latency_seconds_bucket', dict(labels, le=bound), cumulative)
+            sample('api_latency_seconds_bucket', dict(labels, le='+Inf'), stats['calls'])
+            sample('api_latency_seconds_sum', labels, stats['latency_sum'])
+            sample('api_latency_seconds_count', labels, stats['calls'])
+
+        header('phase_seconds', 'gauge', 'Time spent in each phase of the last run')
+        for phase in metrics['phases']:
+            sample('phase_seconds', {'region': phase['region'], 'phase': phase['phase']}, phase['seconds'])
+
+        header('result', 'gauge', 'Counters of the last run')
+        for region_name, result in sorted(metrics['results'].iteritems()):
+            for key, value in sorted(result.iteritems()):
+                sample('result', {'region': region_name, 'counter': key}, value)
+
+        header('run_seconds', 'gauge', 'Wall time of the last run')
+        lines.append('{}_run_seconds {}'.format(PROMETHEUS_PREFIX, metrics['wall_time']))
+        header('last_run_timestamp_seconds', 'gauge', 'Time the last run finished')
+        lines.append('{}_last_run_timestamp_seconds {}'.format(PROMETHEUS_PREFIX, int(time())))
+
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+    def close(self):
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+
+def write_atomic(path, contents):
+    """
+    Write to a temporary file and rename it, so readers never see a partial file
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        fh.write(contents)
+    os.rename(tmp_path, path)
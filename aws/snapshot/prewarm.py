@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Pre-warm block devices by reading every block once.
+
+A volume restored from a snapshot fetches its blocks from S3 the first time they are read, so it is slow until
+every block has been read.  Each device is split in as many contiguous ranges as threads, every thread reads
+its range sequentially, and all the devices are read at the same time.  Works on any block device or file.
+"""
+from time import sleep, time
+import argparse
+import os
+import sys
+import threading
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_THREADS = 8
+
+# Seconds between two progress lines
+DEFAULT_PROGRESS_INTERVAL = 10
+
+
+def device_size(path):
+    """
+    :return: size in bytes of a block device or file, a block device has no size in its stat
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def read_ranges(size, block_size, threads):
+    """
+    Split size bytes in contiguous ranges, one per thread, starting on block boundaries
+    :return: list of (first byte, end byte)
+    """
+    blocks = (size + block_size - 1) // block_size
+    per_thread = max(1, (blocks + threads - 1) // max(1, threads))
+    return [(start * block_size, min(size, (start + per_thread) * block_size))
+            for start in range(0, blocks, per_thread)]
+
+
+class Prewarm(object):
+    """
+    Reads one device with threads, each with its own file descriptor
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, threads=DEFAULT_THREADS):
+        self.path = path
+        self.block_size = block_size
+        self.size = device_size(path)
+        self.ranges = read_ranges(self.size, block_size, threads)
+        self.bytes_read = 0
+        self.errors = []
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.read, args=read_range) for read_range in self.ranges]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        self.started = time()
+        for thread in self.threads:
+            thread.start()
+
+    def read(self, start, end):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.lseek(fd, start, os.SEEK_SET)
+                position = start
+                while position < end:
+                    data = os.read(fd, min(self.block_size, end - position))
+                    if not data:
+                        break
+                    position += len(data)
+                    with self.lock:
+                        self.bytes_read += len(data)
+            finally:
+                os.close(fd)
+        except Exception, e:
+            with self.lock:
+                self.errors.append('{} at byte {}: {}'.format(self.path, start, e))
+        finally:
+            with self.lock:
+                self.finished = max(self.finished or 0, time())
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    @property
+    def done(self):
+        return all(not thread.is_alive() for thread in self.threads)
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return 0.0
+        return max((self.finished if self.done and self.finished else time()) - self.started, 0.001)
+
+    def progress(self):
+        """
+        :return: one line with the percentage read and the throughput
+        """
+        return '{}: {:.1f}% {:.1f} of {:.1f} GiB at {:.1f} MiB/s'.format(
+            self.path, 100.0 * self.bytes_read / max(1, self.size), self.bytes_read / 1024.0 ** 3,
+            self.size / 1024.0 ** 3, self.bytes_read / 1024.0 ** 2 / self.seconds)
+
+    def result(self):
+        return {'path': self.path,
+                'size': self.size,
+                'bytes': self.bytes_read,
+                'seconds': round(self.seconds, 3),
+                'mb_per_second': round(self.bytes_read / 1024.0 ** 2 / self.seconds, 2),
+                'threads': len(self.ranges),
+                'block_size': self.block_size,
+                'errors': list(self.errors)}
+
+
+def prewarm_devices(paths, block_size=DEFAULT_BLOCK_SIZE, threads=DEFAULT_THREADS,
+                    progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """
+    Read every block of the devices, all at once, printing the progress of each every progress_interval seconds
+    :param threads: threads reading each device
+    :return: list of the result dicts of the devices
+    """
+    prewarms = [Prewarm(path, block_size, threads) for path in paths]
+    for prewarm in prewarms:
+        prewarm.start()
+    last_progress = time()
+    while True:
+        sleep(min(1.0, progress_interval))
+        if all(prewarm.done for prewarm in prewarms):
+            break
+        if time() - last_progress >= progress_interval:
+            last_progress = time()
+            for prewarm in prewarms:
+                print prewarm.progress()
+    for prewarm in prewarms:
+        prewarm.join()
+        print prewarm.progress()
+    return [prewarm.result() for prewarm in prewarms]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reads every block of devices restored from snapshots once, so "
+                                                 "they are at full speed when used")
+
+    parser.add_argument('paths', nargs='+', help='Block devices or files, i.e. /dev/xvdf')
+
+    parser.add_argument('-b', '--block_size', type=int,
+                        help='KiB read at once. Default {}'.format(DEFAULT_BLOCK_SIZE / 1024),
+                        default=DEFAULT_BLOCK_SIZE / 1024)
+
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Threads reading each device. Default {}'.format(DEFAULT_THREADS),
+                        default=DEFAULT_THREADS)
+
+    parser.add_argument('--progress_interval', type=int,
+                        help='Seconds between two progress lines. Default {}'.format(DEFAULT_PROGRESS_INTERVAL),
+                        default=DEFAULT_PROGRESS_INTERVAL)
+
+    args = parser.parse_args()
+
+    started = time()
+    results = prewarm_devices(args.paths, args.block_size * 1024, args.threads, args.progress_interval)
+    total = sum(result['bytes'] for result in results)
+    print '\nRead {:.1f} GiB of {} devices in {:.1f}s, {:.1f} MiB/s'.format(
+        total / 1024.0 ** 3, len(results), time() - started, total / 1024.0 ** 2 / max(time() - started, 0.001))
+    failed = False
+    for result in results:
+        for error in result['errors']:
+            print 'Error reading ' + error
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
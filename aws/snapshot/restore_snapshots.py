@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+Restore a group of snapshots, the snapshots make_snapshot took together in one run, as new volumes.
+
+Each volume is created in the availability zone of the volume it was taken of, with its tags, then optionally
+attached to an instance and, when that instance is this one, pre-warmed by reading every block once.  Every
+volume goes through these steps on its own worker, so a restore takes as long as its slowest volume.
+"""
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+import argparse
+import os
+import sys
+import threading
+
+from boto.ec2.volume import Volume
+from boto.utils import get_instance_metadata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aws_clients import DEFAULT_RETRIES, DEFAULT_TIMEOUT, get_clients, print_exception
+from make_snapshot import (DESCRIPTION_TAG, MAX_FILTER_VALUES, ZONE_TAG, chunks, get_ec2_connection,
+                           get_instance_volumes, get_region_names, sync_catalog)
+from prewarm import DEFAULT_BLOCK_SIZE, DEFAULT_PROGRESS_INTERVAL, DEFAULT_THREADS, prewarm_devices
+from snapshot_catalog import COPY_VOLUME_TAG, SnapshotCatalog, snapshot_cluster, snapshot_volume_id
+
+# Number of volumes restored in parallel by default
+DEFAULT_WORKERS = 8
+
+# Tags of the snapshots that are not given to the restored volumes
+SNAPSHOT_ONLY_TAGS = ('group_id', ZONE_TAG, DESCRIPTION_TAG, COPY_VOLUME_TAG, 'source_snapshot_id', 'source_region')
+
+# Tag of a restored volume holding the snapshot it was restored from
+RESTORED_FROM_TAG = 'restored_from'
+
+# Seconds between two polls of the volumes being created or attached, and how long to wait for each
+VOLUME_POLL_INTERVAL = 5
+DEFAULT_VOLUME_TIMEOUT = 1800
+
+# Device names restored volumes are attached as, the first ones free on the instance are used
+ATTACH_DEVICES = ['/dev/sd' + letter for letter in 'fghijklmnopqrstuvwxyz']
+
+# Seconds an attached volume may take to show up as a device of this instance
+DEVICE_TIMEOUT = 120
+
+
+def find_group_snapshots(conn, group_id, catalog=None, cluster=None, uid=None):
+    """
+    :param catalog: SnapshotCatalog to look the group up in after syncing it, None to list the snapshots
+    :param cluster: only the snapshots of this cluster, None for every cluster
+    :param uid: only the snapshots of this Uid, None for every Uid
+    :return: the snapshots of the group in the region of conn
+    """
+    if catalog is not None:
+        sync_catalog(catalog, conn)
+        return [catalog.to_snapshot(conn, row) for row in catalog.snapshots(conn.region.name, cluster=cluster,
+                                                                           uid=uid, group_id=group_id)]
+    snaps = conn.get_all_snapshots(owner='self', filters={'tag:group_id': group_id})
+    return [snap for snap in snaps if (cluster is None or snapshot_cluster(snap)[0] == cluster) and
+            (uid is None or snapshot_cluster(snap)[1] == uid)]
+
+
+def group_clusters(snaps):
+    """
+    :return: dict of cluster to its number of snapshots.  A group_id is the time of a run, the runs of several
+             clusters started in the same second share it.
+    """
+    clusters = {}
+    for snap in snaps:
+        cluster = snapshot_cluster(snap)[0]
+        clusters[cluster] = clusters.get(cluster, 0) + 1
+    return clusters
+
+
+def get_volumes(conn, volume_ids):
+    """
+    :return: dict of volume id to the volume, for the volumes that still exist
+    """
+    volumes = {}
+    for chunk in chunks(sorted(set(volume_ids)), MAX_FILTER_VALUES):
+        for vol in conn.get_all_volumes(filters={'volume-id': chunk}):
+            volumes[vol.id] = vol
+    return volumes
+
+
+def restore_zone(snap, volumes, region_name, zone=None):
+    """
+    :param volumes: dict of volume id to the volumes that still exist
+    :param zone: zone every volume is restored in, None for the zone of the volume the snapshot was taken of
+    :return: the availability zone to restore the snapshot in, None if it is not known
+    """
+    if zone:
+        return zone
+    vol = volumes.get(snapshot_volume_id(snap))
+    if vol is not None:
+        return vol.zone
+    # The zone of a copy is the zone of the volume in the region it was copied from
+    snap_zone = snap.tags.get(ZONE_TAG)
+    if snap_zone and snap_zone.startswith(region_name):
+        return snap_zone
+    return None
+
+
+def volume_tags(snap):
+    """
+    :return: the tags of the volume restored from the snapshot, the tags of the volume the snapshot was taken of
+    """
+    # Tags starting with 'aws:' are reserved for internal use
+    tags = dict((key, value) for key, value in snap.tags.iteritems()
+                if key not in SNAPSHOT_ONLY_TAGS and not key.startswith('aws:'))
+    tags[RESTORED_FROM_TAG] = snap.id
+    return tags
+
+
+def create_volume_local(conn, snap, zone, volume_type, tags):
+    """
+    Same as conn.create_volume, with the tags given in the same call
+    :param volume_type: i.e. gp2, None for the default of EC2
+    :return: the new volume
+    """
+    params = {'SnapshotId': snap.id,
+              'AvailabilityZone': zone,
+              'TagSpecification.1.ResourceType': 'volume'}
+    if volume_type:
+        params['VolumeType'] = volume_type
+    for i, (tag_key, tag_value) in enumerate(sorted(tags.iteritems()), 1):
+        params['TagSpecification.1.Tag.{}.Key'.format(i)] = tag_key
+        params['TagSpecification.1.Tag.{}.Value'.format(i)] = tag_value
+    return conn.get_object('CreateVolume', params, Volume, verb='POST')
+
+
+class VolumeWatcher(object):
+    """
+    Polls the volumes being restored, MAX_FILTER_VALUES volumes per describe call, and wakes the worker of each
+    volume once it is available or attached
+    """
+
+    def __init__(self, conn, poll_interval=VOLUME_POLL_INTERVAL):
+        self.conn = conn
+        self.poll_interval = poll_interval
+        self.waiting = {}
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, volume_id, status, timeout=DEFAULT_VOLUME_TIMEOUT):
+        """
+        :param status: available, or attached for a volume attached to its instance
+        :return: the volume once it has the status
+        """
+        event = threading.Event()
+        entry = {'status': status, 'event': event, 'volume': None, 'state': None}
+        with self.lock:
+            self.waiting[volume_id] = entry
+        event.wait(timeout)
+        with self.lock:
+            self.waiting.pop(volume_id, None)
+        if not event.is_set():
+            raise Exception('Volume {} is not {} after {} seconds'.format(volume_id, status, timeout))
+        if entry['volume'] is None:
+            raise Exception('Volume {} failed, it is in state {}'.format(volume_id, entry['state']))
+        return entry['volume']
+
+    def run(self):
+        while not self.closed:
+            sleep(self.poll_interval)
+            with self.lock:
+                waiting = dict(self.waiting)
+            try:
+                for chunk in chunks(waiting.keys(), MAX_FILTER_VALUES):
+                    for vol in self.conn.get_all_volumes(filters={'volume-id': chunk}):
+                        entry = waiting[vol.id]
+                        if entry['status'] == 'attached':
+                            reached = vol.attachment_state() == 'attached'
+                        else:
+                            reached = vol.status == entry['status']
+                        if reached:
+                            entry['volume'] = vol
+                        elif vol.status != 'error':
+                            continue
+                        entry['state'] = vol.status
+                        entry['event'].set()
+            except Exception, e:
+                print_exception(e)
+                print 'Error polling the volumes being restored'
+
+    def close(self):
+        self.closed = True
+
+
+def local_device(volume_id, device, timeout=DEVICE_TIMEOUT):
+    """
+    Find the device of an attached volume on this instance.  /dev/sdf can show up as /dev/xvdf, and on NVMe
+    instances as the device linked from /dev/disk/by-id by the volume id.
+    :return: the path of the device
+    """
+    candidates = [device, device.replace('/dev/sd', '/dev/xvd'),
+                  '/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_' + volume_id.replace('-', '')]
+    started = time()
+    while time() - started < timeout:
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return os.path.realpath(candidate)
+        sleep(1)
+    raise Exception('Volume {} attached as {} did not show up on this instance'.format(volume_id, device))
+
+
+def restore_group(conn, snaps, workers=DEFAULT_WORKERS, zone=None, volume_type=None, attach_instance=None,
+                  prewarm=False, block_size=DEFAULT_BLOCK_SIZE, prewarm_threads=DEFAULT_THREADS,
+                  progress_interval=DEFAULT_PROGRESS_INTERVAL, volume_timeout=DEFAULT_VOLUME_TIMEOUT,
+                  poll_interval=VOLUME_POLL_INTERVAL):
+    """
+    Restore the snapshots as new volumes, all at once
+    :param snaps: the snapshots of a group
+    :param zone: zone every volume is restored in, None for the zone of the volume each snapshot was taken of
+    :param volume_type: i.e. gp2, None for the type of the volume each snapshot was taken of if it still exists
+    :param attach_instance: id of the instance the volumes are attached to, None to leave them available
+    :param prewarm: True to read every block of the volumes once attached, attach_instance must be this instance
+    :return: list of dicts of the snapshot id, volume id, zone, device and seconds of each step, or the error
+    """
+    region_name = conn.region.name
+    volumes = get_volumes(conn, [snapshot_volume_id(snap) for snap in snaps])
+    free_devices = []
+    if attach_instance is not None:
+        used = set(vol.attach_data.device for vol in get_instance_volumes(conn, [attach_instance])[attach_instance])
+        free_devices = [device for device in ATTACH_DEVICES
+                        if device not in used and device.replace('/dev/sd', '/dev/xvd') not in used]
+        if len(free_devices) < len(snaps):
+            raise Exception('Instance {} has {} free devices for {} volumes'.format(attach_instance,
+                                                                                   len(free_devices), len(snaps)))
+    devices_lock = threading.Lock()
+    watcher = VolumeWatcher(conn, poll_interval)
+
+    def restore(snap):
+        started = time()
+        result = {'snapshot_id': snap.id, 'source_volume_id': snapshot_volume_id(snap), 'size': snap.volume_size}
+        try:
+            if snap.status != 'completed':
+                raise Exception('Snapshot {} is {}, not completed'.format(snap.id, snap.status))
+            result['zone'] = restore_zone(snap, volumes, region_name, zone)
+            if result['zone'] is None:
+                raise Exception('Availability zone of snapshot {} is not known, give one with --zone'.format(snap.id))
+            source = volumes.get(snapshot_volume_id(snap))
+            vol = create_volume_local(conn, snap, result['zone'], volume_type or (source.type if source else None),
+                                      volume_tags(snap))
+            result['volume_id'] = vol.id
+            print 'Creating volume {} from snapshot {} in {}'.format(vol.id, snap.id, result['zone'])
+            watcher.wait(vol.id, 'available', volume_timeout)
+            result['available_seconds'] = round(time() - started, 3)
+
+            if attach_instance is not None:
+                with devices_lock:
+                    device = free_devices.pop(0)
+                conn.attach_volume(vol.id, attach_instance, device)
+                watcher.wait(vol.id, 'attached', volume_timeout)
+                result['device'] = device
+                result['attached_seconds'] = round(time() - started, 3)
+                print 'Attached volume {} to {} as {}'.format(vol.id, attach_instance, device)
+
+            if prewarm and attach_instance is not None:
+                path = local_device(vol.id, device)
+                result['prewarm'] = prewarm_devices([path], block_size, prewarm_threads, progress_interval)[0]
+                if result['prewarm']['errors']:
+                    raise Exception('Could not read all of {}: {}'.format(path, result['prewarm']['errors'][0]))
+                result['prewarmed_seconds'] = round(time() - started, 3)
+        except Exception, e:
+            print_exception(e)
+            print 'Error restoring snapshot ' + snap.id
+            result['error'] = str(e)
+        result['seconds'] = round(time() - started, 3)
+        return result
+
+    pool = ThreadPool(max(1, min(workers, len(snaps))))
+    try:
+        return pool.map(restore, snaps)
+    finally:
+        pool.close()
+        pool.join()
+        watcher.close()
+
+
+def print_restore_report(group_id, results, wall_time):
+    message = '\nRestore of group {}: {} volumes\n'.format(group_id, len(results))
+    for result in sorted(results, key=lambda result: result['snapshot_id']):
+        if 'error' in result:
+            message += '\n{} of {}: FAILED {}'.format(result['snapshot_id'], result['source_volume_id'],
+                                                      result['error'])
+            continue
+        message += '\n{} of {}: volume {} in {}'.format(result['snapshot_id'], result['source_volume_id'],
+                                                        result['volume_id'], result['zone'])
+        if 'device' in result:
+            message += ' as {}'.format(result['device'])
+        message += ', available after {:.0f}s'.format(result['available_seconds'])
+        if 'prewarm' in result:
+            message += ', pre-warmed at {} MiB/s after {:.0f}s'.format(result['prewarm']['mb_per_second'],
+                                                                       result['prewarmed_seconds'])
+    failed = len([result for result in results if 'error' in result])
+    message += '\n\nTotal volumes restored: {}'.format(len(results) - failed)
+    message += '\nTotal volumes failed: {}'.format(failed)
+    message += '\nSlowest volume: {:.1f} seconds'.format(max([result['seconds'] for result in results] or [0]))
+    message += '\nTotal wall time: {:.1f} seconds\n'.format(wall_time)
+    print message
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restores a group of snapshots taken by make_snapshot as volumes",
+                                     epilog='''
+    Notes:
+    The group_id is the group_id tag of the snapshots, see make_snapshot.py --restore_points.  A group_id
+    shared by several clusters is refused unless --cluster picks one of them.
+''')
+
+    parser.add_argument('-g', '--group_id', help='Group of snapshots to restore', required=True)
+
+    parser.add_argument('--cluster', help='Restore only the snapshots of this cluster', default=None)
+
+    parser.add_argument('--uid', help='Restore only the snapshots of this Uid', default=None)
+
+    parser.add_argument('-r', '--region', help='region, i.e. us-east-1', required=True)
+
+    parser.add_argument('-w', '--aws_access_key',
+                        help='AWS Access key, None if using instance profile',
+                        default=None)
+
+    parser.add_argument('-x', '--aws_secret_key',
+                        help='AWS Secret key, None if using instance profile',
+                        default=None)
+
+    parser.add_argument('--catalog',
+                        help='SQLite snapshot catalog of make_snapshot to find the group in. Default the '
+                             'snapshots are listed', default=None)
+
+    parser.add_argument('-n', '--workers', type=int,
+                        help='Number of volumes restored in parallel. Default {}'.format(DEFAULT_WORKERS),
+                        default=DEFAULT_WORKERS)
+
+    parser.add_argument('--zone',
+                        help='Availability zone to restore every volume in. Default the zone of the volume each '
+                             'snapshot was taken of', default=None)
+
+    parser.add_argument('--volume_type',
+                        help='Type of the volumes, i.e. gp2. Default the type of the volume each snapshot was '
+                             'taken of', default=None)
+
+    parser.add_argument('--attach_instance',
+                        help='Attach the volumes to this instance id, or self for the instance this runs on. '
+                             'Default the volumes are left available', default=None)
+
+    parser.add_argument('--prewarm', action='store_true', default=False,
+                        help='Read every block of the volumes once attached to this instance, so they are at '
+                             'full speed when used')
+
+    parser.add_argument('-b', '--block_size', type=int,
+                        help='KiB read at once when pre-warming. Default {}'.format(DEFAULT_BLOCK_SIZE / 1024),
+                        default=DEFAULT_BLOCK_SIZE / 1024)
+
+    parser.add_argument('-t', '--prewarm_threads', type=int,
+                        help='Threads reading each volume when pre-warming. Default {}'.format(DEFAULT_THREADS),
+                        default=DEFAULT_THREADS)
+
+    parser.add_argument('--progress_interval', type=int,
+                        help='Seconds between two pre-warm progress lines. '
+                             'Default {}'.format(DEFAULT_PROGRESS_INTERVAL),
+                        default=DEFAULT_PROGRESS_INTERVAL)
+
+    parser.add_argument('--volume_timeout', type=int,
+                        help='Seconds to wait for a volume to be available or attached. '
+                             'Default {}'.format(DEFAULT_VOLUME_TIMEOUT),
+                        default=DEFAULT_VOLUME_TIMEOUT)
+
+    parser.add_argument('--aws_timeout', type=int,
+                        help='Seconds a request to AWS may wait on its socket. Default {}'.format(DEFAULT_TIMEOUT),
+                        default=DEFAULT_TIMEOUT)
+
+    parser.add_argument('--aws_retries', type=int,
+                        help='Retries of a request to AWS failing with a server or connection error. '
+                             'Default {}'.format(DEFAULT_RETRIES),
+                        default=DEFAULT_RETRIES)
+
+    args = parser.parse_args()
+
+    attach_instance = args.attach_instance
+    if attach_instance == 'self' or args.prewarm:
+        instance_id = get_instance_metadata(timeout=2, num_retries=1).get('instance-id')
+        if attach_instance == 'self':
+            attach_instance = instance_id
+        if args.prewarm and (attach_instance is None or attach_instance != instance_id):
+            parser.error('--prewarm needs the volumes attached to this instance, use --attach_instance self')
+
+    get_clients(args.aws_access_key, args.aws_secret_key, args.workers + 1, args.aws_timeout, args.aws_retries)
+    get_region_names(args.aws_access_key, args.aws_secret_key, args.region)
+    conn = get_ec2_connection(args.aws_access_key, args.aws_secret_key, args.region)
+    if conn is None:
+        raise Exception("Could not connect to region {}".format(args.region))
+
+    catalog = SnapshotCatalog(args.catalog) if args.catalog is not None else None
+    try:
+        snaps = find_group_snapshots(conn, args.group_id, catalog, args.cluster, args.uid)
+    finally:
+        if catalog is not None:
+            catalog.close()
+    if len(snaps) < 1:
+        raise Exception("No snapshots of group {} in region {}".format(args.group_id, args.region))
+    clusters = group_clusters(snaps)
+    if len(clusters) > 1:
+        raise Exception("Group {} has the snapshots of several clusters, {}, choose one with --cluster".format(
+            args.group_id, ', '.join('{} ({} snapshots)'.format(cluster, count)
+                                     for cluster, count in sorted(clusters.iteritems()))))
+
+    started = time()
+    results = restore_group(conn, snaps, args.workers, args.zone, args.volume_type, attach_instance, args.prewarm,
+                            args.block_size * 1024, args.prewarm_threads, args.progress_interval,
+                            args.volume_timeout)
+    print_restore_report(args.group_id, results, time() - started)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
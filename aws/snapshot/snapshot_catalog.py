@@ -0,0 +1,300 @@
+"""
+Local catalog of the snapshots made by make_snapshot.
+
+The snapshots of every region are kept in a SQLite file, indexed by region and volume, cluster and Uid, period
+and group_id, so rotation and restore point lookups run as local queries instead of listing every snapshot of
+the account.  The catalog is updated by make_snapshot as it creates and deletes snapshots, synced from EC2 for
+the days since its watermark, and fully reconciled with EC2 every reconcile interval to correct any drift.
+"""
+from datetime import datetime
+from time import time
+import json
+import re
+import sqlite3
+import threading
+
+from boto.ec2.snapshot import Snapshot
+
+# Tag holding the volume id of the snapshot a copy was made from, copies do not have a real volume id
+COPY_VOLUME_TAG = 'source_volume_id'
+
+# Matches the period in the descriptions make_snapshots gives to snapshots.  A snapshot taken for several
+# periods at once, by the daemon, has them joined with a + i.e. DAY+WEEK
+SNAPSHOT_PERIOD_RE = re.compile(r' Interana ((?:DAY|WEEK|MONTH|ADHOC)(?:\+(?:DAY|WEEK|MONTH|ADHOC))*) Snapshot ')
+
+# Cluster, Uid and group id in the descriptions, for snapshots missing the tags
+SNAPSHOT_DESCRIPTION_RE = re.compile(r'^(.*) Interana \S+ Snapshot (\S+)-(\d{8}T\d{6}) for ')
+
+# Seconds between two full reconciles of the catalog of a region with EC2
+DEFAULT_RECONCILE_INTERVAL = 24 * 3600
+
+# Values bound to a single query, below the SQLite limit on variables
+MAX_QUERY_VALUES = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    volume_id TEXT,
+    ec2_volume_id TEXT,
+    cluster TEXT,
+    uid TEXT,
+    group_id TEXT,
+    start_time TEXT NOT NULL,
+    status TEXT,
+    volume_size INTEGER,
+    description TEXT,
+    tags TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshot_periods (
+    snapshot_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, period)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    region TEXT PRIMARY KEY,
+    watermark TEXT,
+    synced REAL,
+    reconciled REAL
+);
+CREATE INDEX IF NOT EXISTS snapshots_volume ON snapshots (region, volume_id, start_time);
+CREATE INDEX IF NOT EXISTS snapshots_cluster ON snapshots (cluster, uid, start_time);
+CREATE INDEX IF NOT EXISTS snapshots_group ON snapshots (group_id);
+CREATE INDEX IF NOT EXISTS snapshot_periods_period ON snapshot_periods (period, snapshot_id);
+'''
+
+COLUMNS = ('id', 'region', 'volume_id', 'ec2_volume_id', 'cluster', 'uid', 'group_id', 'start_time', 'status',
+           'volume_size', 'description', 'tags', 'updated')
+
+
+def snapshot_volume_id(snap):
+    """
+    :return: id of the volume the snapshot is of, for a copy the volume of the snapshot it was copied from
+    """
+    return snap.tags.get(COPY_VOLUME_TAG) or snap.volume_id
+
+
+def snapshot_periods(description):
+    """
+    :param description: snapshot description made by make_snapshots
+    :return: list of day, week, month or adhoc, empty if the snapshot was not made by us
+    """
+    match = SNAPSHOT_PERIOD_RE.search(description or '')
+    if match is None:
+        return []
+    return match.group(1).lower().split('+')
+
+
+def snapshot_cluster(snap):
+    """
+    :return: cluster, Uid and group id of a snapshot, from its tags or else its description, None when unknown
+    """
+    cluster = snap.tags.get('Cluster')
+    uid = snap.tags.get('Uid')
+    group_id = snap.tags.get('group_id')
+    match = SNAPSHOT_DESCRIPTION_RE.search(snap.description or '')
+    if match is not None:
+        cluster = cluster or match.group(1)
+        uid = uid or (match.group(2) if match.group(2) != 'UidUnknown' else None)
+        group_id = group_id or match.group(3)
+    return cluster, uid, group_id
+
+
+def snapshot_row(region_name, snap, updated):
+    """
+    :return: the catalog row of a snapshot, as a tuple of COLUMNS
+    """
+    cluster, uid, group_id = snapshot_cluster(snap)
+    start_time = snap.start_time or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return (snap.id, region_name, snapshot_volume_id(snap), snap.volume_id, cluster, uid, group_id, start_time,
+            snap.status or 'pending', snap.volume_size, snap.description, json.dumps(dict(snap.tags)), updated)
+
+
+class SnapshotCatalog(object):
+    """
+    Shared by every region and worker of a process.  Several processes may use the same file, SQLite locks it
+    while writing.
+    """
+
+    def __init__(self, path, reconcile_interval=DEFAULT_RECONCILE_INTERVAL):
+        """
+        :param path: SQLite file, created if missing, :memory: for a catalog of this process only
+        """
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def put(self, region_name, snaps):
+        """
+        Add or update snapshots of a region.  Snapshots not made by make_snapshots are ignored.
+        :return: number of snapshots stored
+        """
+        updated = time()
+        rows = []
+        periods = []
+        for snap in snaps:
+            snap_periods = snapshot_periods(snap.description)
+            if not snap_periods:
+                continue
+            rows.append(snapshot_row(region_name, snap, updated))
+            periods += [(snap.id, period) for period in snap_periods]
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO snapshots ({}) VALUES ({})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), rows)
+                self.db.executemany('INSERT OR IGNORE INTO snapshot_periods (snapshot_id, period) VALUES (?, ?)',
+                                    periods)
+        return len(rows)
+
+    def add(self, region_name, snap):
+        self.put(region_name, [snap])
+
+    def remove(self, snapshot_ids):
+        with self.lock:
+            with self.db:
+                self.delete_rows(list(snapshot_ids))
+
+    def delete_rows(self, snapshot_ids):
+        for start in range(0, len(snapshot_ids), MAX_QUERY_VALUES):
+            chunk = snapshot_ids[start:start + MAX_QUERY_VALUES]
+            marks = ', '.join('?' * len(chunk))
+            self.db.execute('DELETE FROM snapshot_periods WHERE snapshot_id IN ({})'.format(marks), chunk)
+            self.db.execute('DELETE FROM snapshots WHERE id IN ({})'.format(marks), chunk)
+
+    def sync_from(self, region_name):
+        """
+        :return: the start time EC2 should be listed from to bring the region up to date, the watermark or the
+                 start time of the oldest snapshot still pending if older, now if the region has no snapshots.
+                 None when a full reconcile is due.
+        """
+        with self.lock:
+            state = self.db.execute('SELECT watermark, reconciled FROM sync_state WHERE region = ?',
+                                    (region_name,)).fetchone()
+            if state is None or state['reconciled'] is None or \
+                    time() - state['reconciled'] >= self.reconcile_interval:
+                return None
+            pending = self.db.execute("SELECT min(start_time) FROM snapshots WHERE region = ? AND status = 'pending'",
+                                      (region_name,)).fetchone()[0]
+        starts = [start for start in (state['watermark'], pending) if start is not None]
+        return min(starts) if starts else datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def update(self, region_name, snaps):
+        """
+        Store the snapshots listed since the watermark, and move the watermark to the newest of them
+        """
+        self.put(region_name, snaps)
+        self.set_state(region_name, snaps)
+
+    def reconcile(self, region_name, snaps, started):
+        """
+        Replace the catalog of a region with a full listing of its snapshots
+        :param started: time the listing started, snapshots added to the catalog since are kept
+        """
+        self.put(region_name, snaps)
+        listed = set(snap.id for snap in snaps)
+        with self.lock:
+            with self.db:
+                missing = [row['id'] for row in self.db.execute(
+                    'SELECT id FROM snapshots WHERE region = ? AND updated < ?', (region_name, started))
+                    if row['id'] not in listed]
+                self.delete_rows(missing)
+        self.set_state(region_name, snaps, reconciled=True)
+        return len(missing)
+
+    def set_state(self, region_name, snaps, reconciled=False):
+        now = time()
+        with self.lock:
+            with self.db:
+                state = self.db.execute('SELECT watermark, reconciled FROM sync_state WHERE region = ?',
+                                        (region_name,)).fetchone()
+                watermarks = [snap.start_time for snap in snaps if snap.start_time]
+                if state is not None and state['watermark']:
+                    watermarks.append(state['watermark'])
+                self.db.execute('INSERT OR REPLACE INTO sync_state (region, watermark, synced, reconciled) '
+                                'VALUES (?, ?, ?, ?)',
+                                (region_name, max(watermarks) if watermarks else None, now,
+                                 now if reconciled else (state['reconciled'] if state is not None else None)))
+
+    def snapshots(self, region_name=None, volume_ids=None, period=None, cluster=None, uid=None, group_id=None,
+                  completed=False):
+        """
+        Query the catalog, every given criteria must match
+        :param volume_ids: list of volume ids, for copies the volumes of the snapshots they were copied from
+        :param completed: True for the completed snapshots only
+        :return: list of rows, oldest first
+        """
+        where = []
+        values = []
+        for column, value in (('s.region', region_name), ('s.cluster', cluster), ('s.uid', uid),
+                              ('s.group_id', group_id), ('p.period', period)):
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                values.append(value)
+        if completed:
+            where.append("s.status = 'completed'")
+        query = 'SELECT s.* FROM snapshots s'
+        if period is not None:
+            query += ' JOIN snapshot_periods p ON p.snapshot_id = s.id'
+        if volume_ids is None:
+            chunks = [None]
+        else:
+            volume_ids = list(volume_ids)
+            chunks = [volume_ids[start:start + MAX_QUERY_VALUES]
+                      for start in range(0, len(volume_ids), MAX_QUERY_VALUES)]
+        rows = []
+        with self.lock:
+            for chunk in chunks:
+                chunk_where = list(where)
+                chunk_values = list(values)
+                if chunk is not None:
+                    chunk_where.append('s.volume_id IN ({})'.format(', '.join('?' * len(chunk))))
+                    chunk_values += chunk
+                rows += self.db.execute(query + (' WHERE ' + ' AND '.join(chunk_where) if chunk_where else ''),
+                                        chunk_values).fetchall()
+        return sorted(rows, key=lambda row: (row['start_time'], row['id']))
+
+    def restore_points(self, region_name=None, cluster=None, uid=None):
+        """
+        The groups of snapshots taken together by a run, newest first
+        :return: list of dicts with the group_id, cluster, uid, regions, number of snapshots and of completed
+                 ones, and the start time of the first and last snapshot of the group
+        """
+        where = ['group_id IS NOT NULL']
+        values = []
+        for column, value in (('region', region_name), ('cluster', cluster), ('uid', uid)):
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                values.append(value)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT group_id, cluster, uid, group_concat(DISTINCT region) AS regions, count(*) AS snapshots, "
+                "sum(status = 'completed') AS completed, min(start_time) AS first_start, "
+                "max(start_time) AS last_start FROM snapshots WHERE {} GROUP BY group_id, cluster, uid "
+                "ORDER BY last_start DESC, cluster, uid".format(' AND '.join(where)), values).fetchall()
+        return [dict(row) for row in rows]
+
+    def to_snapshot(self, conn, row):
+        """
+        :return: a boto Snapshot of the row, bound to conn so it can be deleted or copied without describing it
+        """
+        snap = Snapshot(conn)
+        snap.region = conn.region
+        snap.id = row['id']
+        snap.volume_id = row['ec2_volume_id']
+        snap.status = row['status']
+        snap.start_time = row['start_time']
+        snap.volume_size = row['volume_size']
+        snap.description = row['description']
+        snap.tags.update(json.loads(row['tags'] or '{}'))
+        return snap